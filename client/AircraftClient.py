@@ -1,27 +1,72 @@
-import json
 import os
 import random
+import struct
 import sys
 from argparse import ArgumentParser, Namespace
 from datetime import datetime, timezone
 from multiprocessing import Queue
 from queue import Empty
 from threading import Event, Thread
-from time import sleep
+from time import monotonic, sleep
 from typing import Callable
 
 from ViasatMSI import ViasatMSI
 from common.MsiToOcc import transform
 from common.KinesisClient import KinesisClient
+from common import Codec
+from common.Compression import BUILTIN_VERSION, Compressor, loadDictionary
+from common.DeltaCodec import DeltaEncoder
 from common.MqttClient import MqttClient
+from common.Spool import Spool, TokenBucket
 
 import logging
 logger = logging.getLogger()
 
 class AircraftClient(object) :
-    def __init__(self,msi="https://msi.viasat.com:9100/v1/flight") :
+    # spooled records: <topic length:u16><content-type length:u16><topic><content-type><payload>
+    RECORD = struct.Struct("!HH")
+    DRAIN_IDLE = 1
+    DRAIN_RETRY = 10
+    PUBLISH_TIMEOUT = 10
+
+    def __init__(self,msi="https://msi.viasat.com:9100/v1/flight",encoding:str="json",contentType:bool=False,
+                 keyframeInterval:int=0,batchSize:int=1,batchDelay:float=30.0,
+                 spoolDir:str=None,spoolMaxBytes:int=64*1024*1024,drainRate:float=20.0,drainBatch:int=50) :
         super().__init__()
 
+        self.fmt = Codec.getFormat(encoding)
+        self.useContentType = contentType
+
+        # delta mode: a full keyframe every keyframeInterval messages and only
+        # the changed fields in between (0 = always full records)
+        self.delta = DeltaEncoder(keyframeInterval) if keyframeInterval > 1 else None
+        self.connects = 0
+        self.lastTopic = None
+
+        # batching: up to batchSize samples, or batchDelay seconds of them, are
+        # published as one envelope {"header": ..., "batch": [envelope,...]}
+        self.batchSize = batchSize
+        self.batchDelay = batchDelay
+        self.pending = []
+        self.pendingTopic = None
+        self.pendingContentType = None
+        self.pendingSince = 0.0
+        self.pendingFull = []
+
+        # store-and-forward: while the broker can't be reached the full
+        # records go to a disk spool (oldest evicted past spoolMaxBytes) and
+        # are drained as batches of up to drainBatch records, at most
+        # drainRate records/s and only while no live sample is waiting
+        self.spool = None
+        self.drainThread = None
+        self.stopFlag = Event()
+        self.drained = 0
+        if spoolDir is not None:
+            self.spool = Spool(spoolDir,segmentSize=min(16*1024*1024,max(spoolMaxBytes // 8,64*1024)),
+                               maxBytes=spoolMaxBytes)
+            self.drainLimit = TokenBucket(drainRate,max(drainRate,drainBatch))
+            self.drainBatch = drainBatch
+
         self.msiUrl = msi
         logger.info(f"Retrieving MSI data from {msi}")
 
@@ -32,12 +77,14 @@ class AircraftClient(object) :
         self.tailNum = None
         self.flightNum = None
 
-    def addClient(self,name:str,func:Callable,client) :
+    def addClient(self,name:str,func:Callable,client,flush:Callable=None) :
+        # flush(client,force) is called after every sample and on timeouts,
+        # for clients that hold samples back
         q = Queue()
         evt = Event()
         evt.set()
 
-        thr = Thread(target=self.clientRun,args=(name,q,evt,func,client))
+        thr = Thread(target=self.clientRun,args=(name,q,evt,func,client,flush))
         self.clients[name] = (thr,q,evt,func,client)
         thr.start()
 
@@ -47,8 +94,7 @@ class AircraftClient(object) :
             return
 
         try:
-            kdata = json.dumps(transform(msiData))
-            rsp = aws.publish(None,kdata)
+            rsp = aws.publish(None,transform(msiData))
             if rsp is not None:
                 logger.info(f"Published to Kinesis: [{rsp['ResponseMetadata']['HTTPStatusCode']}] : {rsp['SequenceNumber']}")
         except KeyError as ke:
@@ -82,24 +128,190 @@ class AircraftClient(object) :
                    "data" : dataToSend
                    }
 
-        payloadStr = json.dumps(payload)
+        payloadStr = self.fmt.dumps(payload)
+        logText = payloadStr if self.fmt.name == "json" else Codec.dumps(payload)
+
+        # deltas can't be replayed after newer records, spool full ones
+        offline = self.isOffline(mqtt)
+
+        toSend = payload
+        if self.delta is not None and not offline:
+            # the server may have missed messages while disconnected
+            if mqtt.connects != self.connects:
+                self.connects = mqtt.connects
+                self.delta.reset()
+            if self.lastTopic is not None and topic != self.lastTopic:
+                logger.info(f"Delta savings for {self.lastTopic}: {self.delta.stats(self.lastTopic)}")
+            self.lastTopic = topic
+
+            # the log keeps the full record
+            fields,delta = self.delta.encode(topic,dataToSend)
+            full = len(payloadStr)
+            toSend = {"header" : dict(header,**fields),
+                      "data" : delta
+                      }
+            payloadStr = self.fmt.dumps(toSend)
+            self.delta.account(topic,len(payloadStr),full)
+
+        # binary formats are announced with the content-type property or a
+        # topic suffix, the server also recognizes them by the first byte
+        pubTopic = topic
+        contentType = None
+        if self.fmt.name != "json":
+            if self.useContentType:
+                contentType = self.fmt.contentType
+            else:
+                pubTopic = f"{topic}/{self.fmt.name}"
 
 
         logger.info(f"Publishing to {topic}, timestamp: {msiData['timestamp']}")
-        logger.info(f"TOPIC:[{topic}] PAYLOAD:[{payloadStr}]")
-        mqtt.publish(topic,payloadStr)
+        logger.info(f"TOPIC:[{topic}] PAYLOAD:[{logText.decode('utf-8')}]")
+        if offline:
+            self.flushMqtt(mqtt,True)
+            self.store(pubTopic,contentType,payloadStr)
+            return
+
+        if self.batchSize <= 1:
+            mqtt.publish(pubTopic,payloadStr,contentType=contentType)
+            return
 
+        # a batch holds a single topic, the next flight starts a new one
+        if pubTopic != self.pendingTopic:
+            self.flushMqtt(mqtt,True)
+        if len(self.pending) == 0:
+            self.pendingSince = monotonic()
+        self.pending.append(toSend)
+        self.pendingFull.append(payload)
+        self.pendingTopic = pubTopic
+        self.pendingContentType = contentType
+        self.flushMqtt(mqtt)
+
+    def flushMqtt(self,mqtt,force:bool=False) :
+        if len(self.pending) == 0:
+            return
+        if not force and len(self.pending) < self.batchSize and monotonic() - self.pendingSince < self.batchDelay:
+            return
 
+        offline = self.isOffline(mqtt)
+        header = {"timestamp": str(datetime.now(timezone.utc)), "count": len(self.pending)}
+        payloadStr = self.fmt.dumps({"header" : header,
+                                     "batch" : self.pendingFull if offline else self.pending
+                                     })
+        if offline:
+            self.store(self.pendingTopic,self.pendingContentType,payloadStr)
+        else:
+            logger.info(f"Publishing {len(self.pending)} samples to {self.pendingTopic}, {len(payloadStr)} bytes")
+            mqtt.publish(self.pendingTopic,payloadStr,contentType=self.pendingContentType)
+        self.pending = []
+        self.pendingFull = []
+
+    def isOffline(self,mqtt) -> bool :
+        return self.spool is not None and not mqtt.isConnected()
+
+    def store(self,topic:str,contentType:str,payload:bytes) -> None :
+        tpc = topic.encode('utf-8')
+        ct = (contentType or "").encode('utf-8')
+        self.spool.append(self.RECORD.pack(len(tpc),len(ct)) + tpc + ct + payload)
+        logger.info(f"Broker unreachable, spooled {len(payload)} bytes for {topic}")
+
+    @classmethod
+    def unpackRecord(cls,rec:bytes) :
+        tlen,clen = cls.RECORD.unpack_from(rec)
+        pos = cls.RECORD.size
+        topic = bytes(rec[pos:pos+tlen]).decode('utf-8')
+        ct = bytes(rec[pos+tlen:pos+tlen+clen]).decode('utf-8') or None
+        return topic,ct,bytes(rec[pos+tlen+clen:])
+
+    @classmethod
+    def regroup(cls,records:list) -> list :
+        # consecutive records of a topic are sent as one batch envelope
+        groups = []
+        for rec in records:
+            topic,ct,payload = cls.unpackRecord(rec)
+            if len(groups) > 0 and groups[-1][0] == topic and groups[-1][1] == ct:
+                groups[-1][2].append(payload)
+            else:
+                groups.append((topic,ct,[payload]))
+
+        out = []
+        for topic,ct,payloads in groups:
+            if len(payloads) == 1:
+                out.append((topic,ct,payloads[0]))
+                continue
+
+            fmt = Codec.formatOf(topic,payloads[0],ct)
+            try:
+                batch = []
+                for payload in payloads:
+                    env = fmt.loads(payload)
+                    batch.extend(env['batch'] if 'batch' in env else (env,))
+            except Codec.DecodeError as de:
+                logger.warning(f"Unreadable spooled records for {topic}, sending them one by one: {de}")
+                out.extend((topic,ct,payload) for payload in payloads)
+                continue
+
+            header = {"timestamp": str(datetime.now(timezone.utc)), "count": len(batch)}
+            out.append((topic,ct,fmt.dumps({"header" : header, "batch" : batch})))
+        return out
+
+    def published(self,info) -> bool :
+        try:
+            info.wait_for_publish(self.PUBLISH_TIMEOUT)
+            return info.is_published()
+        except (RuntimeError,ValueError):
+            return False
+
+    def startDrain(self,mqtt) -> None :
+        if self.spool is None:
+            return
+        msgQ = self.clients["MQTT"][1] if "MQTT" in self.clients else None
+        self.drainThread = Thread(target=self.drainRun,args=(mqtt,msgQ),name="spool-drain",daemon=True)
+        self.drainThread.start()
+
+    def drainRun(self,mqtt,msgQ) -> None :
+        self.startFlag.wait()
+        while not self.stopFlag.is_set():
+            # live samples go first
+            if self.spool.isEmpty() or not mqtt.isConnected() or (msgQ is not None and not msgQ.empty()):
+                self.stopFlag.wait(self.DRAIN_IDLE)
+                continue
+
+            records,pos = self.spool.read(maxRecords=self.drainBatch)
+            if len(records) == 0:
+                self.stopFlag.wait(self.DRAIN_IDLE)
+                continue
+            self.drainLimit.take(len(records))
+
+            # QoS 1, the records leave the spool once the broker has them
+            try:
+                infos = [mqtt.publish(topic,payload,qos=1,contentType=ct) for topic,ct,payload in self.regroup(records)]
+                ok = all(info is not None and self.published(info) for info in infos)
+            except Exception as e:
+                logger.exception(e)
+                ok = False
 
+            if ok:
+                self.spool.ack(pos,len(records))
+                self.drained += len(records)
+                logger.info(f"Forwarded {len(records)} spooled records in {len(infos)} messages, {self.spool.stats()['pendingBytes']} bytes left")
+            else:
+                logger.warning("Forwarding spooled records failed, retrying")
+                self.spool.rewind()
+                self.stopFlag.wait(self.DRAIN_RETRY)
 
-    def clientRun(self,name:str,msgQ:Queue,runFlag:Event,publish:Callable,client) -> None:
+
+
+
+    def clientRun(self,name:str,msgQ:Queue,runFlag:Event,publish:Callable,client,flush:Callable=None) -> None:
         logger.info(f"Client {name} waiting to start")
         self.startFlag.wait()
         logger.info(f"Client {name} started on {msgQ}")
 
+        # wake up often enough to honour the batch delay
+        timeout = 3 if flush is None else min(3,max(self.batchDelay,0.1))
         while runFlag.is_set() :
             try:
-                data = msgQ.get(timeout=3)
+                data = msgQ.get(timeout=timeout)
                 if data is not None:
                     logger.info(f"Client {name} publishing {data['timestamp']}")
                     publish(data,client)
@@ -111,13 +323,22 @@ class AircraftClient(object) :
                 logger.exception(e)
                 pass
 
+            if flush is not None:
+                try:
+                    flush(client)
+                except Exception as e:
+                    logger.exception(e)
+
+        if flush is not None:
+            flush(client,True)
         logger.info(f"Client {name} exiting")
 
     def run(self) :
         self.startFlag.set()
 
         while True:
-            sleep(3)
+            # polled faster during climb and approach, slower in cruise
+            self.api.wait()
             data = self.api.query()
             if (data is not None) :
                 logger.info(f"Received message from MSI {data['timestamp']}")
@@ -151,6 +372,19 @@ class AircraftClient(object) :
             thr.join()
             pass
 
+        logger.info(f"MSI polling: {self.api.stats()}")
+        self.api.close()
+
+        if self.delta is not None:
+            logger.info(f"Delta savings: {self.delta.stats()}")
+
+        if self.spool is not None:
+            self.stopFlag.set()
+            if self.drainThread is not None:
+                self.drainThread.join()
+            logger.info(f"Spool: {self.spool.stats()}, {self.drained} records forwarded")
+            self.spool.close()
+
 def parseCmdLine(args) -> Namespace :
 
     parser = ArgumentParser("Collect and report MSI data to ground")
@@ -186,6 +420,69 @@ def parseCmdLine(args) -> Namespace :
                         default=os.getenv("MQTT_PASSWORD"),
                         help="MQTT Password")
 
+    parser.add_argument("--encoding",
+                        dest="encoding",
+                        choices=("json","msgpack","cbor"),
+                        default="json",
+                        help="Payload encoding, binary formats are smaller")
+
+    parser.add_argument("--content-type",
+                        dest="contentType",
+                        action="store_true",
+                        help="Announce a binary encoding with the MQTT v5 content-type property instead of a topic suffix")
+
+    parser.add_argument("--keyframe-interval",
+                        dest="keyframeInterval",
+                        type=int,
+                        default=0,
+                        help="Delta mode, send a full record every N messages and only the changed fields in between (0 = off)")
+
+    parser.add_argument("--batch-size",
+                        dest="batchSize",
+                        type=int,
+                        default=1,
+                        help="Publish up to N MSI samples in one message (1 = one message per sample)")
+
+    parser.add_argument("--batch-delay",
+                        dest="batchDelay",
+                        type=float,
+                        default=30.0,
+                        help="Maximum time (s) a sample is held back for a batch")
+
+    parser.add_argument("--spool",
+                        dest="spoolDir",
+                        default=None,
+                        help="Store samples in this directory while the broker is unreachable and forward them later")
+
+    parser.add_argument("--spool-max",
+                        dest="spoolMaxMb",
+                        type=int,
+                        default=64,
+                        help="Spool size limit (MB), the oldest samples are dropped past it")
+
+    parser.add_argument("--drain-rate",
+                        dest="drainRate",
+                        type=float,
+                        default=20.0,
+                        help="Spooled records forwarded per second after a reconnect")
+
+    parser.add_argument("--drain-batch",
+                        dest="drainBatch",
+                        type=int,
+                        default=50,
+                        help="Spooled records per forwarding burst")
+
+    parser.add_argument("--compress",
+                        dest="compress",
+                        choices=("zlib","zstd"),
+                        default=None,
+                        help="Compress the payloads with a dictionary shared with the server")
+
+    parser.add_argument("--dict",
+                        dest="dictFile",
+                        default=None,
+                        help="Trained compression dictionary (see common/Compression.py), default the builtin one")
+
     return parser.parse_args(args)
 
 
@@ -216,9 +513,20 @@ if __name__ == "__main__" :
 
 
 
-    svc = AircraftClient(msi=params.msiEndpoint)
-    mqtt = MqttClient(params.mqttBroker, user=params.userName, passwd=params.password, clientID=clientId)
-    svc.addClient("MQTT",svc.publishMqtt,mqtt)
+    svc = AircraftClient(msi=params.msiEndpoint,encoding=params.encoding,contentType=params.contentType,
+                         keyframeInterval=params.keyframeInterval,batchSize=params.batchSize,
+                         batchDelay=params.batchDelay,spoolDir=params.spoolDir,
+                         spoolMaxBytes=params.spoolMaxMb*1024*1024,drainRate=params.drainRate,
+                         drainBatch=params.drainBatch)
+    compressor = None
+    if params.compress is not None:
+        version = BUILTIN_VERSION if params.dictFile is None else loadDictionary(params.dictFile)
+        compressor = Compressor(params.compress,version)
+
+    mqtt = MqttClient(params.mqttBroker, user=params.userName, passwd=params.password, clientID=clientId,
+                      compressor=compressor)
+    svc.addClient("MQTT",svc.publishMqtt,mqtt,svc.flushMqtt)
+    svc.startDrain(mqtt)
 
     if params.kinesisCfg is not None:
         # Start Kinesis Client
@@ -1,22 +1,167 @@
 import json
+import logging
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Callable, Iterable
 
 import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("DeviceScan")
 
 DEV_URL = "https://msi.viasat.com:9100/v1/devices"
-if __name__ == "__main__" :
 
-    for i in range(0,256) :
-        addr = f"172.19.0.{i}"
 
+class DeviceScanner(object) :
+    # Probes the device addresses concurrently through one session whose pool
+    # holds a keep-alive connection per worker.  Results are yielded as they
+    # arrive.  Known devices are kept between sweeps: a quick sweep only
+    # re-probes them, every fullEvery sweeps all the addresses are, and a
+    # device that missed missLimit sweeps in a row is reported lost.
+    CONCURRENCY = 32
+    CONNECT_TIMEOUT = 1.0
+    READ_TIMEOUT = 2.5
+    FULL_EVERY = 10
+    MISS_LIMIT = 3
+
+    def __init__(self,url:str=DEV_URL,addresses:Iterable[str]=None,concurrency:int=CONCURRENCY,
+                 timeout:float=READ_TIMEOUT,fullEvery:int=FULL_EVERY,missLimit:int=MISS_LIMIT) :
+        super().__init__()
+        self.url = url.rstrip("/")
+        self.addresses = list(addresses) if addresses is not None else [f"172.19.0.{i}" for i in range(256)]
+        self.concurrency = concurrency
+        self.timeout = (min(self.CONNECT_TIMEOUT,timeout),timeout)
+        self.fullEvery = fullEvery
+        self.missLimit = missLimit
+
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/json'})
+        self.session.mount(self.url,HTTPAdapter(pool_connections=1,pool_maxsize=concurrency))
+        self.pool = ThreadPoolExecutor(max_workers=concurrency,thread_name_prefix="scan")
+
+        # addr -> {"device" : ..., "lastSeen" : ..., "misses" : ...}
+        self.known = {}
+        self.lock = Lock()
+        self.sweeps = 0
+        self.probes = 0
+        self.errors = 0
+        self.lastSweep = {}
+        self.thread = None
+        self.stopFlag = Event()
+
+    def probe(self,addr:str) -> [dict,None] :
         try:
-            url = f"{DEV_URL}/{addr}"
-            rsp = requests.get(url, timeout=2.5,
-                               headers={'Accept': 'application/json'})
+            rsp = self.session.get(f"{self.url}/{addr}",timeout=self.timeout)
+            if rsp.status_code == 200:
+                return json.loads(rsp.text)
+        except (requests.exceptions.RequestException,ValueError) as e:
+            logger.debug(f"Probe of {addr} failed: {e}")
+            with self.lock:
+                self.errors += 1
+        return None
+
+    def sweep(self,full:bool=None) :
+        # yields (addr, device) as the answers come in, device is None for a
+        # known device that was lost
+        if full is None:
+            full = self.sweeps % self.fullEvery == 0 or len(self.known) == 0
+        self.sweeps += 1
+
+        # known devices first, they're the ones expected to answer
+        targets = list(self.known)
+        if full:
+            targets += [a for a in self.addresses if a not in self.known]
+
+        start = monotonic()
+        found = 0
+        futures = {self.pool.submit(self.probe,addr) : addr for addr in targets}
+        for f in as_completed(futures):
+            addr = futures[f]
+            device = f.result()
+            if device is not None:
+                found += 1
+                self.known[addr] = {"device" : device, "lastSeen" : monotonic(), "misses" : 0}
+                yield addr,device
+                continue
 
-            if rsp.status_code == 200 :
-                res = json.loads(rsp.text)
+            entry = self.known.get(addr)
+            if entry is None:
+                continue
+            entry['misses'] += 1
+            if entry['misses'] >= self.missLimit:
+                logger.info(f"Device {addr} lost after {entry['misses']} sweeps")
+                del self.known[addr]
+                yield addr,None
 
+        self.probes += len(targets)
+        self.lastSweep = {"full" : full,
+                          "probed" : len(targets),
+                          "found" : found,
+                          "known" : len(self.known),
+                          "seconds" : round(monotonic() - start,2)}
+        logger.info(f"Device sweep: {self.lastSweep}")
 
-        except requests.exceptions.RequestException :
-            pass
+    def devices(self) -> dict :
+        return {addr : entry['device'] for addr,entry in list(self.known.items())}
+
+    def start(self,onDevice:Callable,interval:float=60.0) -> None :
+        # sweeps in the background, onDevice(addr,device) is called for every
+        # answer, e.g. to put it on the aircraft client queues
+        self.thread = Thread(target=self.run,args=(onDevice,interval),name="device-scan",daemon=True)
+        self.thread.start()
+
+    def run(self,onDevice:Callable,interval:float) -> None :
+        while not self.stopFlag.is_set():
+            started = monotonic()
+            for addr,device in self.sweep():
+                try:
+                    onDevice(addr,device)
+                except Exception as e:
+                    logger.exception(e)
+                if self.stopFlag.is_set():
+                    break
+            self.stopFlag.wait(max(0.0,interval - (monotonic() - started)))
+
+    def stats(self) -> dict :
+        return {"sweeps" : self.sweeps,
+                "probes" : self.probes,
+                "errors" : self.errors,
+                "known" : len(self.known),
+                "lastSweep" : self.lastSweep}
+
+    def close(self) -> None :
+        self.stopFlag.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.pool.shutdown(wait=True,cancel_futures=True)
+        self.session.close()
+
+
+def parseCmdLine(args) :
+    parser = ArgumentParser("Scan the aircraft network for devices")
+    parser.add_argument("-e","--endpoint",dest="url",default=DEV_URL,help="Device API endpoint")
+    parser.add_argument("-n","--network",default="172.19.0",help="First three octets of the addresses")
+    parser.add_argument("-c","--concurrency",type=int,default=DeviceScanner.CONCURRENCY,
+                        help="Probes in flight")
+    parser.add_argument("-t","--timeout",type=float,default=DeviceScanner.READ_TIMEOUT,
+                        help="Probe timeout (s)")
+    parser.add_argument("-s","--sweeps",type=int,default=1,help="Number of sweeps")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__" :
+    logging.basicConfig(level=logging.INFO)
+    params = parseCmdLine(sys.argv[1:])
 
+    scanner = DeviceScanner(params.url,[f"{params.network}.{i}" for i in range(256)],
+                            params.concurrency,params.timeout)
+    try:
+        for i in range(params.sweeps):
+            for addr,device in scanner.sweep(full=(i == 0) or None):
+                print(addr,"lost" if device is None else device)
+    finally:
+        print(scanner.stats())
+        scanner.close()
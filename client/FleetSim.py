@@ -0,0 +1,445 @@
+import logging
+import os
+import sys
+from argparse import ArgumentParser, Namespace
+from datetime import datetime, timedelta, timezone
+from threading import Event
+from time import monotonic, sleep
+
+import numpy as np
+
+from common import Codec
+from common.MqttClient import MqttClient
+from DssSim import DssSimulator
+from SeatMatrix import FIELDS
+
+logger = logging.getLogger("FleetSim")
+
+# Load test fleet.  Every aircraft flies great-circle legs between the
+# airports below: gate, taxi, takeoff, climb, cruise, descent, approach,
+# landing, taxi and a turnaround, then the next leg from where it landed.
+# Positions, phases and the seat states of the whole fleet are numpy arrays
+# updated in one go, the MSI and DSS records are published as AircraftClient
+# and IfeDssClient do, on Delta/<tail>/<flight>/MSI and .../DSS.
+
+AIRPORTS = (("KATL",33.6367,-84.4281),("KDTW",42.2124,-83.3534),("KMSP",44.8820,-93.2218),
+            ("KSLC",40.7884,-111.9778),("KJFK",40.6398,-73.7789),("KLGA",40.7772,-73.8726),
+            ("KBOS",42.3643,-71.0052),("KLAX",33.9425,-118.4081),("KSEA",47.4490,-122.3093),
+            ("KCVG",39.0488,-84.6678),("KMCO",28.4294,-81.3090),("KAUS",30.1945,-97.6699),
+            ("KRDU",35.8776,-78.7875),("KSFO",37.6190,-122.3749),("EGLL",51.4706,-0.4619),
+            ("LFPG",49.0097,2.5479),("EHAM",52.3086,4.7639),("RJTT",35.5523,139.7798))
+
+EARTH_NM = 3440.065
+
+GATE,TAXI_OUT,TAKEOFF,CLIMB,CRUISE,DESCENT,APPROACH,LANDING,TAXI_IN = range(9)
+PHASES = ("Gate","Taxi Out","Takeoff","Climb","Cruise","Descent","Approach","Landing","Taxi In")
+# ground speed (kt) per phase
+SPEEDS = np.array([0,15,150,300,470,380,180,140,15],dtype=np.float64)
+
+CRUISE_ALT = 35000
+TAKEOFF_NM = 5
+CLIMB_NM = 150
+DESCENT_NM = 120
+APPROACH_NM = 30
+LANDING_NM = 3
+TAXI_S = 600
+TURNAROUND_S = 2700
+
+# seat flags: share of seats with the flag set in the long run, and the
+# chance a seat's flag is redrawn at each snapshot
+FLAG_SHARE = {"DSS_COMM_LOSS" : 0.05, "TM_SYNC" : 0.9, "TV_SVC_AVL" : 0.9, "VLS" : 0.2, "PA" : 0.0,
+              "PCTL_LOCK" : 0.05, "STOWD" : 0.1, "LOGIN_AVL" : 0.95, "LOGD_IN" : 0.4, "KID" : 0.05,
+              "CONTENT_AVL" : 0.95}
+FLAG_RATE = 0.1
+UI_RATE = 0.15
+UI_STATES = list(dict.fromkeys(["Home/Landing Page"] + DssSimulator.UI_VALUES))
+
+
+def toVector(lat,lon) -> np.ndarray :
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon),np.cos(lat) * np.sin(lon),np.sin(lat)],axis=-1)
+
+
+class FleetSimulator(object) :
+    def __init__(self,aircraft:int=1000,seats:int=190,tailPrefix:str="SIM",seed:int=None) :
+        self.rng = np.random.default_rng(seed)
+        rng = self.rng
+        n = aircraft
+        self.count = n
+        self.seats = seats
+
+        self.codes = [a[0] for a in AIRPORTS]
+        self.airports = toVector([a[1] for a in AIRPORTS],[a[2] for a in AIRPORTS])
+        # airport x airport great-circle distances (nm)
+        cos = np.clip(self.airports @ self.airports.T,-1.0,1.0)
+        self.distances = np.arccos(cos) * EARTH_NM
+
+        self.tails = [f"{tailPrefix}{i+1:05d}" for i in range(n)]
+        self.noseIds = [f"{i+1:06d}" for i in range(n)]
+
+        self.origin = rng.integers(0,len(AIRPORTS),n)
+        self.dest = self.pickDestinations(self.origin)
+        self.flightNum = rng.integers(100,10_000,n)
+        self.departed = np.full(n,np.datetime64(datetime.now(timezone.utc).replace(tzinfo=None),"s"))
+
+        # spread the fleet over the whole cycle: some at the gate, most en route
+        self.flown = self.distances[self.origin,self.dest] * rng.uniform(0,1,n)
+        self.ground = np.where(rng.random(n) < 0.2,rng.uniform(0,TURNAROUND_S + 2*TAXI_S,n),0.0)
+        self.airborne = self.ground <= 0
+        self.flown[~self.airborne] = 0.0
+        self.departed -= (self.flown / SPEEDS[CRUISE] * 3600).astype("timedelta64[s]")
+        self.phase = np.zeros(n,dtype=np.int8)
+        self.position = np.zeros((n,3))
+        self.heading = np.zeros(n)
+        self.grossWeight = rng.uniform(400,600,n)
+        self.paState = np.zeros(n,dtype=bool)
+        self.windSpeed = rng.uniform(20,150,n)
+        self.windDirection = rng.uniform(0,360,n)
+
+        # cabin: aircraft x seat x flag and aircraft x seat UI screen codes
+        share = np.array([FLAG_SHARE.get(f,0.1) for f in FIELDS])
+        self.flagShare = share
+        self.cabin = (rng.random((n,seats,len(FIELDS))) < share).astype(np.uint8)
+        self.ui = rng.integers(0,len(UI_STATES),(n,seats)).astype(np.int16)
+        self.ui[rng.random((n,seats)) < 0.7] = 0
+
+        self.step(0.0)
+
+    def pickDestinations(self,origin:np.ndarray) -> np.ndarray :
+        dest = self.rng.integers(0,len(AIRPORTS) - 1,len(origin))
+        return dest + (dest >= origin)
+
+    def step(self,dt:float) -> None :
+        # advance the fleet by dt simulated seconds
+        n = self.count
+        total = self.distances[self.origin,self.dest]
+
+        # on the ground: taxi in, turnaround at the gate, taxi out
+        onGround = ~self.airborne
+        self.ground[onGround] -= dt
+        departing = onGround & (self.ground <= 0)
+        if departing.any():
+            self.airborne[departing] = True
+            self.flown[departing] = 0.0
+            self.departed[departing] = np.datetime64(datetime.now(timezone.utc).replace(tzinfo=None),"s")
+            self.grossWeight[departing] = self.rng.uniform(400,600,departing.sum())
+
+        air = self.airborne
+        self.flown[air] += SPEEDS[self.phase[air]].clip(min=SPEEDS[TAKEOFF]) * dt / 3600
+        toGo = np.maximum(total - self.flown,0.0)
+
+        landed = air & (toGo <= 0)
+        if landed.any():
+            idx = np.flatnonzero(landed)
+            self.airborne[idx] = False
+            self.ground[idx] = TURNAROUND_S + 2*TAXI_S
+            self.origin[idx] = self.dest[idx]
+            self.dest[idx] = self.pickDestinations(self.origin[idx])
+            self.flightNum[idx] = self.rng.integers(100,10_000,len(idx))
+            self.flown[idx] = 0.0
+            total = self.distances[self.origin,self.dest]
+            toGo = np.maximum(total - self.flown,0.0)
+        air = self.airborne
+
+        # short legs climb and descend over half the route
+        climb = np.minimum(CLIMB_NM,total / 2)
+        descent = np.minimum(DESCENT_NM,total / 2)
+        phase = np.full(n,CRUISE,dtype=np.int8)
+        phase[self.flown < climb] = CLIMB
+        phase[self.flown < TAKEOFF_NM] = TAKEOFF
+        phase[toGo < descent] = DESCENT
+        phase[toGo < APPROACH_NM] = APPROACH
+        phase[toGo < LANDING_NM] = LANDING
+        phase[~air & (self.ground > TURNAROUND_S + TAXI_S)] = TAXI_IN
+        phase[~air & (self.ground <= TURNAROUND_S + TAXI_S)] = GATE
+        phase[~air & (self.ground <= TAXI_S)] = TAXI_OUT
+        self.phase = phase
+
+        # slerp along the great circle, the heading is the initial course
+        # from here to the destination
+        a = self.airports[self.origin]
+        b = self.airports[self.dest]
+        delta = np.maximum(total / EARTH_NM,1e-9)
+        f = np.where(air,self.flown / np.maximum(total,1e-9),0.0)
+        pos = (np.sin((1 - f) * delta)[:,None] * a + np.sin(f * delta)[:,None] * b) / np.sin(delta)[:,None]
+        self.position = pos
+
+        lat = np.arcsin(np.clip(pos[:,2],-1,1))
+        lon = np.arctan2(pos[:,1],pos[:,0])
+        lat2 = np.arcsin(b[:,2])
+        lon2 = np.arctan2(b[:,1],b[:,0])
+        dlon = lon2 - lon
+        self.heading = (np.degrees(np.arctan2(np.sin(dlon) * np.cos(lat2),
+                                              np.cos(lat) * np.sin(lat2) - np.sin(lat) * np.cos(lat2) * np.cos(dlon)))
+                        + 360) % 360
+        self.lat = np.degrees(lat)
+        self.lon = np.degrees(lon)
+        self.toGo = toGo
+
+        # the fuel burns off, the cabin crew now and then
+        self.grossWeight[air] -= dt * 0.002
+        self.paState = np.where(self.rng.random(n) < dt / 600,~self.paState,self.paState)
+        self.paState[self.paState & (self.rng.random(n) < dt / 60)] = False
+
+    def altitude(self) -> np.ndarray :
+        total = self.distances[self.origin,self.dest]
+        climb = np.minimum(CLIMB_NM,total / 2)
+        descent = np.minimum(DESCENT_NM,total / 2)
+        alt = CRUISE_ALT * np.minimum(np.minimum(self.flown / climb,self.toGo / descent),1.0)
+        return np.where(self.airborne,alt,0.0)
+
+    def msiRecords(self,idx:np.ndarray,now:datetime) -> list :
+        # -> [(topic, record)] for the aircraft in idx
+        ts = now.strftime("%Y-%m-%dT%H:%M:%SZ")
+        alt = self.altitude()[idx]
+        speed = SPEEDS[self.phase[idx]]
+        timeToGo = np.where(self.airborne[idx],self.toGo[idx] / np.maximum(speed,1) * 60,0)
+        eta = [(now + timedelta(minutes=m)).strftime("%H:%M") for m in timeToGo.tolist()]
+        duration = (np.datetime64(now.replace(tzinfo=None),"s") - self.departed[idx]).astype(np.int64) // 60
+
+        records = []
+        for (i,lat,lon,a,spd,hdg,dist,ttg,gw,ws,wd,pa,dur,e) in zip(
+                idx.tolist(),self.lat[idx].round(6).tolist(),self.lon[idx].round(6).tolist(),
+                alt.round(-1).astype(int).tolist(),speed.astype(int).tolist(),self.heading[idx].round().astype(int).tolist(),
+                self.toGo[idx].round().astype(int).tolist(),timeToGo.round().astype(int).tolist(),
+                self.grossWeight[idx].round().astype(int).tolist(),self.windSpeed[idx].round().astype(int).tolist(),
+                self.windDirection[idx].round().tolist(),self.paState[idx].tolist(),duration.tolist(),eta):
+            phase = self.phase[i]
+            onGround = phase in (GATE,TAXI_OUT,TAXI_IN)
+            flight = f"DAL{self.flightNum[i]}"
+            origin = self.codes[self.origin[i]]
+            dest = self.codes[self.dest[i]]
+            records.append((f"Delta/{self.tails[i]}/{flight}/MSI",
+                            {"timestamp" : ts, "eta" : e, "flightDuration" : dur if not onGround else 0,
+                             "flightNumber" : flight, "latitude" : lat, "longitude" : lon,
+                             "noseId" : self.noseIds[i], "paState" : pa, "vehicleId" : self.tails[i],
+                             "destination" : dest, "origin" : origin,
+                             "flightId" : f"{self.tails[i]}_{origin}{dest}_{str(self.departed[i]).replace('-','').replace(':','').replace('T','')}",
+                             "airspeed" : spd, "airTemperature" : round(15 - 2 * a / 1000),
+                             "altitude" : a, "distanceToGo" : dist, "doorState" : "Open" if phase == GATE else "Closed",
+                             "groundspeed" : spd, "heading" : hdg, "timeToGo" : ttg,
+                             "wheelWeightState" : "On" if onGround else "Off", "grossWeight" : gw,
+                             "windSpeed" : ws, "windDirection" : wd, "flightPhase" : PHASES[phase]}))
+        return records
+
+    def updateCabins(self,idx:np.ndarray) -> None :
+        # a redrawn flag is set with its long run share, so the cabin stays
+        # around FLAG_SHARE; PA follows the aircraft's PA state
+        rng = self.rng
+        shape = (len(idx),self.seats,len(FIELDS))
+        cabin = self.cabin[idx]
+        redraw = rng.random(shape) < FLAG_RATE
+        cabin[redraw] = (rng.random(shape) < self.flagShare)[redraw]
+        cabin[:,:,FIELDS.index("PA")] = self.paState[idx][:,None]
+        self.cabin[idx] = cabin
+
+        ui = self.ui[idx]
+        moved = rng.random(ui.shape) < UI_RATE
+        ui[moved] = rng.integers(0,len(UI_STATES),moved.sum())
+        self.ui[idx] = ui
+
+    def dssRecords(self,idx:np.ndarray,now:datetime) -> list :
+        # the cabin wide counters IfeDssClient publishes
+        self.updateCabins(idx)
+        counts = self.cabin[idx].sum(axis=1,dtype=np.int32)
+        codes = self.ui[idx].astype(np.int64) + np.arange(len(idx))[:,None] * len(UI_STATES)
+        hist = np.bincount(codes.ravel(),minlength=len(idx) * len(UI_STATES)).reshape(len(idx),len(UI_STATES))
+
+        ts = str(now)
+        records = []
+        for i,c,h in zip(idx.tolist(),counts.tolist(),hist.tolist()):
+            rec = {f : v for f,v in zip(FIELDS,c) if v > 0}
+            rec.update({f"UI_{s}" : v for s,v in zip(UI_STATES,h) if v > 0})
+            rec['timestamp'] = ts
+            records.append((f"Delta/{self.tails[i]}/DAL{self.flightNum[i]}/DSS",rec))
+        return records
+
+
+
+class FleetPublisher(object) :
+    # Publishes the fleet's records every msiInterval / dssInterval seconds
+    # per aircraft, staggered so the load is even.  The simulation runs
+    # timeScale times faster than the clock, one step per TICK.  When the
+    # broker connection can't keep up the schedule slips rather than bursting.
+    TICK = 0.1
+    REPORT_EVERY = 10
+
+    def __init__(self,sim:FleetSimulator,clients:list,encoding:str="json",msiInterval:float=3.0,
+                 dssInterval:float=15.0,timeScale:float=1.0) :
+        self.sim = sim
+        self.clients = clients
+        self.fmt = Codec.getFormat(encoding)
+        self.msiInterval = msiInterval
+        self.dssInterval = dssInterval
+        self.timeScale = timeScale
+        self.stopFlag = Event()
+
+        now = monotonic()
+        self.nextMsi = now + sim.rng.uniform(0,msiInterval,sim.count)
+        self.nextDss = now + sim.rng.uniform(0,dssInterval,sim.count) if dssInterval > 0 else None
+
+        self.published = {"MSI" : 0, "DSS" : 0}
+        self.bytes = 0
+        self.publishTime = 0.0
+        self.buildTime = 0.0
+
+    def targetRate(self) -> float :
+        rate = self.sim.count / self.msiInterval
+        if self.nextDss is not None:
+            rate += self.sim.count / self.dssInterval
+        return rate
+
+    def publish(self,kind:str,records:list) -> None :
+        fmt = self.fmt
+        clients = self.clients
+        start = monotonic()
+        header = {"timestamp" : str(datetime.now(timezone.utc))}
+        for i,(topic,rec) in enumerate(records):
+            payload = fmt.dumps({"header" : header, "data" : rec})
+            if fmt.name != "json":
+                topic = f"{topic}/{fmt.name}"
+            self.bytes += len(payload)
+            if clients:
+                clients[i % len(clients)].publish(topic,payload)
+        self.publishTime += monotonic() - start
+        self.published[kind] += len(records)
+
+    def due(self,schedule:np.ndarray,interval:float,now:float) -> np.ndarray :
+        idx = np.flatnonzero(schedule <= now)
+        schedule[idx] = np.maximum(schedule[idx] + interval,now)
+        return idx
+
+    def run(self,duration:float=None) -> dict :
+        start = last = lastReport = monotonic()
+        logger.info(f"Fleet of {self.sim.count} aircraft, target {self.targetRate():.0f} msg/s")
+        while not self.stopFlag.is_set():
+            now = monotonic()
+            if duration is not None and now - start >= duration:
+                break
+
+            t = monotonic()
+            self.sim.step((now - last) * self.timeScale)
+            last = now
+            wall = datetime.now(timezone.utc)
+            idx = self.due(self.nextMsi,self.msiInterval,now)
+            msi = self.sim.msiRecords(idx,wall) if len(idx) > 0 else []
+            dss = []
+            if self.nextDss is not None:
+                idx = self.due(self.nextDss,self.dssInterval,now)
+                dss = self.sim.dssRecords(idx,wall) if len(idx) > 0 else []
+            self.buildTime += monotonic() - t
+
+            self.publish("MSI",msi)
+            self.publish("DSS",dss)
+
+            if now - lastReport >= self.REPORT_EVERY:
+                lastReport = now
+                logger.info(f"Fleet publishing: {self.stats(now - start)}")
+
+            # the aircraft due within a tick go out together
+            sleep(max(0.0,self.TICK - (monotonic() - now)))
+
+        return self.stats(monotonic() - start)
+
+    def stats(self,elapsed:float) -> dict :
+        total = sum(self.published.values())
+        return {"aircraft" : self.sim.count,
+                "published" : dict(self.published),
+                "seconds" : round(elapsed,1),
+                "rate" : round(total / max(elapsed,1e-9)),
+                "target" : round(self.targetRate()),
+                "bytesAvg" : round(self.bytes / max(total,1)),
+                "buildUs" : round(self.buildTime / max(total,1) * 1e6,1),
+                "publishUs" : round(self.publishTime / max(total,1) * 1e6,1),
+                "phases" : {PHASES[p] : int(n) for p,n in enumerate(np.bincount(self.sim.phase,minlength=len(PHASES)))}}
+
+
+def parseCmdLine(args) -> Namespace :
+    parser = ArgumentParser("Simulate a fleet of aircraft publishing MSI and DSS data")
+
+    parser.add_argument("-b","--mqtt-broker",
+                        dest="mqttBroker",
+                        default=os.getenv("MQTT_URL","localhost"),
+                        help="MQTT Broker URL, none to only generate the records")
+    parser.add_argument("--port",
+                        type=int,
+                        default=1883,
+                        help="MQTT Broker port")
+    parser.add_argument("-u","--user",
+                        dest="userName",
+                        default=os.getenv("MQTT_USER"),
+                        help="MQTT User Name")
+    parser.add_argument("-p","--password",
+                        dest="password",
+                        default=os.getenv("MQTT_PASSWORD"),
+                        help="MQTT Password")
+    parser.add_argument("-n","--aircraft",
+                        type=int,
+                        default=1000,
+                        help="Fleet size")
+    parser.add_argument("--seats",
+                        type=int,
+                        default=190,
+                        help="Seats per aircraft")
+    parser.add_argument("--msi-interval",
+                        dest="msiInterval",
+                        type=float,
+                        default=3.0,
+                        help="MSI records per aircraft every N seconds")
+    parser.add_argument("--dss-interval",
+                        dest="dssInterval",
+                        type=float,
+                        default=15.0,
+                        help="DSS records per aircraft every N seconds (0 = no DSS)")
+    parser.add_argument("--time-scale",
+                        dest="timeScale",
+                        type=float,
+                        default=1.0,
+                        help="Simulated seconds per second, e.g. 60 to fly the legs in minutes")
+    parser.add_argument("--connections",
+                        type=int,
+                        default=1,
+                        help="MQTT connections to spread the fleet over")
+    parser.add_argument("--encoding",
+                        choices=("json","msgpack","cbor"),
+                        default="json",
+                        help="Payload encoding")
+    parser.add_argument("--tail-prefix",
+                        dest="tailPrefix",
+                        default="SIM",
+                        help="Simulated tail numbers are <prefix>00001...")
+    parser.add_argument("-d","--duration",
+                        type=float,
+                        default=None,
+                        help="Run for N seconds")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=None,
+                        help="Random seed")
+
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__" :
+    logging.basicConfig(level=logging.INFO)
+    params = parseCmdLine(sys.argv[1:])
+
+    sim = FleetSimulator(params.aircraft,params.seats,params.tailPrefix,params.seed)
+
+    clients = []
+    if params.mqttBroker.lower() != "none":
+        for i in range(params.connections):
+            mqtt = MqttClient(params.mqttBroker,params.port,user=params.userName,passwd=params.password,
+                              clientID=f"FleetSim-{os.getpid()}-{i}")
+            mqtt.run()
+            clients.append(mqtt)
+
+    pub = FleetPublisher(sim,clients,params.encoding,params.msiInterval,params.dssInterval,params.timeScale)
+    try:
+        print(pub.run(params.duration))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for mqtt in clients:
+            mqtt.terminate()
@@ -14,8 +14,11 @@ from typing import Callable
 import requests
 
 from client.ViasatMSI import ViasatMSI
+from common import Codec
+from common.Compression import BUILTIN_VERSION, Compressor, loadDictionary
 from common.MqttClient import MqttClient
 from DssSim import DssSimulator
+from SeatMatrix import ROW_RANGE, ZONES, SeatMatrix, SeatTracker, parseZones
 logger = logging.getLogger()
 
 
@@ -25,9 +28,27 @@ class IfeDssClient(object) :
     def __init__(self,
                  qoeUrl="https://smartife-local-api.delta.com:50802/qoe/snapshot",
                  msiApi="https://msi.viasat.com:9100/v1/flight",
-                 msiUpdateRateSec: int = 60) :
+                 msiUpdateRateSec: int = 60,
+                 encoding:str = "json",
+                 contentType:bool = False,
+                 zones = ZONES,
+                 rowRange:int = ROW_RANGE,
+                 checkpointInterval:int = 0,
+                 pollInterval:float = 15) :
         super().__init__()
 
+        self.fmt = Codec.getFormat(encoding)
+        self.useContentType = contentType
+
+        # the snapshots are aggregated cabin wide, per zone and per row range
+        self.seats = SeatMatrix(zones,rowRange)
+
+        # transition mode: the seats and flags that changed since the last
+        # snapshot go with the counters, the whole cabin state every
+        # checkpointInterval snapshots, nothing when no seat changed
+        self.tracker = SeatTracker(self.seats,checkpointInterval) if checkpointInterval > 0 else None
+        self.pollInterval = pollInterval
+
         self.qoeUrl = qoeUrl
         self.msiUrl = msiApi
         self.msiUpdateRate = timedelta(seconds=msiUpdateRateSec)
@@ -37,6 +58,7 @@ class IfeDssClient(object) :
         self.clients = {}
 
         self.msiUrl = "http://192.168.1.129:9100/v1/flight"
+        self.msi = ViasatMSI(self.msiUrl)
 
 
     def addClient(self,name:str,func:Callable,client) :
@@ -66,31 +88,34 @@ class IfeDssClient(object) :
                    "data" : dataToSend
                    }
 
-        payloadStr = json.dumps(payload)
+        payloadStr = self.fmt.dumps(payload)
+
+        # binary formats are announced with the content-type property or a
+        # topic suffix, the server also recognizes them by the first byte
+        pubTopic = self.topic
+        contentType = None
+        if self.fmt.name != "json":
+            if self.useContentType:
+                contentType = self.fmt.contentType
+            else:
+                pubTopic = f"{self.topic}/{self.fmt.name}"
+        logText = payloadStr if self.fmt.name == "json" else Codec.dumps(payload)
 
 
         logger.info(f"Publishing to {self.topic}, timestamp: {data['timestamp']}")
-        logger.info(f"TOPIC:[{self.topic}] PAYLOAD:[{payloadStr}]")
-        mqtt.publish(self.topic,payloadStr)
+        logger.info(f"TOPIC:[{self.topic}] PAYLOAD:[{logText.decode('utf-8')}]")
+        mqtt.publish(pubTopic,payloadStr,contentType=contentType)
 
 
     def preProcess(self,data:dict) -> [dict,None]:
-        pub = {}
-        dss = {}
-        seats = data['Seats']
-        for s in seats:
-            for fld in seats[s]:
-                if fld == "UI":
-                    fld = f"UI_{seats[s][fld]}"
-                    val = 1
-                else:
-                    val = seats[s][fld]
+        self.seats.load(data['Seats'])
+        pub = self.seats.aggregate(zones=len(self.seats.zones) > 0,rowRanges=self.seats.rowRange > 0)
 
-                if (val == 1) :
-                    try:
-                        pub[fld] += 1
-                    except KeyError:
-                        pub[fld] = 1
+        if self.tracker is not None:
+            seats = self.tracker.update()
+            if seats is None:
+                return None
+            pub.update(seats)
 
         if len(pub) > 0:
             pub['timestamp'] =  str(data['timestamp'])
@@ -157,9 +182,9 @@ class IfeDssClient(object) :
         while True:
             timeSinceLastUpdate = datetime.now() - self.lastUpdate
             if timeSinceLastUpdate > (3 * self.msiUpdateRate):
-                msiQry = ViasatMSI(self.msiUrl)
                 try:
-                    rsp = msiQry.query()
+                    # an unchanged sample is still the current flight
+                    rsp = self.msi.query() or self.msi.last
 
                     if rsp is not None:
                         self.tailNum = rsp['vehicleId']
@@ -184,7 +209,7 @@ class IfeDssClient(object) :
                     logger.info(f"Publishing to {k} on {q}")
                     q.put(data)
 
-            sleep(15)
+            sleep(self.pollInterval)
 
 
 
@@ -199,6 +224,10 @@ class IfeDssClient(object) :
             thr.join()
             pass
 
+        self.msi.close()
+        if self.tracker is not None:
+            logger.info(f"Seat transitions: {self.tracker.stats()}")
+
 def parseCmdLine(args) -> Namespace :
 
     parser = ArgumentParser("Collect and report DSS data to ground")
@@ -230,6 +259,52 @@ def parseCmdLine(args) -> Namespace :
                         default=os.getenv("MQTT_PASSWORD"),
                         help="MQTT Password")
 
+    parser.add_argument("--encoding",
+                        dest="encoding",
+                        choices=("json","msgpack","cbor"),
+                        default="json",
+                        help="Payload encoding, binary formats are smaller")
+
+    parser.add_argument("--content-type",
+                        dest="contentType",
+                        action="store_true",
+                        help="Announce a binary encoding with the MQTT v5 content-type property instead of a topic suffix")
+
+    parser.add_argument("--compress",
+                        dest="compress",
+                        choices=("zlib","zstd"),
+                        default=None,
+                        help="Compress the payloads with a dictionary shared with the server")
+
+    parser.add_argument("--dict",
+                        dest="dictFile",
+                        default=None,
+                        help="Trained compression dictionary (see common/Compression.py), default the builtin one")
+
+    parser.add_argument("--zones",
+                        dest="zones",
+                        type=parseZones,
+                        default=ZONES,
+                        help="Cabin zones to aggregate the seats by, e.g. First:1-9,Comfort:10-19,Main:20-99")
+
+    parser.add_argument("--row-range",
+                        dest="rowRange",
+                        type=int,
+                        default=ROW_RANGE,
+                        help="Also aggregate the seats by ranges of N rows (0 = off)")
+
+    parser.add_argument("--checkpoint-interval",
+                        dest="checkpointInterval",
+                        type=int,
+                        default=0,
+                        help="Publish seat level transitions, with the full seat state every N snapshots (0 = counters only)")
+
+    parser.add_argument("--poll",
+                        dest="pollInterval",
+                        type=float,
+                        default=15,
+                        help="Snapshot interval (s), transitions make shorter ones affordable")
+
     return parser.parse_args(args)
 
 
@@ -279,10 +354,18 @@ if __name__ == "__main__" :
 
 
 
-    svc = IfeDssClient(params.endpoint)
+    svc = IfeDssClient(params.endpoint,encoding=params.encoding,contentType=params.contentType,
+                       zones=params.zones,rowRange=params.rowRange,
+                       checkpointInterval=params.checkpointInterval,pollInterval=params.pollInterval)
     svc.sim = DssSimulator()
 
-    mqtt = MqttClient(params.mqttBroker, user=params.userName, passwd=params.password, clientID=clientId)
+    compressor = None
+    if params.compress is not None:
+        version = BUILTIN_VERSION if params.dictFile is None else loadDictionary(params.dictFile)
+        compressor = Compressor(params.compress,version)
+
+    mqtt = MqttClient(params.mqttBroker, user=params.userName, passwd=params.password, clientID=clientId,
+                      compressor=compressor)
     svc.addClient("MQTT",svc.publishMqtt,mqtt)
 
 
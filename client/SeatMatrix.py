@@ -0,0 +1,312 @@
+import logging
+import re
+import sys
+from base64 import b64encode
+from itertools import chain
+from operator import itemgetter
+from time import perf_counter
+from typing import List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("SeatMatrix")
+
+# DSS seat snapshot as a seat x field matrix.  The columns are the seat
+# state flags in a fixed order (flags the IFE adds later are appended) and
+# the UI screen is a code into a vocabulary of the screens seen so far, so
+# every aggregation is a reduction over numpy arrays.
+
+FIELDS = ("DSS_COMM_LOSS","TM_SYNC","TV_SVC_AVL","VLS","PA","PCTL_LOCK","STOWD","LOGIN_AVL",
+          "LOGD_IN","KID","CONTENT_AVL")
+UI = "UI"
+
+# cabin zones by row, (name, first row, last row)
+ZONES = (("First",1,9),("Comfort",10,19),("Main",20,99))
+ROW_RANGE = 10
+
+SEAT = re.compile(r"(\d+)([A-Za-z]*)")
+
+
+def parseZones(spec:str) -> Tuple[Tuple[str,int,int],...] :
+    # "First:1-9,Comfort:10-19,Main:20-99"
+    zones = []
+    for item in filter(None,spec.split(",")):
+        name,rows = item.split(":")
+        first,last = rows.split("-")
+        zones.append((name.strip(),int(first),int(last)))
+    return tuple(zones)
+
+
+class SeatMatrix(object) :
+    def __init__(self,zones=ZONES,rowRange:int=ROW_RANGE) :
+        self.zones = tuple(zones)
+        self.rowRange = rowRange
+        self.fields = list(FIELDS)
+        self.column = {f : i for i,f in enumerate(self.fields)}
+        self.uiStates = []
+        self.uiCode = {}
+
+        # per layout: the seat ids, their rows and the zone/row range
+        # one-hot matrices, rebuilt only when the seat list changes
+        self.seatIds = None
+        self.rows = None
+        self.zoneMap = None
+        self.rangeNames = []
+        self.rangeMap = None
+        self.getter = itemgetter(*self.fields)
+
+        self.matrix = np.zeros((0,len(self.fields)),dtype=np.uint8)
+        self.ui = np.zeros(0,dtype=np.int32)
+
+    def layout(self,seatIds:List[str]) -> None :
+        self.seatIds = seatIds
+        rows = np.zeros(len(seatIds),dtype=np.int32)
+        for i,s in enumerate(seatIds):
+            m = SEAT.match(s)
+            if m is not None:
+                rows[i] = int(m.group(1))
+        self.rows = rows
+
+        self.zoneMap = np.zeros((len(self.zones),len(seatIds)),dtype=np.int32)
+        for z,(name,first,last) in enumerate(self.zones):
+            self.zoneMap[z] = (rows >= first) & (rows <= last)
+
+        ranges = np.where(rows > 0,(rows - 1) // max(self.rowRange,1),-1)
+        count = int(ranges.max()) + 1 if len(ranges) > 0 and self.rowRange > 0 else 0
+        self.rangeNames = [f"Row{r*self.rowRange+1}-{(r+1)*self.rowRange}" for r in range(count)]
+        self.rangeMap = (ranges[None,:] == np.arange(count)[:,None]).astype(np.int32)
+        logger.info(f"Seat layout: {len(seatIds)} seats, rows {rows.min() if len(rows) else 0}-{rows.max() if len(rows) else 0}")
+
+    def addField(self,fld:str) -> None :
+        self.column[fld] = len(self.fields)
+        self.fields.append(fld)
+        self.getter = itemgetter(*self.fields)
+        logger.info(f"New seat field {fld}")
+
+    def uiIndex(self,state) -> int :
+        code = self.uiCode.get(state)
+        if code is None:
+            code = self.uiCode[state] = len(self.uiStates)
+            self.uiStates.append(state)
+        return code
+
+    def load(self,seats:dict) -> None :
+        seatIds = list(seats)
+        if seatIds != self.seatIds:
+            self.layout(seatIds)
+
+        states = seats.values()
+        width = len(self.fields) + 1
+        try:
+            # all seats carry the flags and UI only, the flags go through bytes()
+            # without a python level loop (ValueError past 0-255)
+            if any(len(s) != width for s in states):
+                raise KeyError
+            flags = bytes(chain.from_iterable(map(self.getter,states)))
+            self.matrix = np.frombuffer(flags,dtype=np.uint8).reshape(len(seatIds),len(self.fields))
+        except (KeyError,TypeError,ValueError):
+            self.matrix = self.loadSlow(states)
+
+        try:
+            self.ui = np.fromiter(map(self.uiCode.__getitem__,map(itemgetter(UI),states)),
+                                  dtype=np.int32,count=len(seatIds))
+        except KeyError:
+            # a screen not seen before, or a seat without one
+            uiIndex = self.uiIndex
+            self.ui = np.fromiter((uiIndex(s[UI]) if UI in s else -1 for s in states),dtype=np.int32,
+                                  count=len(seatIds))
+
+    def loadSlow(self,states) -> np.ndarray :
+        # missing flags are 0, values that aren't flags are ignored
+        for s in states:
+            for fld in s:
+                if fld != UI and fld not in self.column:
+                    self.addField(fld)
+
+        matrix = np.zeros((len(states),len(self.fields)),dtype=np.uint8)
+        for i,s in enumerate(states):
+            for fld,val in s.items():
+                if fld != UI and isinstance(val,(int,bool)) and val == 1:
+                    matrix[i,self.column[fld]] = 1
+        return matrix
+
+    def active(self) -> np.ndarray :
+        return self.matrix == 1
+
+    def counts(self) -> np.ndarray :
+        return self.active().sum(axis=0)
+
+    def zoneCounts(self) -> np.ndarray :
+        # zones x fields
+        return self.zoneMap @ self.active().astype(np.int32)
+
+    def rangeCounts(self) -> np.ndarray :
+        return self.rangeMap @ self.active().astype(np.int32)
+
+    def uiHistogram(self) -> np.ndarray :
+        ui = self.ui[self.ui >= 0]
+        return np.bincount(ui,minlength=len(self.uiStates))
+
+    def aggregate(self,zones:bool=True,rowRanges:bool=True) -> dict :
+        # the cabin wide counters and UI_<screen> counts as before, then
+        # <zone>_<flag> and Row<a>-<b>_<flag>, counts of 0 are left out
+        pub = {}
+        for fld,n in zip(self.fields,self.counts().tolist()):
+            if n > 0:
+                pub[fld] = n
+        for state,n in zip(self.uiStates,self.uiHistogram().tolist()):
+            if n > 0:
+                pub[f"UI_{state}"] = n
+
+        if zones:
+            for (name,first,last),counts in zip(self.zones,self.zoneCounts().tolist()):
+                for fld,n in zip(self.fields,counts):
+                    if n > 0:
+                        pub[f"{name}_{fld}"] = n
+        if rowRanges:
+            for name,counts in zip(self.rangeNames,self.rangeCounts().tolist()):
+                for fld,n in zip(self.fields,counts):
+                    if n > 0:
+                        pub[f"{name}_{fld}"] = n
+        return pub
+
+
+class SeatTracker(object) :
+    # Seat level changes between snapshots.  The previous snapshot is kept as
+    # one bitmap per flag (bit i = seat i, np.packbits order) plus the UI
+    # codes, a new one is XORed against it and only the flips are published:
+    #   "changes": {flag: {"on": [seat,...], "off": [seat,...]}, "UI": {seat: screen}}
+    # Every checkpointInterval snapshots, or when the seats or flags change,
+    # the whole state is published instead:
+    #   "checkpoint": {"ids": [seat,...], "flags": {flag: base64 bitmap},
+    #                  "uiStates": [screen,...], "ui": [code per seat, -1 = none]}
+    CHECKPOINT_INTERVAL = 20
+
+    def __init__(self,matrix:SeatMatrix,checkpointInterval:int=CHECKPOINT_INTERVAL) :
+        self.matrix = matrix
+        self.checkpointInterval = checkpointInterval
+        self.seatIds = None
+        self.fields = None
+        self.bitmaps = None
+        self.ui = None
+        self.sinceCheckpoint = 0
+
+        self.snapshots = 0
+        self.checkpoints = 0
+        self.transitions = 0
+
+    def update(self) -> [dict,None] :
+        # call after matrix.load(), -> the fields to add to the published
+        # record, None when no seat changed
+        m = self.matrix
+        bitmaps = np.packbits(m.active().T,axis=1)
+        ui = m.ui.copy()
+        self.snapshots += 1
+
+        self.sinceCheckpoint += 1
+        if self.bitmaps is None or m.seatIds is not self.seatIds or len(m.fields) != len(self.fields) \
+                or self.sinceCheckpoint >= self.checkpointInterval:
+            self.seatIds = m.seatIds
+            self.fields = list(m.fields)
+            self.bitmaps = bitmaps
+            self.ui = ui
+            self.sinceCheckpoint = 0
+            self.checkpoints += 1
+            return {"checkpoint" : self.checkpoint()}
+
+        changes = {}
+        n = len(self.seatIds)
+        flipped = bitmaps ^ self.bitmaps
+        for f in np.flatnonzero(flipped.any(axis=1)).tolist():
+            seats = np.flatnonzero(np.unpackbits(flipped[f],count=n))
+            now = np.unpackbits(bitmaps[f],count=n)[seats]
+            changes[self.fields[f]] = {"on" : [self.seatIds[i] for i in seats[now == 1].tolist()],
+                                       "off" : [self.seatIds[i] for i in seats[now == 0].tolist()]}
+            self.transitions += len(seats)
+
+        moved = np.flatnonzero(ui != self.ui).tolist()
+        if len(moved) > 0:
+            states = m.uiStates
+            changes[UI] = {self.seatIds[i] : (states[ui[i]] if ui[i] >= 0 else None) for i in moved}
+            self.transitions += len(moved)
+
+        self.bitmaps = bitmaps
+        self.ui = ui
+        return {"changes" : changes} if len(changes) > 0 else None
+
+    def checkpoint(self) -> dict :
+        return {"ids" : list(self.seatIds),
+                "flags" : {fld : b64encode(self.bitmaps[f].tobytes()).decode('ascii')
+                           for f,fld in enumerate(self.fields)},
+                "uiStates" : list(self.matrix.uiStates),
+                "ui" : self.ui.tolist()}
+
+    def stats(self) -> dict :
+        return {"snapshots" : self.snapshots,
+                "checkpoints" : self.checkpoints,
+                "transitions" : self.transitions}
+
+
+
+def preProcessLoop(seats:dict) -> dict :
+    # the per seat, per field loop SeatMatrix replaces
+    pub = {}
+    for s in seats:
+        for fld in seats[s]:
+            if fld == "UI":
+                fld = f"UI_{seats[s][fld]}"
+                val = 1
+            else:
+                val = seats[s][fld]
+            if (val == 1) :
+                try:
+                    pub[fld] += 1
+                except KeyError:
+                    pub[fld] = 1
+    return pub
+
+
+def widebody(sim,rows:int) -> dict :
+    # the simulator's cabin stretched to rows x 10 seats
+    template = list(sim.sample['Seats'].values())
+    seats = {}
+    for r in range(1,rows + 1):
+        for c in "ABCDEFGHJK":
+            seats[f"{r}{c}"] = dict(template[len(seats) % len(template)])
+    return seats
+
+
+def benchmark(rows:int=40,repeat:int=200) -> None :
+    from DssSim import DssSimulator
+
+    sim = DssSimulator(0.5)
+    for label,seats in (("narrowbody",sim.get()['Seats']),(f"widebody {rows*10}",widebody(sim,rows))):
+        sm = SeatMatrix()
+        sm.load(seats)
+        base = {k : v for k,v in sm.aggregate(False,False).items()}
+        assert base == preProcessLoop(seats), label
+
+        start = perf_counter()
+        for i in range(repeat):
+            preProcessLoop(seats)
+        loop = (perf_counter() - start) / repeat
+
+        start = perf_counter()
+        for i in range(repeat):
+            sm.load(seats)
+            sm.aggregate(False,False)
+        vec = (perf_counter() - start) / repeat
+
+        start = perf_counter()
+        for i in range(repeat):
+            sm.load(seats)
+            pub = sm.aggregate()
+        full = (perf_counter() - start) / repeat
+
+        print(f"{label:15} {len(seats):4} seats: loop {loop*1e6:7.0f}us  matrix {vec*1e6:7.0f}us  "
+              f"with zones/rows {full*1e6:7.0f}us ({len(pub)} fields)")
+
+
+if __name__ == "__main__" :
+    logging.basicConfig(level=logging.WARNING)
+    benchmark(*[int(a) for a in sys.argv[1:3]])
@@ -1,57 +1,171 @@
 import json
 import logging
 import sys
-from datetime import datetime, timezone
+from collections import deque
+from time import monotonic, sleep
 
-from time import sleep
 import requests
+from requests.adapters import HTTPAdapter
 
+logger = logging.getLogger("ViasatMSI")
 
 
 class ViasatMSI(object) :
-    def __init__(self,url="https://msi.viasat.com:9100/v1/flight") :
+    # MSI poller.  One keep-alive session for all the polls, conditional
+    # requests (ETag/Last-Modified) when the endpoint sends validators, and
+    # samples with an already seen timestamp are dropped.  The poll interval
+    # follows the flight phase: fast while climbing and approaching, slow in
+    # cruise.
+    TIMEOUT = 2.5
+    DEFAULT_INTERVAL = 3.0
+    PHASE_INTERVALS = {"takeoff" : 1.0, "climb" : 1.0, "descent" : 1.0, "approach" : 1.0, "landing" : 1.0,
+                       "cruise" : 10.0}
+    LATENCY_SAMPLES = 200
+    STATS_EVERY = 100
+
+    def __init__(self,url="https://msi.viasat.com:9100/v1/flight",phaseIntervals:dict=None,
+                 defaultInterval:float=DEFAULT_INTERVAL) :
         super().__init__()
         self.url = url
+        self.phaseIntervals = dict(self.PHASE_INTERVALS if phaseIntervals is None else phaseIntervals)
+        self.defaultInterval = defaultInterval
+
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/json'})
+        self.session.mount(url,HTTPAdapter(pool_connections=1,pool_maxsize=1))
+
+        # validators of the last response and the last sample
+        self.etag = None
+        self.lastModified = None
+        self.lastTimestamp = None
+        self.last = None
+        self.phase = None
+        self.nextPoll = monotonic()
+
+        self.requests = 0
+        self.samples = 0
+        self.duplicates = 0
+        self.notModified = 0
+        self.errors = 0
+        # consecutive failed queries, the first one and the recovery are
+        # logged as warnings, the ones in between at debug
+        self.failures = 0
+        self.latencies = deque(maxlen=self.LATENCY_SAMPLES)
+
+    def interval(self) -> float :
+        if self.phase is None:
+            return self.defaultInterval
+        phase = str(self.phase).lower()
+        for key,secs in self.phaseIntervals.items():
+            if key in phase:
+                return secs
+        return self.defaultInterval
+
+    def wait(self) -> None :
+        # polls at a fixed rate, the time spent in the request included
+        self.nextPoll = max(self.nextPoll + self.interval(),monotonic())
+        sleep(max(0.0,self.nextPoll - monotonic()))
 
     def query(self) -> dict:
+        # -> the new sample, None when there is none (error, not modified,
+        # duplicate), self.last keeps the latest one
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.lastModified is not None:
+            headers['If-Modified-Since'] = self.lastModified
+
+        self.requests += 1
+        if self.requests % self.STATS_EVERY == 0:
+            logger.info(f"MSI {self.url}: {self.stats()}")
 
         try:
-            if True:
-
-                    rsp = requests.get(self.url,timeout=2.5,
-                                       headers={'Accept': 'application/json'})
-
-            else:
-                rsp = type("", (dict,), {"status_code": 200, "text": ""})()
-                rsp.text = '{ "timestamp": "' + f"{datetime.now(timezone.utc).replace(microsecond=0).isoformat()}" + '",'
-
-                rsp.text += """
-                "airspeed" : 410.0,
-                "altitude": 33000.0,
-                "groundspeed": 420.0,
-                "eta" : "02:30",
-                "heading": 180.0,
-                "latitude": 30.4469485748939,
-                "longitude": -99.234234
-                }"""
-
-            if rsp.status_code == 200:
-
-                jsonRsp = json.loads(rsp.text)
-
-                return jsonRsp
-            else:
-                logging.error(f"Unable to query MSI: {rsp.status_code}")
+            start = monotonic()
+            rsp = self.session.get(self.url,timeout=self.TIMEOUT,headers=headers)
+            self.latencies.append(monotonic() - start)
+
+            if rsp.status_code == 304:
+                self.recovered()
+                self.notModified += 1
+                return None
+
+            if rsp.status_code != 200:
+                self.failed(f"HTTP {rsp.status_code}")
+                return None
+
+            self.etag = rsp.headers.get('ETag')
+            self.lastModified = rsp.headers.get('Last-Modified')
+            jsonRsp = json.loads(rsp.text)
         except Exception as e :
-            pass
-
-        return None
+            self.failed(e)
+            return None
+
+        self.recovered()
+
+        ts = jsonRsp.get('timestamp')
+        if ts is not None and ts == self.lastTimestamp:
+            self.duplicates += 1
+            return None
+
+        self.lastTimestamp = ts
+        self.last = jsonRsp
+        self.phase = jsonRsp.get('flightPhase',self.phase)
+        self.samples += 1
+        return jsonRsp
+
+    def failed(self,reason) -> None :
+        self.errors += 1
+        self.failures += 1
+        if self.failures == 1:
+            logger.warning(f"MSI query failed: {reason}, retrying every poll")
+        else:
+            logger.debug(f"MSI query failed ({self.failures} in a row): {reason}")
+
+    def recovered(self) -> None :
+        if self.failures > 0:
+            logger.warning(f"MSI queries succeed again after {self.failures} failures")
+            self.failures = 0
+
+    def connections(self) -> tuple :
+        # (connections opened, requests sent) by the session's pools
+        pools = self.session.get_adapter(self.url).poolmanager.pools
+        opened = 0
+        sent = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return opened,sent
+
+    def stats(self) -> dict :
+        opened,sent = self.connections()
+        lat = sorted(self.latencies)
+        return {"requests" : self.requests,
+                "samples" : self.samples,
+                "duplicates" : self.duplicates,
+                "notModified" : self.notModified,
+                "errors" : self.errors,
+                "failing" : self.failures,
+                # TCP/TLS connections opened for all those requests
+                "connections" : opened,
+                "reused" : max(0,sent - opened),
+                "latencyMs" : {"avg" : round(sum(lat) / len(lat) * 1000,1) if lat else 0,
+                               "p50" : round(lat[len(lat) // 2] * 1000,1) if lat else 0,
+                               "p95" : round(lat[int(len(lat) * 0.95)] * 1000,1) if lat else 0,
+                               "max" : round(lat[-1] * 1000,1) if lat else 0},
+                "phase" : self.phase,
+                "interval" : self.interval()}
+
+    def close(self) -> None :
+        self.session.close()
 
 
 
 ENDPOINT = "https://msi.viasat.com:9100/v1/flight"
 
 if __name__ == "__main__" :
+    logging.basicConfig(level=logging.INFO)
 
     if len(sys.argv) > 1 :
         ENDPOINT = sys.argv[1]
@@ -62,9 +176,9 @@ if __name__ == "__main__" :
     for i in range(10) :
         rsp = api.query()
         if (rsp is None) :
-            print("Failed to get response")
-
-        sleep(1)
+            print("No new sample")
 
+        api.wait()
 
+    print(api.stats())
     print("Done")
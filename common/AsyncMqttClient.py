@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import socket
+
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+
+from common.MqttClient import MqttClient
+
+logger = logging.getLogger("AsyncMqttClient")
+
+
+class AsyncMqttClient(MqttClient) :
+    # MqttClient driven by an asyncio event loop instead of paho's network
+    # thread.  The socket is registered with the loop, so message callbacks
+    # run on the loop and can schedule coroutines directly.  pause()/resume()
+    # stop and restart reading from the broker for backpressure.  sendBuffer
+    # sets SO_SNDBUF of the socket, None keeps the OS default.
+    MISC_INTERVAL = 1.0
+
+    def __init__(self,*args,sendBuffer:int=None,**kwargs) :
+        super(AsyncMqttClient, self).__init__(*args,**kwargs)
+
+        self.sendBuffer = sendBuffer
+        self.loop = None
+        self.sock = None
+        self.paused = False
+        self.miscTask = None
+
+        self.mqClient.on_socket_open = self._onSocketOpen
+        self.mqClient.on_socket_close = self._onSocketClose
+        self.mqClient.on_socket_register_write = self._onSocketRegisterWrite
+        self.mqClient.on_socket_unregister_write = self._onSocketUnregisterWrite
+
+    @staticmethod
+    def _onSocketOpen(client,ud,sock) :
+        ud.sock = sock
+        if not ud.paused:
+            ud.loop.add_reader(sock,client.loop_read)
+        if ud.sendBuffer is not None:
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF,ud.sendBuffer)
+
+    @staticmethod
+    def _onSocketClose(client,ud,sock) :
+        ud.loop.remove_reader(sock)
+        ud.sock = None
+
+    @staticmethod
+    def _onSocketRegisterWrite(client,ud,sock) :
+        ud.loop.add_writer(sock,client.loop_write)
+
+    @staticmethod
+    def _onSocketUnregisterWrite(client,ud,sock) :
+        ud.loop.remove_writer(sock)
+
+    def pause(self) -> None :
+        if not self.paused:
+            self.paused = True
+            if self.sock is not None:
+                self.loop.remove_reader(self.sock)
+            logger.debug("Paused reading from broker")
+
+    def resume(self) -> None :
+        if self.paused:
+            self.paused = False
+            if self.sock is not None:
+                self.loop.add_reader(self.sock,self.mqClient.loop_read)
+            logger.debug("Resumed reading from broker")
+
+    async def miscLoop(self) -> None :
+        # keepalive pings, retries and reconnects
+        delay = self.FIRST_RECONNECT_DELAY
+        while not self.abort.is_set():
+            rc = self.mqClient.loop_misc()
+            if rc != MQTT_ERR_SUCCESS and not self.abort.is_set():
+                logger.info(f"Reconnecting in {delay} seconds...")
+                await asyncio.sleep(delay)
+                try:
+                    self.mqClient.reconnect()
+                    delay = self.FIRST_RECONNECT_DELAY
+                    logger.info("Reconnected successfully!")
+                except OSError as err:
+                    logger.error(f"{err}. Reconnect failed. Retrying...")
+                    delay = min(delay * self.RECONNECT_RATE,self.MAX_RECONNECT_DELAY)
+                continue
+            await asyncio.sleep(self.MISC_INTERVAL)
+
+    async def start(self) -> None :
+        self.loop = asyncio.get_running_loop()
+        self.initialize()
+
+        while not self.abort.is_set():
+            try:
+                self.doConnect(self.server,self.port)
+                break
+            except OSError as err:
+                logger.warning(f"Unable to connect to {self.server}: {err}")
+                await asyncio.sleep(self.FIRST_RECONNECT_DELAY)
+
+        self.miscTask = asyncio.create_task(self.miscLoop())
+
+    def run(self) :
+        raise RuntimeError("AsyncMqttClient is started with 'await start()'")
+
+    def terminate(self) :
+        self.abort.set()
+        self.mqClient.disconnect()
+        if self.miscTask is not None:
+            self.miscTask.cancel()
+        logger.info("MQTT Client terminated successfully")
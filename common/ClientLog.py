@@ -0,0 +1,113 @@
+import json
+import re
+import sys
+from typing import Iterator, Tuple
+
+# Recorded client/server logs come in a few flavours depending on the version
+# that wrote them.  readRecords() turns any of them back into (topic,payload).
+
+# AircraftClient / IfeDssClient: full topic and payload
+PUBLISH_RE = re.compile(r"TOPIC:\[(?P<TOPIC>[^\]]+)\] PAYLOAD:\[(?P<PAYLOAD>.*)\]\s*$")
+
+# InfluxMqttServer
+RX_RE = re.compile(r"RX-> TOPIC\[(?P<TOPIC>[^\]]+)\] PAYLOAD\[b'(?P<PAYLOAD>.*)'\]\s*$")
+
+# MqttClient.onMessage, the topic was not logged
+RECEIVED_RE = re.compile(r"Message received: b'(?P<PAYLOAD>.*)'\s*$")
+
+# older AircraftClient logs only recorded topic and MSI timestamp
+SUMMARY_RE = re.compile(r"Publishing to (?P<TOPIC>\w+/[^/]+/[^/]+/\w+), timestamp: (?P<TS>\S+)\s*$")
+
+DEFAULT_TOPIC = "Delta/NXXXBS/DL998/MSI"
+
+MSI_TEMPLATE = {"timestamp":"2025-10-16T12:08:46Z","eta":"02:35","flightDuration":12,"flightNumber":"DAL1516",
+                "latitude":37.22229967994918,"longitude":-112.15674058996935,"noseId":"004001","paState":True,
+                "vehicleId":"TESTDL15","destination":"KCVG","origin":"KATL","flightId":"TESTDL15_SF_20251014183628",
+                "airspeed":410,"airTemperature":32,"altitude":33000,"distanceToGo":999,"doorState":"Closed",
+                "groundspeed":420,"heading":180,"timeToGo":12,"wheelWeightState":"Off","grossWeight":500,
+                "windSpeed":150,"windDirection":200.0,"flightPhase":"Cruise"}
+
+
+def synthesize(topic:str,ts:str) -> str :
+    # rebuild a representative MSI payload for summary-only log lines
+    tpc = topic.split('/')
+    data = dict(MSI_TEMPLATE)
+    data['timestamp'] = ts
+    data['vehicleId'] = tpc[1]
+    data['flightNumber'] = tpc[2]
+    return json.dumps({"header" : {"timestamp" : ts}, "data" : data})
+
+
+def parseLine(line:str,synth:bool=True) -> [Tuple[str,str],None] :
+    m = PUBLISH_RE.search(line)
+    if m is not None:
+        return m.group("TOPIC"),m.group("PAYLOAD")
+
+    m = RX_RE.search(line)
+    if m is not None:
+        return m.group("TOPIC"),m.group("PAYLOAD")
+
+    m = RECEIVED_RE.search(line)
+    if m is not None:
+        return DEFAULT_TOPIC,m.group("PAYLOAD")
+
+    if synth:
+        m = SUMMARY_RE.search(line)
+        if m is not None:
+            return m.group("TOPIC"),synthesize(m.group("TOPIC"),m.group("TS"))
+
+    return None
+
+
+# all of the above over a whole buffer (bytes or mmap), one regex pass
+# instead of a python loop over the lines
+SCAN_RE = re.compile(rb"(?:"
+                     rb"TOPIC:\[(?P<T1>[^\]\n]+)\] PAYLOAD:\[(?P<P1>[^\n]*)\]"
+                     rb"|RX-> TOPIC\[(?P<T2>[^\]\n]+)\] PAYLOAD\[b'(?P<P2>[^\n]*)'\]"
+                     rb"|Message received: b'(?P<P3>[^\n]*)'"
+                     rb"|Publishing to (?P<T4>\w+/[^/\n]+/[^/\n]+/\w+), timestamp: (?P<TS>\S+)"
+                     rb")[ \t\r]*$",re.MULTILINE)
+TIMESTAMP_RE = re.compile(rb'"timestamp"\s*:\s*"([^"]+)"')
+
+
+def record(m,synth:bool=True) -> [Tuple[str,bytes,str],None] :
+    # SCAN_RE match -> (topic, payload, timestamp) with the payload's first
+    # timestamp, the header one for envelopes, None when there is none
+    topic = m.group("T1") or m.group("T2")
+    payload = m.group("P1") or m.group("P2")
+    if payload is None:
+        payload = m.group("P3")
+        if payload is not None:
+            topic = DEFAULT_TOPIC.encode()
+        elif synth:
+            topic = m.group("T4").decode()
+            ts = m.group("TS").decode()
+            return topic,synthesize(topic,ts).encode('utf-8'),ts
+        else:
+            return None
+
+    t = TIMESTAMP_RE.search(payload)
+    return topic.decode(),payload,(t.group(1).decode() if t is not None else None)
+
+
+def scan(buf,synth:bool=True) -> Iterator[Tuple[str,bytes,str]] :
+    for m in SCAN_RE.finditer(buf):
+        rec = record(m,synth)
+        if rec is not None:
+            yield rec
+
+
+def readRecords(fname:str,synth:bool=True) -> Iterator[Tuple[str,str]] :
+    with open(fname,encoding='utf-8',errors='replace') as f:
+        for line in f:
+            rec = parseLine(line,synth)
+            if rec is not None:
+                yield rec
+
+
+if __name__ == "__main__" :
+    count = 0
+    for fname in sys.argv[1:]:
+        for topic,payload in readRecords(fname):
+            count += 1
+    print(f"{count} records")
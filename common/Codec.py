@@ -0,0 +1,444 @@
+import json
+import logging
+import os
+import sys
+from time import perf_counter
+from typing import Any, Dict, List, TypedDict, Union
+
+logger = logging.getLogger("Codec")
+
+# JSON codec used by the aircraft clients and the server.  Uses msgspec or
+# orjson when they are installed and falls back to the stdlib json module.
+# Set MQTT_JSON_CODEC=json|orjson|msgspec to force a backend.
+#
+# Publishers can also send the envelopes as MessagePack or CBOR, see
+# PayloadFormat below.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class DecodeError(ValueError) :
+    pass
+
+
+Number = Union[int,float]
+
+class Header(TypedDict) :
+    timestamp: str
+
+class Envelope(TypedDict) :
+    header: Header
+    data: Dict[str,Any]
+
+class MsiRecord(TypedDict, total=False) :
+    timestamp: str
+    eta: str
+    flightDuration: Number
+    flightNumber: str
+    latitude: Number
+    longitude: Number
+    noseId: str
+    paState: bool
+    vehicleId: str
+    destination: str
+    origin: str
+    flightId: str
+    airspeed: Number
+    airTemperature: Number
+    altitude: Number
+    distanceToGo: Number
+    doorState: str
+    groundspeed: Number
+    heading: Number
+    timeToGo: Number
+    wheelWeightState: str
+    grossWeight: Number
+    windSpeed: Number
+    windDirection: Number
+    flightPhase: str
+
+class MsiEnvelope(TypedDict) :
+    header: Header
+    data: MsiRecord
+
+# several samples published at once, see AircraftClient batching
+class Batch(TypedDict) :
+    header: Header
+    batch: List[Envelope]
+
+class MsiBatch(TypedDict) :
+    header: Header
+    batch: List[MsiEnvelope]
+
+
+# Every payload is decoded once, untyped, and the result is checked against
+# the schema by a checker compiled per schema: exact classes in frozensets,
+# so a bool doesn't pass as a number and no typing objects are hashed on the
+# hot path.  Keys the schema doesn't know are kept.
+_TYPES = {str : (str,), bool : (bool,), Number : (int,float), Dict[str,Any] : (dict,),
+          Header : (dict,), MsiRecord : (dict,), List[Envelope] : (list,), List[MsiEnvelope] : (list,)}
+_NESTED = {Header, MsiRecord}
+_LISTS = {List[Envelope] : Envelope, List[MsiEnvelope] : MsiEnvelope}
+_CHECKERS = {}
+# records of one source have the same keys and value types every time, the
+# key/type signatures that passed are remembered for schemas this wide
+MEMO_FIELDS = 8
+MEMO_SIZE = 4096
+
+def checker(schema) :
+    check = _CHECKERS.get(schema)
+    if check is not None:
+        return check
+
+    required = tuple(schema.__required_keys__)
+    fields = []
+    nested = []
+    names = {}
+    for k,typ in schema.__annotations__.items():
+        fields.append((k,frozenset(_TYPES[typ])))
+        names[k] = "int | float" if typ is Number else typ.__name__
+        if typ in _NESTED:
+            nested.append((k,checker(typ),None))
+        elif typ in _LISTS:
+            nested.append((k,None,checker(_LISTS[typ])))
+    fields = tuple(fields)
+    nested = tuple(nested)
+    memo = set() if len(fields) > MEMO_FIELDS else None
+
+    def checkFields(obj,path:str) -> None :
+        get = obj.get
+        for k,types in fields:
+            v = get(k,obj)
+            if v is not obj and v.__class__ not in types:
+                raise DecodeError(f"Expected `{names[k]}` at {path}.{k}, got `{type(v).__name__}`")
+
+    def check(obj,path:str="$") -> None :
+        if obj.__class__ is not dict:
+            raise DecodeError(f"Expected object at {path}")
+        for k in required:
+            if k not in obj:
+                raise DecodeError(f"Object missing required field `{k}` at {path}")
+
+        if memo is None:
+            checkFields(obj,path)
+        else:
+            sig = (*obj,*map(type,obj.values()))
+            if sig not in memo:
+                checkFields(obj,path)
+                if len(memo) < MEMO_SIZE:
+                    memo.add(sig)
+
+        # the path is only built to report an error, by checking again
+        for k,sub,item in nested:
+            v = obj.get(k)
+            if v is None:
+                continue
+            try:
+                if sub is not None:
+                    sub(v)
+                else:
+                    for it in v:
+                        item(it)
+            except DecodeError:
+                if sub is not None:
+                    sub(v,f"{path}.{k}")
+                else:
+                    for i,it in enumerate(v):
+                        item(it,f"{path}.{k}[{i}]")
+                raise
+
+    _CHECKERS[schema] = check
+    return check
+
+def validate(obj,schema) :
+    checker(schema)(obj)
+    return obj
+
+
+class JsonBackend(object) :
+    name = "json"
+
+    def loads(self,buf) :
+        try:
+            return json.loads(buf)
+        except (ValueError,TypeError) as e:
+            raise DecodeError(str(e))
+
+    def dumps(self,obj) -> bytes :
+        return json.dumps(obj,separators=(',',':'),default=str).encode('utf-8')
+
+    def decoder(self,schema) :
+        check = checker(schema)
+        loads = self.loads
+        def decode(buf) :
+            obj = loads(buf)
+            check(obj)
+            return obj
+        return decode
+
+
+class OrjsonBackend(JsonBackend) :
+    name = "orjson"
+
+    def loads(self,buf) :
+        try:
+            return orjson.loads(buf)
+        except (orjson.JSONDecodeError,TypeError) as e:
+            raise DecodeError(str(e))
+
+    def dumps(self,obj) -> bytes :
+        return orjson.dumps(obj,default=str)
+
+
+class MsgspecBackend(JsonBackend) :
+    name = "msgspec"
+
+    def __init__(self) :
+        self.decoderAny = msgspec.json.Decoder()
+        self.encoder = msgspec.json.Encoder(enc_hook=str)
+
+    def loads(self,buf) :
+        try:
+            return self.decoderAny.decode(buf)
+        except (msgspec.DecodeError,TypeError) as e:
+            raise DecodeError(str(e))
+
+    def dumps(self,obj) -> bytes :
+        return self.encoder.encode(obj)
+
+
+BACKENDS = {"json" : JsonBackend}
+if orjson is not None:
+    BACKENDS["orjson"] = OrjsonBackend
+if msgspec is not None:
+    BACKENDS["msgspec"] = MsgspecBackend
+
+
+backend = None
+loads = None
+dumps = None
+decodeEnvelope = None
+decodeMsi = None
+decodeBatch = None
+decodeMsiBatch = None
+
+def setBackend(name:str=None) -> str :
+    global backend, loads, dumps, decodeEnvelope, decodeMsi, decodeBatch, decodeMsiBatch
+
+    if name is None:
+        for name in ("msgspec","orjson","json"):
+            if name in BACKENDS:
+                break
+    elif name not in BACKENDS:
+        logger.warning(f"JSON codec {name} not available, using stdlib json")
+        name = "json"
+
+    backend = BACKENDS[name]()
+    loads = backend.loads
+    dumps = backend.dumps
+    decodeEnvelope = backend.decoder(Envelope)
+    decodeMsi = backend.decoder(MsiEnvelope)
+    decodeBatch = backend.decoder(Batch)
+    decodeMsiBatch = backend.decoder(MsiBatch)
+    logger.info(f"Using {name} JSON codec")
+    return name
+
+setBackend(os.getenv("MQTT_JSON_CODEC"))
+
+
+# Payload formats, chosen per publisher.  The receiver takes the format from
+# the MQTT v5 content-type property, else from a topic suffix
+# (Delta/<tail>/<flight>/MSI/msgpack), else from the first payload byte:
+# the envelope is a map, '{' in JSON, 0x8X in MessagePack and 0xAX in CBOR.
+# Values the encoders don't know are sent as str() like the JSON backends'
+# default=str does.
+
+class PayloadFormat(object) :
+    # JSON through the selected backend
+    name = "json"
+    contentType = "application/json"
+
+    def dumps(self,obj) -> bytes :
+        return dumps(obj)
+
+    def loads(self,buf) :
+        return loads(buf)
+
+    def decodeEnvelope(self,buf) :
+        return decodeEnvelope(buf)
+
+    def decodeMsi(self,buf) :
+        return decodeMsi(buf)
+
+    def decodeBatch(self,buf) :
+        return decodeBatch(buf)
+
+    def decodeMsiBatch(self,buf) :
+        return decodeMsiBatch(buf)
+
+
+class BinaryFormat(PayloadFormat) :
+    def __init__(self) :
+        self.decodeEnvelope = self.decoder(Envelope)
+        self.decodeMsi = self.decoder(MsiEnvelope)
+        self.decodeBatch = self.decoder(Batch)
+        self.decodeMsiBatch = self.decoder(MsiBatch)
+
+    def decoder(self,schema) :
+        check = checker(schema)
+        loads = self.loads
+        def decode(buf) :
+            obj = loads(buf)
+            check(obj)
+            return obj
+        return decode
+
+
+class MsgpackFormat(BinaryFormat) :
+    name = "msgpack"
+    contentType = "application/msgpack"
+
+    def __init__(self) :
+        if msgspec is not None:
+            self.encoder = msgspec.msgpack.Encoder(enc_hook=str)
+            self.decoderAny = msgspec.msgpack.Decoder()
+        super(MsgpackFormat, self).__init__()
+
+    def dumps(self,obj) -> bytes :
+        if msgspec is not None:
+            return self.encoder.encode(obj)
+        return msgpack.packb(obj,default=str)
+
+    def loads(self,buf) :
+        try:
+            if msgspec is not None:
+                return self.decoderAny.decode(buf)
+            return msgpack.unpackb(buf)
+        except Exception as e:
+            raise DecodeError(str(e))
+
+
+class CborFormat(BinaryFormat) :
+    name = "cbor"
+    contentType = "application/cbor"
+
+    @staticmethod
+    def _default(encoder,value) -> None :
+        encoder.encode(str(value))
+
+    def dumps(self,obj) -> bytes :
+        return cbor2.dumps(obj,default=self._default)
+
+    def loads(self,buf) :
+        try:
+            return cbor2.loads(buf)
+        except Exception as e:
+            raise DecodeError(str(e))
+
+
+FORMATS = {"json" : PayloadFormat()}
+if msgspec is not None or msgpack is not None:
+    FORMATS["msgpack"] = MsgpackFormat()
+if cbor2 is not None:
+    FORMATS["cbor"] = CborFormat()
+
+CONTENT_TYPES = {fmt.contentType : fmt for fmt in FORMATS.values()}
+
+
+def getFormat(name:str) -> PayloadFormat :
+    if name not in FORMATS:
+        logger.warning(f"Payload format {name} not available, using json")
+        name = "json"
+    return FORMATS[name]
+
+def sniff(payload) -> str :
+    if len(payload) > 0:
+        b = payload[0]
+        if 0x80 <= b <= 0x8F or b in (0xDE,0xDF):
+            return "msgpack"
+        if 0xA0 <= b <= 0xBF:
+            return "cbor"
+    return "json"
+
+def formatOf(topic:str,payload,contentType:str=None) -> PayloadFormat :
+    fmt = CONTENT_TYPES.get(contentType)
+    if fmt is None:
+        fmt = FORMATS.get(topic[topic.rfind('/')+1:])
+    if fmt is None:
+        fmt = FORMATS.get(sniff(payload),FORMATS["json"])
+    return fmt
+
+
+
+def benchmark(fnames,repeat:int=5) -> None :
+    from common.ClientLog import readRecords
+
+    payloads = []
+    for fname in fnames:
+        payloads.extend(p.encode('utf-8') for t,p in readRecords(fname))
+    if len(payloads) == 0:
+        print("No records found")
+        return
+
+    objs = [json.loads(p) for p in payloads]
+    print(f"{len(payloads)} records, {sum(len(p) for p in payloads)/len(payloads):.0f} bytes avg")
+
+    def timeit(func,items) -> float :
+        best = None
+        for i in range(repeat):
+            start = perf_counter()
+            for item in items:
+                func(item)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best,elapsed)
+        return best / len(items) * 1e6
+
+    baseline = None
+    for name in BACKENDS:
+        be = BACKENDS[name]()
+        result = (timeit(be.loads,payloads),
+                  timeit(be.decoder(MsiEnvelope),payloads),
+                  timeit(be.dumps,objs))
+        if baseline is None:
+            baseline = result
+        print(f"{name:8} loads {result[0]:6.2f}us ({baseline[0]/result[0]:4.1f}x)  "
+              f"typed {result[1]:6.2f}us ({baseline[1]/result[1]:4.1f}x)  "
+              f"dumps {result[2]:6.2f}us ({baseline[2]/result[2]:4.1f}x)")
+
+    # payload formats with the current JSON backend as the reference
+    print(f"Payload formats (json = {backend.name})")
+    baseline = None
+    for name,fmt in FORMATS.items():
+        encoded = [fmt.dumps(o) for o in objs]
+        assert fmt.decodeMsi(encoded[0]) == objs[0]
+        size = sum(len(e) for e in encoded) / len(encoded)
+        result = (size,timeit(fmt.loads,encoded),timeit(fmt.decodeMsi,encoded),timeit(fmt.dumps,objs))
+        if baseline is None:
+            baseline = result
+        print(f"{name:8} size {result[0]:6.0f}B ({result[0]/baseline[0]:4.0%})  "
+              f"loads {result[1]:6.2f}us ({baseline[1]/result[1]:4.1f}x)  "
+              f"typed decode {result[2]:6.2f}us ({baseline[2]/result[2]:4.1f}x)  "
+              f"encode {result[3]:6.2f}us ({baseline[3]/result[3]:4.1f}x)")
+
+
+if __name__ == "__main__" :
+    files = sys.argv[1:] if len(sys.argv) > 1 else ["test/AcClient_20251015_144203.log"]
+    benchmark(files)
@@ -0,0 +1,291 @@
+import logging
+import struct
+import sys
+import zlib
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import List, Tuple
+
+from common.Codec import DecodeError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("Compression")
+
+# Dictionary compression of the uplink payloads.  MSI and DSS messages are a
+# few hundred bytes of the same keys over and over, too little for a
+# compressor to learn from a single message, so both ends share a preset
+# dictionary.  A compressed payload is framed as
+#
+#     0xC1 | algorithm (1 byte) | dictionary version (2 bytes) | data
+#
+# 0xC1 starts neither a JSON, MessagePack (never used) nor CBOR (a tag, not
+# the envelope map) payload, so uncompressed payloads pass through.
+
+MAGIC = 0xC1
+HEADER = struct.Struct("!BBH")
+ZLIB = 1
+ZSTD = 2
+ALGOS = {"zlib" : ZLIB, "zstd" : ZSTD}
+MAX_SIZE = 1024*1024
+
+FILE_MAGIC = b"MQTTDICT"
+BUILTIN_VERSION = 1
+
+# Version 1, representative DSS and MSI envelopes.  Never change it, publish
+# a trained dictionary under a new version instead.
+BUILTIN_V1 = (b'{"header":{"timestamp":"2025-10-16 12:08:46.123456+00:00"},"data":{"DSS_COMM_LOSS":12,'
+              b'"TM_SYNC":95,"TV_SVC_AVL":96,"VLS":40,"PA":3,"PCTL_LOCK":20,"STOWD":45,"LOGIN_AVL":101,'
+              b'"LOGD_IN":88,"KID":9,"CONTENT_AVL":150,"UI_Home/Landing Page":30,"UI_Logout":4,"UI_Movies":25,'
+              b'"UI_TV":18,"UI_Map":20,"timestamp":"2025-10-16 12:08:46.123456+00:00"}}'
+              b'{"header":{"timestamp":"2025-10-16 12:08:46.123456+00:00"},"data":{"timestamp":'
+              b'"2025-10-16T12:08:46Z","eta":"02:35","flightDuration":12,"flightNumber":"DAL1516","latitude":'
+              b'37.22229967994918,"longitude":-112.15674058996935,"noseId":"004001","paState":true,"vehicleId":'
+              b'"TESTDL15","destination":"KCVG","origin":"KATL","flightId":"TESTDL15_SF_20251014183628","airspeed":'
+              b'410,"airTemperature":32,"altitude":33000,"distanceToGo":999,"doorState":"Closed","groundspeed":420,'
+              b'"heading":180,"timeToGo":12,"wheelWeightState":"Off","grossWeight":500,"windSpeed":150,'
+              b'"windDirection":200.0,"flightPhase":"Cruise"}}')
+
+DICTIONARIES = {BUILTIN_VERSION : BUILTIN_V1}
+
+
+def registerDictionary(version:int,data:bytes) -> None :
+    if version in DICTIONARIES and DICTIONARIES[version] != data:
+        raise ValueError(f"Compression dictionary version {version} already registered")
+    DICTIONARIES[version] = data
+
+def saveDictionary(fname:str,version:int,data:bytes) -> None :
+    with open(fname,"wb") as f:
+        f.write(FILE_MAGIC + struct.pack("!H",version) + data)
+
+def loadDictionary(fname:str) -> int :
+    with open(fname,"rb") as f:
+        buf = f.read()
+    if not buf.startswith(FILE_MAGIC):
+        raise ValueError(f"{fname} is not a compression dictionary")
+    version, = struct.unpack_from("!H",buf,len(FILE_MAGIC))
+    registerDictionary(version,buf[len(FILE_MAGIC)+2:])
+    logger.info(f"Loaded compression dictionary version {version} from {fname}")
+    return version
+
+def zstdDict(version:int) :
+    # trained zstd dictionaries are detected by their magic number, anything
+    # else is used as raw content like the zlib preset dictionary
+    return zstandard.ZstdCompressionDict(DICTIONARIES[version],dict_type=zstandard.DICT_TYPE_AUTO)
+
+
+class Compressor(object) :
+    def __init__(self,algo:str="zlib",version:int=BUILTIN_VERSION,level:int=None) :
+        if algo == "zstd" and zstandard is None:
+            logger.warning("zstandard not installed, compressing with zlib")
+            algo = "zlib"
+        if version not in DICTIONARIES:
+            raise ValueError(f"Unknown compression dictionary version {version}")
+
+        self.algo = algo
+        self.version = version
+        self.header = HEADER.pack(MAGIC,ALGOS[algo],version)
+        self.zdict = DICTIONARIES[version]
+        if algo == "zstd":
+            self.level = 19 if level is None else level
+            self.cctx = zstandard.ZstdCompressor(level=self.level,dict_data=zstdDict(version),
+                                                 write_checksum=False,write_dict_id=False)
+        else:
+            self.level = 9 if level is None else level
+
+    def compress(self,data:bytes) -> bytes :
+        if self.algo == "zstd":
+            return self.header + self.cctx.compress(data)
+
+        # raw deflate, the zlib header and checksum would cost 6 bytes
+        c = zlib.compressobj(self.level,zlib.DEFLATED,-15,9,zlib.Z_DEFAULT_STRATEGY,self.zdict)
+        return self.header + c.compress(data) + c.flush()
+
+
+class Decompressor(object) :
+    def __init__(self) :
+        self.dctx = {}
+        self.frames = 0
+
+    def decompress(self,payload:bytes) -> bytes :
+        # uncompressed payloads are returned as they are
+        if len(payload) == 0 or payload[0] != MAGIC:
+            return payload
+        if len(payload) < HEADER.size:
+            raise DecodeError("Truncated compressed payload")
+
+        magic,algo,version = HEADER.unpack_from(payload)
+        zdict = DICTIONARIES.get(version)
+        if zdict is None:
+            raise DecodeError(f"Unknown compression dictionary version {version}")
+
+        try:
+            if algo == ZLIB:
+                d = zlib.decompressobj(-15,zdict=zdict)
+                data = d.decompress(payload[HEADER.size:],MAX_SIZE)
+                if d.unconsumed_tail:
+                    raise DecodeError(f"Compressed payload larger than {MAX_SIZE} bytes")
+            elif algo == ZSTD and zstandard is not None:
+                dctx = self.dctx.get(version)
+                if dctx is None:
+                    dctx = self.dctx[version] = zstandard.ZstdDecompressor(dict_data=zstdDict(version))
+                data = dctx.decompress(payload[HEADER.size:],max_output_size=MAX_SIZE)
+            else:
+                raise DecodeError(f"Unsupported compression algorithm {algo}")
+        except zlib.error as e:
+            raise DecodeError(f"zlib: {e}")
+        except Exception as e:
+            if zstandard is not None and isinstance(e,zstandard.ZstdError):
+                raise DecodeError(f"zstd: {e}")
+            raise
+
+        self.frames += 1
+        return data
+
+
+
+def trainRaw(samples:List[bytes],size:int) -> bytes :
+    # zlib preset dictionary: whole messages spread over the training set,
+    # deflate finds the keys and the slow moving values in them
+    avg = sum(len(s) for s in samples) / len(samples)
+    step = max(1,int(len(samples) * avg / size))
+    data = b''
+    for s in samples[::step]:
+        if len(data) + len(s) > size:
+            break
+        data += s
+    return data
+
+def train(samples:List[bytes],size:int,algo:str) -> bytes :
+    if algo == "zstd":
+        return zstandard.train_dictionary(size,samples).as_bytes()
+    return trainRaw(samples,size)
+
+
+def samplesFrom(fnames:List[str],fmtName:str="json",synthetic:bool=False) -> Tuple[List[bytes],int] :
+    # -> (payloads as published in fmtName, how many of them are synthetic)
+    # The logged payloads; logs that only have "Publishing to ..." summary
+    # lines have none, with synthetic their flights are moved along a route
+    # by DeltaCodec.simulateFlight instead.
+    from common import Codec
+    from common.ClientLog import readRecords
+    from common.DeltaCodec import simulateFlight
+
+    fmt = Codec.getFormat(fmtName)
+    samples = []
+    simulated = 0
+    for fname in fnames:
+        found = 0
+        for topic,payload in readRecords(fname,synth=False):
+            try:
+                obj = Codec.loads(payload)
+            except DecodeError:
+                continue
+            samples.append(payload.encode('utf-8') if fmt.name == "json" else fmt.dumps(obj))
+            found += 1
+        if found > 0:
+            continue
+
+        if not synthetic:
+            raise ValueError(f"{fname} has no logged payloads to train on (summary lines only?), "
+                             f"use --synthetic to simulate its flights")
+
+        # record count and summary record (template) per flight
+        flights = {}
+        for topic,payload in readRecords(fname,synth=True):
+            count,template = flights.get(topic,(0,None))
+            flights[topic] = (count + 1,payload)
+        if len(flights) == 0:
+            raise ValueError(f"{fname} has no records")
+        logger.warning(f"{fname} has no logged payloads, simulating {sum(c for c,t in flights.values())} MSI records")
+        for topic,(count,template) in flights.items():
+            for rec in simulateFlight(topic,Codec.loads(template)['data'],count):
+                header = {"timestamp" : rec['timestamp'].replace('T',' ').replace('Z','.000000+00:00')}
+                samples.append(fmt.dumps({"header" : header, "data" : rec}))
+                simulated += 1
+    return samples,simulated
+
+
+def benchmark(fnames:List[str],size:int=4096,repeat:int=3,synthetic:bool=False) -> None :
+    from common import Codec
+
+    def timeit(func,items) -> float :
+        best = None
+        for i in range(repeat):
+            start = perf_counter()
+            for item in items:
+                func(item)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best,elapsed)
+        return best / len(items) * 1e6
+
+    algos = ["zlib"] + (["zstd"] if zstandard is not None else [])
+    for fmtName in Codec.FORMATS:
+        samples,simulated = samplesFrom(fnames,fmtName,synthetic)
+        # train on the first half, measure on the second
+        half = len(samples) // 2
+        training,test = samples[:half],samples[half:]
+        raw = sum(len(s) for s in test) / len(test)
+        label = f" ({simulated} of {len(samples)} synthetic, DeltaCodec.simulateFlight)" if simulated > 0 else ""
+        print(f"{fmtName}: {len(test)} messages, {raw:.0f} bytes avg{label}")
+
+        for algo in algos:
+            trained = train(training,size,algo)
+            for label,zdict in (("no dict",b''),("builtin v1",BUILTIN_V1),(f"trained {len(trained)}B",trained)):
+                version = 0xFFFF
+                DICTIONARIES[version] = zdict
+                comp = Compressor(algo,version)
+                dec = Decompressor()
+                frames = [comp.compress(s) for s in test]
+                assert all(dec.decompress(f) == s for f,s in zip(frames,test))
+                size_ = sum(len(f) for f in frames) / len(frames)
+                print(f"  {algo:4} {label:15} {size_:6.0f}B ({raw/size_:4.1f}x)  "
+                      f"compress {timeit(comp.compress,test):6.1f}us  decompress {timeit(dec.decompress,frames):5.1f}us")
+                del DICTIONARIES[version]
+
+
+def parseCmdLine(args) :
+    parser = ArgumentParser("Train and benchmark payload compression dictionaries")
+    sub = parser.add_subparsers(dest="cmd",required=True)
+
+    tr = sub.add_parser("train",help="Train a dictionary from logged traffic")
+    tr.add_argument("output",help="Dictionary file to write")
+    tr.add_argument("logs",nargs="+",help="AcClient logs")
+    tr.add_argument("--version",type=int,required=True,help="Dictionary version, >1 (1 is builtin)")
+    tr.add_argument("--size",type=int,default=4096,help="Dictionary size in bytes")
+    tr.add_argument("--algo",choices=("zlib","zstd"),default="zstd" if zstandard is not None else "zlib",
+                    help="zstd trains a zstd only dictionary, zlib a raw one usable by both")
+    tr.add_argument("--format",default="json",help="Payload format of the samples")
+    tr.add_argument("--synthetic",action="store_true",
+                    help="Simulate the flights of logs that have no payloads (summary lines only)")
+
+    bn = sub.add_parser("bench",help="Compression ratio and CPU cost per message")
+    bn.add_argument("logs",nargs="*",default=["test/AcClient_20251015_144203.log"])
+    bn.add_argument("--size",type=int,default=4096,help="Trained dictionary size in bytes")
+    bn.add_argument("--synthetic",action="store_true",
+                    help="Simulate the flights of logs that have no payloads (the test log)")
+
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__" :
+    logging.basicConfig(level=logging.INFO)
+    params = parseCmdLine(sys.argv[1:] if len(sys.argv) > 1 else ["bench","--synthetic"])
+
+    try:
+        if params.cmd == "train":
+            if params.version <= BUILTIN_VERSION:
+                sys.exit("Versions up to 1 are builtin")
+            samples,simulated = samplesFrom(params.logs,params.format,params.synthetic)
+            data = train(samples,params.size,params.algo)
+            saveDictionary(params.output,params.version,data)
+            label = f", {simulated} of {len(samples)} samples synthetic" if simulated > 0 else ""
+            print(f"Wrote {len(data)} byte {params.algo} dictionary version {params.version} to {params.output} "
+                  f"({len(samples)} samples{label})")
+        else:
+            benchmark(params.logs,params.size,synthetic=params.synthetic)
+    except ValueError as e:
+        sys.exit(str(e))
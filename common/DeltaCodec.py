@@ -0,0 +1,215 @@
+import logging
+import math
+import random
+import sys
+from collections import OrderedDict
+from typing import Tuple
+
+logger = logging.getLogger("DeltaCodec")
+
+# Delta/keyframe encoding of the MSI records.  Every topic (aircraft and
+# flight) has its own sequence: a keyframe carries the full record, the
+# messages in between only the fields that changed since the previous
+# message plus DELETED, the fields that disappeared.  The header says which:
+#   {"timestamp": ..., "seq": 18, "frame": "D"}
+# Records without a seq are plain full records.
+
+KEYFRAME = "K"
+DELTA = "D"
+DELETED = "_deleted"
+
+
+class DeltaEncoder(object) :
+    KEYFRAME_INTERVAL = 20
+
+    def __init__(self,keyframeInterval:int=KEYFRAME_INTERVAL) :
+        self.keyframeInterval = keyframeInterval
+        self.last = {}
+        self.seq = {}
+        self.sinceKeyframe = {}
+        self.savings = {}
+
+    def reset(self) -> None :
+        # after a reconnect the receiver may have missed messages, start over
+        # with a keyframe on every topic
+        self.last.clear()
+
+    def encode(self,topic:str,data:dict) -> Tuple[dict,dict] :
+        # -> (header fields, data to send)
+        seq = self.seq.get(topic,0) + 1
+        self.seq[topic] = seq
+
+        last = self.last.get(topic)
+        if last is None or self.sinceKeyframe.get(topic,0) + 1 >= self.keyframeInterval:
+            self.last[topic] = dict(data)
+            self.sinceKeyframe[topic] = 0
+            return {"seq" : seq, "frame" : KEYFRAME},data
+
+        delta = {k : v for k,v in data.items() if k not in last or last[k] != v}
+        deleted = [k for k in last if k not in data]
+        if len(deleted) > 0:
+            delta[DELETED] = deleted
+
+        self.last[topic] = dict(data)
+        self.sinceKeyframe[topic] += 1
+        return {"seq" : seq, "frame" : DELTA},delta
+
+    def account(self,topic:str,sent:int,full:int) -> None :
+        # bytes published against the bytes of the full record
+        stats = self.savings.get(topic)
+        if stats is None:
+            stats = self.savings[topic] = {"messages" : 0, "bytesFull" : 0, "bytesSent" : 0}
+        stats['messages'] += 1
+        stats['bytesFull'] += full
+        stats['bytesSent'] += sent
+
+    def stats(self,topic:str=None) -> dict :
+        if topic is not None:
+            return dict(self.savings.get(topic,{}))
+        return {t : dict(s) for t,s in self.savings.items()}
+
+
+class DeltaDecoder(object) :
+    # Server side: rebuilds the full records per topic.  A delta can only be
+    # applied on top of the message right before it, after a gap (lost
+    # message, server restart) the topic's deltas are dropped until the next
+    # keyframe.
+    #
+    # The state lives in this process, so every message of a topic has to
+    # reach the same decoder: a plain subscription, or the sharded engine
+    # (-W) behind one, which shards by aircraft.  Servers splitting a $share
+    # group each see a fraction of a topic's sequence and drop most deltas,
+    # the clients must not delta encode then (no --keyframe-interval).
+    #
+    # Topics are kept in LRU order, past maxTopics the least recently seen
+    # one is forgotten (flights end, their topics never come back); were it
+    # still live it only waits for its next keyframe.
+    MAX_TOPICS = 10_000
+
+    def __init__(self,maxTopics:int=MAX_TOPICS) :
+        self.maxTopics = maxTopics
+        self.state = OrderedDict()
+        self.keyframes = 0
+        self.deltas = 0
+        self.dropped = 0
+        self.evicted = 0
+
+    def remember(self,topic:str,seq:int,record:dict) -> None :
+        self.state[topic] = (seq,record)
+        self.state.move_to_end(topic)
+        while len(self.state) > self.maxTopics:
+            self.state.popitem(last=False)
+            self.evicted += 1
+
+    def decode(self,topic:str,payload:dict) -> [dict,None] :
+        header = payload.get('header') or {}
+        seq = header.get('seq')
+        if seq is None:
+            return payload
+
+        data = payload.get('data') or {}
+        if header.get('frame') == KEYFRAME:
+            self.remember(topic,seq,data)
+            self.keyframes += 1
+            return payload
+
+        state = self.state.get(topic)
+        if state is None or seq != state[0] + 1:
+            if state is not None and seq > state[0]:
+                logger.info(f"Delta gap on {topic}: seq {seq} after {state[0]}, waiting for a keyframe")
+                del self.state[topic]
+            self.dropped += 1
+            return None
+
+        record = dict(state[1])
+        for k,v in data.items():
+            if k != DELETED:
+                record[k] = v
+        for k in data.get(DELETED,()):
+            record.pop(k,None)
+
+        self.remember(topic,seq,record)
+        self.deltas += 1
+        return {"header" : header, "data" : record}
+
+    def stats(self) -> dict :
+        return {"topics" : len(self.state),
+                "keyframes" : self.keyframes,
+                "deltas" : self.deltas,
+                "dropped" : self.dropped,
+                "evicted" : self.evicted}
+
+
+
+def simulateFlight(topic:str,template:dict,samples:int,interval:int=3) :
+    # MSI records of a cruising aircraft: position, time and distance to go
+    # move every sample, speeds, wind and temperature now and then
+    rnd = random.Random(topic)
+    lat,lon = 33.64,-84.42
+    heading = 305.0
+    dist = template.get('distanceToGo',999) * 1.0
+    rec = dict(template)
+    for i in range(samples):
+        lat += math.cos(math.radians(heading)) * 0.0125
+        lon += math.sin(math.radians(heading)) * 0.0125
+        dist = max(dist - 0.36,0.0)
+        rec['latitude'] = round(lat,6)
+        rec['longitude'] = round(lon,6)
+        rec['distanceToGo'] = round(dist)
+        rec['timeToGo'] = round(dist / 7)
+        rec['timestamp'] = f"2025-10-16T{12 + (i*interval)//3600 % 12:02d}:{(i*interval)//60 % 60:02d}:{(i*interval) % 60:02d}Z"
+        if rnd.random() < 0.2:
+            rec['groundspeed'] = template.get('groundspeed',420) + rnd.randint(-6,6)
+            rec['airspeed'] = template.get('airspeed',410) + rnd.randint(-4,4)
+        if rnd.random() < 0.05:
+            heading = (heading + rnd.uniform(-3,3)) % 360
+            rec['heading'] = round(heading)
+            rec['windSpeed'] = rnd.randint(60,160)
+            rec['windDirection'] = float(rnd.randint(0,359))
+        if rnd.random() < 0.02:
+            rec['airTemperature'] = rnd.randint(-60,-40)
+        yield dict(rec)
+
+
+def benchmark(fname:str="test/AcClient_20251015_144203.log",keyframeInterval:int=DeltaEncoder.KEYFRAME_INTERVAL) -> None :
+    # bytes saved per format on the flights of a log, their MSI records moved
+    # along a route, and what 1% message loss costs
+    from common import Codec
+    from common.ClientLog import readRecords
+
+    flights = {}
+    for topic,payload in readRecords(fname):
+        flights[topic] = flights.get(topic,0) + 1
+    if len(flights) == 0:
+        sys.exit(f"{fname} has no records")
+    template = Codec.loads(payload)['data']
+
+    for fmtName in Codec.FORMATS:
+        fmt = Codec.FORMATS[fmtName]
+        enc = DeltaEncoder(keyframeInterval)
+        lossy = DeltaDecoder()
+        rnd = random.Random(1)
+        lost = 0
+        for topic,count in flights.items():
+            for rec in simulateFlight(topic,template,count):
+                header = {"timestamp" : rec['timestamp']}
+                fields,data = enc.encode(topic,rec)
+                header.update(fields)
+                sent = fmt.dumps({"header" : header, "data" : data})
+                full = fmt.dumps({"header" : {"timestamp" : rec['timestamp']}, "data" : rec})
+                enc.account(topic,len(sent),len(full))
+                if rnd.random() < 0.01:
+                    lost += 1
+                    continue
+                lossy.decode(topic,fmt.loads(sent))
+
+        for topic,stats in enc.stats().items():
+            saved = 1 - stats['bytesSent'] / stats['bytesFull']
+            print(f"{fmtName:8} {topic:28} {stats['messages']:5} msgs {stats['bytesFull']:9} -> "
+                  f"{stats['bytesSent']:8} bytes ({saved:.0%} saved, keyframe every {keyframeInterval})")
+        print(f"{'':8} 1% loss: {lost} lost, {lossy.dropped} deltas dropped until the next keyframe")
+
+
+if __name__ == "__main__" :
+    logging.basicConfig(level=logging.WARNING)
+    benchmark(*sys.argv[1:2],*[int(a) for a in sys.argv[2:3]])
@@ -1,10 +1,11 @@
-import json
 import logging
 import os
+from time import sleep
 
 import boto3
 import botocore
 
+from common import Codec
 from common.Client import Client
 
 logger = logging.getLogger()
@@ -21,6 +22,11 @@ def strcmp(str1, str2):
     return True
 
 class KinesisClient(Client) :
+    MAX_RECORDS = 500
+    RETRIES = 2
+    RETRY_DELAY = 0.1
+    PARTITION_KEY = "parition-1"
+
     def __init__(self,cfg:str=None):
         super(KinesisClient, self).__init__(cfg)
 
@@ -32,15 +38,18 @@ class KinesisClient(Client) :
 
 
     def publish(self,stream:str,data) :
+        # already serialized records are sent as-is
         if isinstance(data,str) :
-            data = json.loads(data)
+            data = data.encode('utf-8')
+        elif not isinstance(data,(bytes,bytearray)) :
+            data = Codec.dumps(data)
         if stream is None:
             stream = self.config['default_stream']
         try:
             logger.debug("putting record to kinesis")
             rsp = self.client.put_record(StreamName=stream,
-                                         Data=json.dumps(data),
-                                         PartitionKey="parition-1")
+                                         Data=data,
+                                         PartitionKey=self.PARTITION_KEY)
             logger.debug("finished putting record to kinesis")
             return rsp
         except botocore.exceptions.SSLError as e:
@@ -50,6 +59,49 @@ class KinesisClient(Client) :
 
         return None
 
+    def publishBatch(self,stream:str,records:list,keys:list=None) -> int :
+        # put_records takes up to MAX_RECORDS per call, the records the
+        # stream rejected (throttling) are retried after a backoff -> number
+        # of records lost.  keys are the records' partition keys (the
+        # aircraft), spreading a batch over the stream's shards.
+        if stream is None:
+            stream = self.config['default_stream']
+        if keys is None:
+            keys = [self.PARTITION_KEY] * len(records)
+
+        entries = []
+        for data,key in zip(records,keys):
+            if isinstance(data,str) :
+                data = data.encode('utf-8')
+            elif not isinstance(data,(bytes,bytearray)) :
+                data = Codec.dumps(data)
+            entries.append({"Data" : data, "PartitionKey" : str(key or self.PARTITION_KEY)})
+
+        failed = 0
+        for i in range(0,len(entries),self.MAX_RECORDS):
+            chunk = entries[i:i+self.MAX_RECORDS]
+            for attempt in range(self.RETRIES + 1):
+                if attempt > 0:
+                    # throttled shards need a moment, 0.1s, 0.2s, ...
+                    sleep(self.RETRY_DELAY * 2 ** (attempt - 1))
+                try:
+                    rsp = self.client.put_records(StreamName=stream,Records=chunk)
+                except botocore.exceptions.SSLError:
+                    logger.warning("Problem connecting to Kinesis Server")
+                    break
+                except Exception as e:
+                    logger.exception(e)
+                    break
+
+                if rsp.get('FailedRecordCount',0) == 0:
+                    chunk = []
+                    break
+                chunk = [entry for entry,res in zip(chunk,rsp['Records']) if 'ErrorCode' in res]
+                logger.warning(f"Kinesis rejected {len(chunk)} records, attempt {attempt + 1}")
+            failed += len(chunk)
+
+        return failed
+
     def terminate(self) :
         self.client.close()
 
@@ -0,0 +1,346 @@
+import bisect
+import hashlib
+import heapq
+import logging
+import mmap
+import os
+import struct
+import sys
+from argparse import ArgumentParser
+from array import array
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Iterator, List, Tuple
+
+from common.ClientLog import DEFAULT_TOPIC, SCAN_RE, TIMESTAMP_RE, record
+
+logger = logging.getLogger("LogIndex")
+
+# Sidecar index of a recorded client/server log, <log>.idx: the byte offset
+# and length of every record line with its topic and timestamp, so a time
+# window or an aircraft is read straight from a memory-mapped log instead
+# of scanning it.
+#
+#     header   MAGIC | version u16 | log size u64 | log mtime ns u64 |
+#              log inode u64 | head digest 8s | bytes indexed u64 |
+#              topics u32 | entries u32
+#     topics   length u16 | topic (utf-8) | first entry u32 | entries u32
+#     columns  timestamp ms i64[] | offset u64[] | length u32[]  (little endian)
+#
+# The entries are sorted by topic, then time, so every topic is one run and
+# a time window in it is found by bisection.  A log that grew since is
+# indexed from where the index stopped.  One that was replaced (another
+# inode, or its first HEAD_BYTES indexed bytes changed: rotated, rewritten
+# in place) is indexed again from the start.
+
+MAGIC = b"MQTTLIDX"
+VERSION = 2
+HEADER = struct.Struct("<8sHQQQ8sQII")
+HEAD_BYTES = 4096
+TOPIC = struct.Struct("<H")
+RUN = struct.Struct("<II")
+SUFFIX = ".idx"
+
+
+def isoTime(ts:str) -> datetime :
+    # also the argparse type of the --start/--end options
+    try:
+        return datetime.fromisoformat(ts)
+    except (ValueError,TypeError):
+        raise ValueError(f"Not an ISO time: {ts!r}") from None
+
+
+def toMillis(ts) -> [int,None] :
+    # None -> None, an unparseable time raises ValueError
+    if ts is None:
+        return None
+    if isinstance(ts,(int,float)):
+        return int(ts)
+    if isinstance(ts,str):
+        ts = isoTime(ts)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return int(ts.timestamp() * 1000)
+
+
+def fromMillis(ms:int) -> datetime :
+    return datetime.fromtimestamp(ms / 1000,timezone.utc)
+
+
+def headDigest(f,indexed:int) -> bytes :
+    # of the log's first indexed bytes, at most HEAD_BYTES
+    f.seek(0)
+    return hashlib.blake2b(f.read(min(indexed,HEAD_BYTES)),digest_size=8).digest()
+
+
+def columns() :
+    ts,offsets,lengths = array('q'),array('Q'),array('I')
+    return ts,offsets,lengths
+
+
+class LogIndex(object) :
+    def __init__(self,fname:str) :
+        self.fname = fname
+        self.logSize = 0
+        self.logMtime = 0
+        self.logInode = 0
+        self.head = b''
+        self.indexed = 0
+        # topic -> (first entry, entries)
+        self.runs = {}
+        self.ts,self.offsets,self.lengths = columns()
+
+    @classmethod
+    def indexPath(cls,fname:str) -> str :
+        return fname + SUFFIX
+
+    @classmethod
+    def open(cls,fname:str,save:bool=True) -> "LogIndex" :
+        # the sidecar when it's current, brought up to date when the log grew,
+        # built otherwise
+        idx = None
+        try:
+            idx = cls.load(fname)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning(f"Rebuilding index of {fname}: {e}")
+
+        st = os.stat(fname)
+        if idx is not None and not idx.sameLog(st):
+            logger.info(f"{fname} was replaced since it was indexed, rebuilding the index")
+            idx = None
+        if idx is not None and (st.st_size,st.st_mtime_ns) == (idx.logSize,idx.logMtime):
+            return idx
+        if idx is None:
+            idx = cls(fname)
+
+        idx.update()
+        if save:
+            try:
+                idx.save()
+            except OSError as e:
+                logger.warning(f"Unable to save the index of {fname}: {e}")
+        return idx
+
+    def sameLog(self,st:os.stat_result) -> bool :
+        # the log the index was built from, grown or not
+        if st.st_ino != self.logInode or st.st_size < self.indexed:
+            return False
+        with open(self.fname,"rb") as f:
+            return headDigest(f,self.indexed) == self.head
+
+    def update(self) -> int :
+        # indexes the log from where the index stopped -> new entries
+        start = perf_counter()
+        st = os.stat(self.fname)
+        new = {}
+        with open(self.fname,"rb") as f:
+            if st.st_size > self.indexed:
+                with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as buf:
+                    # a line being written is left for the next update
+                    end = buf.rfind(b"\n",self.indexed) + 1
+                    last = self.ts[-1] if len(self.ts) > 0 else 0
+                    for m in SCAN_RE.finditer(buf,self.indexed,end):
+                        topic,ms = self.keyOf(m)
+                        last = ms if ms is not None else last
+                        new.setdefault(topic,[]).append((last,m.start(),m.end() - m.start()))
+                    self.indexed = max(self.indexed,end)
+            self.head = headDigest(f,self.indexed)
+
+        self.logSize = st.st_size
+        self.logMtime = st.st_mtime_ns
+        self.logInode = st.st_ino
+        count = sum(len(v) for v in new.values())
+        if count > 0:
+            self.merge(new)
+        logger.info(f"Indexed {count} records of {self.fname} in {perf_counter() - start:.3f}s")
+        return count
+
+    @staticmethod
+    def keyOf(m) -> Tuple[str,int] :
+        # topic and timestamp of a match, without synthesizing the payload
+        topic = m.group("T1") or m.group("T2") or m.group("T4")
+        if m.group("TS") is not None:
+            ts = m.group("TS")
+        else:
+            t = TIMESTAMP_RE.search(m.group("P1") or m.group("P2") or m.group("P3"))
+            ts = t.group(1) if t is not None else None
+        try:
+            ms = toMillis(ts.decode()) if ts is not None else None
+        except ValueError:
+            ms = None
+        return topic.decode() if topic is not None else DEFAULT_TOPIC,ms
+
+    def merge(self,new:dict) -> None :
+        # rebuilds the columns with the new entries in their topic's run
+        ts,offsets,lengths = columns()
+        runs = {}
+        for topic in sorted(set(self.runs) | set(new)):
+            entries = []
+            first,count = self.runs.get(topic,(0,0))
+            for i in range(first,first + count):
+                entries.append((self.ts[i],self.offsets[i],self.lengths[i]))
+            entries.extend(new.get(topic,()))
+            entries.sort()
+
+            runs[topic] = (len(ts),len(entries))
+            for t,o,l in entries:
+                ts.append(t)
+                offsets.append(o)
+                lengths.append(l)
+
+        self.runs = runs
+        self.ts,self.offsets,self.lengths = ts,offsets,lengths
+
+    def save(self,path:str=None) -> None :
+        path = path or self.indexPath(self.fname)
+        tmp = path + ".tmp"
+        with open(tmp,"wb") as f:
+            f.write(HEADER.pack(MAGIC,VERSION,self.logSize,self.logMtime,self.logInode,self.head,self.indexed,
+                                len(self.runs),len(self.ts)))
+            for topic,(first,count) in self.runs.items():
+                name = topic.encode('utf-8')
+                f.write(TOPIC.pack(len(name)) + name + RUN.pack(first,count))
+            for col in (self.ts,self.offsets,self.lengths):
+                if sys.byteorder != "little":
+                    col = array(col.typecode,col)
+                    col.byteswap()
+                f.write(col.tobytes())
+        os.replace(tmp,path)
+
+    @classmethod
+    def load(cls,fname:str,path:str=None) -> "LogIndex" :
+        path = path or cls.indexPath(fname)
+        with open(path,"rb") as f:
+            buf = f.read()
+
+        if len(buf) < HEADER.size:
+            raise ValueError(f"{path} is truncated")
+        magic,version,size,mtime,inode,head,indexed,topics,entries = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} log index")
+
+        idx = cls(fname)
+        idx.logSize,idx.logMtime,idx.logInode,idx.head,idx.indexed = size,mtime,inode,head,indexed
+        pos = HEADER.size
+        for i in range(topics):
+            n, = TOPIC.unpack_from(buf,pos)
+            topic = buf[pos+TOPIC.size:pos+TOPIC.size+n].decode('utf-8')
+            pos += TOPIC.size + n
+            idx.runs[topic] = RUN.unpack_from(buf,pos)
+            pos += RUN.size
+
+        for col in (idx.ts,idx.offsets,idx.lengths):
+            n = entries * col.itemsize
+            if pos + n > len(buf):
+                raise ValueError(f"{path} is truncated")
+            col.frombytes(buf[pos:pos+n])
+            if sys.byteorder != "little":
+                col.byteswap()
+            pos += n
+        return idx
+
+    def topics(self,tail:str=None,flight:str=None,source:str=None) -> List[str] :
+        # Delta/<tail>/<flight>/<source>[/<format>]
+        found = []
+        for topic in self.runs:
+            tpc = topic.split('/') + [None] * 3
+            if (tail is None or tpc[1] == tail) and (flight is None or tpc[2] == flight) \
+                    and (source is None or tpc[3] == source):
+                found.append(topic)
+        return found
+
+    def span(self,topic:str=None) -> [Tuple[datetime,datetime],None] :
+        runs = [self.runs[topic]] if topic is not None else self.runs.values()
+        first = [self.ts[s] for s,n in runs if n > 0]
+        last = [self.ts[s+n-1] for s,n in runs if n > 0]
+        if len(first) == 0:
+            return None
+        return fromMillis(min(first)),fromMillis(max(last))
+
+    def find(self,start=None,end=None,tail:str=None,flight:str=None,source:str=None) -> List[Tuple[int,int,int,str]] :
+        # -> [(timestamp ms, offset, length, topic)] in time order, for the
+        # records in [start, end) of the matching topics
+        lo = toMillis(start)
+        hi = toMillis(end)
+        runs = []
+        for topic in self.topics(tail,flight,source):
+            first,count = self.runs[topic]
+            a = first if lo is None else bisect.bisect_left(self.ts,lo,first,first + count)
+            b = first + count if hi is None else bisect.bisect_left(self.ts,hi,first,first + count)
+            runs.append([(self.ts[i],self.offsets[i],self.lengths[i],topic) for i in range(a,b)])
+        return list(heapq.merge(*runs))
+
+    def read(self,start=None,end=None,tail:str=None,flight:str=None,source:str=None,
+             synth:bool=True) -> Iterator[Tuple[str,bytes,str]] :
+        # the records found, as ClientLog.scan yields them
+        entries = self.find(start,end,tail,flight,source)
+        if len(entries) == 0:
+            return
+        with open(self.fname,"rb") as f:
+            with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as buf:
+                for ms,offset,length,topic in entries:
+                    m = SCAN_RE.match(buf,offset,offset + length)
+                    if m is None:
+                        raise ValueError(f"Stale index for {self.fname}, nothing at offset {offset}")
+                    rec = record(m,synth)
+                    if rec is not None:
+                        yield rec
+
+    def stats(self) -> dict :
+        span = self.span()
+        return {"log" : self.fname,
+                "bytes" : self.indexed,
+                "records" : len(self.ts),
+                "topics" : len(self.runs),
+                "from" : str(span[0]) if span else None,
+                "to" : str(span[1]) if span else None}
+
+
+
+def parseCmdLine(args) :
+    parser = ArgumentParser("Index recorded client/server logs by time and aircraft")
+    sub = parser.add_subparsers(dest="cmd",required=True)
+
+    bd = sub.add_parser("build",help="Build or update the .idx sidecar of logs")
+    bd.add_argument("logs",nargs="+")
+
+    st = sub.add_parser("stats",help="Topics and time span of indexed logs")
+    st.add_argument("logs",nargs="+")
+
+    qr = sub.add_parser("query",help="Print the records of a time window / aircraft")
+    qr.add_argument("log")
+    qr.add_argument("--start",type=isoTime,default=None,help="ISO time, inclusive")
+    qr.add_argument("--end",type=isoTime,default=None,help="ISO time, exclusive")
+    qr.add_argument("--tail",default=None)
+    qr.add_argument("--flight",default=None)
+    qr.add_argument("--source",default=None,help="MSI, DSS or UI")
+    qr.add_argument("--count",action="store_true",help="Only count the records")
+
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__" :
+    logging.basicConfig(level=logging.INFO)
+    params = parseCmdLine(sys.argv[1:])
+
+    if params.cmd == "build":
+        for fname in params.logs:
+            print(LogIndex.open(fname).stats())
+    elif params.cmd == "stats":
+        for fname in params.logs:
+            idx = LogIndex.open(fname)
+            print(idx.stats())
+            for topic,(first,count) in sorted(idx.runs.items()):
+                span = idx.span(topic)
+                print(f"  {topic:40} {count:7} records  {span[0]} - {span[1]}")
+    else:
+        idx = LogIndex.open(params.log)
+        start = perf_counter()
+        count = 0
+        for topic,payload,ts in idx.read(params.start,params.end,params.tail,params.flight,params.source):
+            count += 1
+            if not params.count:
+                print(topic,payload.decode('utf-8','replace'))
+        print(f"{count} records in {perf_counter() - start:.3f}s")
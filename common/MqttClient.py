@@ -1,14 +1,19 @@
 
 import os
 import random
-import re
 import sys
+from collections import OrderedDict
 from multiprocessing import Event
+from threading import Lock
 from time import sleep, time
 from typing import Callable
 
-from paho.mqtt.client import Client
+from paho.mqtt.client import Client, MQTTv5
 from paho.mqtt.enums import CallbackAPIVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from common.TopicTrie import TopicTrie
 
 import logging
 
@@ -19,18 +24,48 @@ class MqttClient(object) :
     RECONNECT_RATE = 2
     MAX_RECONNECT_COUNT = 12
     MAX_RECONNECT_DELAY = 60
+    SESSION_EXPIRY = 3_600
+    TOPIC_ALIASES = 16
 
 
-    def __init__(self, server: str = "localhost", port: int = 1883,user:str=None,passwd:str=None,clientID:str=None,) :
+    def __init__(self, server: str = "localhost", port: int = 1883,user:str=None,passwd:str=None,clientID:str=None,
+                 protocol:int=MQTTv5,shareGroup:str=None,topicAliases:int=TOPIC_ALIASES,compressor=None) :
         # keep the server and port information
         self.server = server
         self.port = port
+        self.protocol = protocol
+
+        # subscriptions are made as $share/<shareGroup>/<topic>, the broker
+        # splits the messages between the clients of the group
+        self.shareGroup = shareGroup
+
+        # MQTT v5 topic aliases, repeated publishes to a topic carry a 2 byte
+        # alias instead of the topic.  Aliases only live as long as the
+        # connection, aliasMax is the broker's limit for the current one
+        self.topicAliases = topicAliases if protocol == MQTTv5 else 0
+        self.aliasLock = Lock()
+        self.aliasMax = 0
+        self.aliasesOut = OrderedDict()
+        self.aliasesIn = {}
+        self.aliasSaved = {}
+
+        # Compression.Compressor, payloads are compressed with a dictionary
+        # shared with the server
+        self.compressor = compressor
 
         # create the client instance (that does most of the work)
-        self.mqClient = Client(callback_api_version=CallbackAPIVersion.VERSION2,
-                               userdata=self,
-                               clean_session=False,
-                               client_id=clientID)
+        if protocol == MQTTv5:
+            # MQTT v5 has no clean_session, the session is kept by
+            # connecting with clean_start=False and a session expiry
+            self.mqClient = Client(callback_api_version=CallbackAPIVersion.VERSION2,
+                                   userdata=self,
+                                   protocol=MQTTv5,
+                                   client_id=clientID)
+        else:
+            self.mqClient = Client(callback_api_version=CallbackAPIVersion.VERSION2,
+                                   userdata=self,
+                                   clean_session=False,
+                                   client_id=clientID)
 
         if (user is not None) :
             self.mqClient.username_pw_set(user,passwd)
@@ -45,8 +80,9 @@ class MqttClient(object) :
         self.subMsgCount = 0
         self.pubMsgCount = 0
         self.subRxCount  = 0
+        self.connects = 0
         self.abort = Event()
-        self.topics = {}
+        self.topics = TopicTrie()
 
     def onConnect(self,client:Client,flags,rc,prop) :
         if rc == 0:
@@ -57,6 +93,9 @@ class MqttClient(object) :
     @staticmethod
     def _onConnect(client, ud, flags, rc, prop) :
         #logger.info(f"Connected to MQTT Broker @ {ud.server}:{ud.port}")
+        ud.resetAliases(prop if rc == 0 else None)
+        if rc == 0:
+            ud.connects += 1
         if hasattr(ud,'onConnect') :
             ud.onConnect(client,flags,rc,prop)
 
@@ -66,6 +105,7 @@ class MqttClient(object) :
     @staticmethod
     def _onDisconnect(client, ud, flags, rc, p):
         logger.info(f"Disconnecting from {ud.server}")
+        ud.resetAliases(None)
         if hasattr(ud, 'onDisconnect') :
             ud.onDisconnect(client,flags,rc,p)
 
@@ -100,21 +140,42 @@ class MqttClient(object) :
         if hasattr(ud,'onMessage') :
             ud.onMessage(client,msg)
 
+    def resetAliases(self,props) -> None :
+        with self.aliasLock:
+            self.aliasesOut.clear()
+            self.aliasesIn.clear()
+            self.aliasMax = min(getattr(props,'TopicAliasMaximum',0),self.topicAliases)
+
+    def resolveAlias(self,msg) -> None :
+        # paho leaves the topic of an aliased message empty
+        alias = getattr(getattr(msg,'properties',None),'TopicAlias',None)
+        if alias is not None:
+            if len(msg._topic) > 0:
+                self.aliasesIn[alias] = msg._topic
+            else:
+                msg._topic = self.aliasesIn.get(alias,b'')
+
     def onMessage(self,client:Client,msg) :
         self.subRxCount += 1
-        logger.info(f"Message received: {msg.payload.decode('utf-8')}")
+        self.resolveAlias(msg)
+        logger.info(f"Message received: {msg.payload}")
 
-        for k in self.topics:
-            pat,usrFunc,usrData = self.topics[k]
-            m = pat.match(msg.topic)
-            if m is not None:
-                if usrFunc is not None:
-                    usrFunc(msg, usrData)
-                    self.subMsgCount += 1
+        for usrFunc,usrData in self.topics.match(msg.topic):
+            if usrFunc is not None:
+                usrFunc(msg, usrData)
+                self.subMsgCount += 1
 
 
     def doConnect(self,srvr:str,port:int) -> bool :
-        if self.mqClient.connect(host=self.server, port=self.port) != 0:
+        if self.protocol == MQTTv5:
+            props = Properties(PacketTypes.CONNECT)
+            props.SessionExpiryInterval = self.SESSION_EXPIRY
+            if self.topicAliases > 0:
+                props.TopicAliasMaximum = self.topicAliases
+            rc = self.mqClient.connect(host=self.server, port=self.port, clean_start=False, properties=props)
+        else:
+            rc = self.mqClient.connect(host=self.server, port=self.port)
+        if rc != 0:
             logger.error(f"Couldn't connect to the mqtt broker on port {self.port}")
             return False
         return True
@@ -127,23 +188,66 @@ class MqttClient(object) :
             ud.onSubscribe(client,flags,rc,p)
 
 
-    def cvtToRegEx(self,topic:str) -> re.Pattern :
-        tmp = topic
-        tmp = tmp.replace('#',".*")
-        tmp = tmp.replace('+',".*")
-
-        return re.compile(tmp)
-
-    def subscribe(self,topic:str,cb:Callable[[str],None],usrParam) -> None :
+    def subscribe(self,topic:str,cb:Callable[[str],None],usrParam,group:str=None) -> None :
+        # messages of a shared subscription arrive with their own topic, the
+        # handler is registered for the filter without the $share/<group>/
+        if topic.startswith("$share/"):
+            _,group,topic = topic.split('/',2)
+        elif group is None:
+            group = self.shareGroup
 
         if topic not in self.topics :
-            logging.info(f"Adding topic {topic}")
-            res = self.mqClient.subscribe(topic)
-        self.topics[topic] = (self.cvtToRegEx(topic),cb,usrParam)
+            subTopic = topic if group is None else f"$share/{group}/{topic}"
+            logging.info(f"Adding topic {subTopic}")
+            res = self.mqClient.subscribe(subTopic)
+        self.topics.add(topic,(cb,usrParam))
 
-    def publish(self,topic:str,msg,qos:int=0,retain:bool=False) :
+    def publish(self,topic:str,msg,qos:int=0,retain:bool=False,contentType:str=None) :
         self.pubMsgCount += 1
-        self.mqClient.publish(topic,msg,qos,retain)
+        if self.compressor is not None:
+            msg = self.compressor.compress(msg.encode('utf-8') if isinstance(msg,str) else msg)
+
+        props = None
+        if contentType is not None and self.protocol == MQTTv5:
+            props = Properties(PacketTypes.PUBLISH)
+            props.ContentType = contentType
+
+        # only QoS 0 is aliased: paho drops unsent QoS 0 packets on reconnect
+        # but resends QoS 1/2 ones, with an alias the new connection doesn't know
+        if qos > 0 or self.topicAliases == 0:
+            return self.mqClient.publish(topic,msg,qos,retain,properties=props)
+
+        with self.aliasLock:
+            if self.aliasMax == 0:
+                return self.mqClient.publish(topic,msg,qos,retain,properties=props)
+
+            if props is None:
+                props = Properties(PacketTypes.PUBLISH)
+            alias = self.aliasesOut.get(topic)
+            if alias is not None:
+                self.aliasesOut.move_to_end(topic)
+                props.TopicAlias = alias
+                # the topic is replaced by the 3 byte alias property
+                self.aliasSaved[topic] = self.aliasSaved.get(topic,0) + len(topic.encode('utf-8')) - 3
+                return self.mqClient.publish("",msg,qos,retain,properties=props)
+
+            # new topic, take a free alias or the least recently used one
+            if len(self.aliasesOut) < self.aliasMax:
+                alias = len(self.aliasesOut) + 1
+            else:
+                old,alias = self.aliasesOut.popitem(last=False)
+            self.aliasesOut[topic] = alias
+            props.TopicAlias = alias
+            self.aliasSaved[topic] = self.aliasSaved.get(topic,0) - 3
+            return self.mqClient.publish(topic,msg,qos,retain,properties=props)
+
+    def isConnected(self) -> bool :
+        return self.mqClient.is_connected()
+
+    def aliasStats(self) -> dict :
+        # bytes saved by topic aliases per topic, i.e. per flight
+        with self.aliasLock:
+            return dict(self.aliasSaved)
 
     def run(self):
 
@@ -165,6 +269,8 @@ class MqttClient(object) :
 
 
     def terminate(self):
+        if len(self.aliasSaved) > 0:
+            logger.info(f"Topic alias bytes saved: {self.aliasStats()}")
         self.abort.set()
         self.mqClient.disconnect()
         self.mqClient.loop_stop()
@@ -0,0 +1,124 @@
+import logging
+import threading
+from typing import Any, List
+
+logger = logging.getLogger("RingBuffer")
+
+
+class RingBuffer(object) :
+    # Bounded, in-process fan-out buffer.  Each message is stored exactly once
+    # and every consumer reads it through its own Cursor, so adding a sink does
+    # not add another copy (or another pickle) of the message.
+    #
+    # What happens when a consumer falls capacity messages behind is chosen
+    # per cursor: DROP skips it past the overwritten messages (counted in
+    # Cursor.dropped), BLOCK makes put() wait until it has caught up, which
+    # holds up the producer (the MQTT thread, and so the broker) instead of
+    # losing data.
+    DROP = "drop"
+    BLOCK = "block"
+
+    def __init__(self, capacity: int = 8192) :
+        if capacity <= 0:
+            raise ValueError(f"Invalid ring buffer capacity {capacity}")
+
+        self.capacity = capacity
+        self.slots = [None] * capacity
+
+        # sequence number of the next message to be written
+        self.head = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.cursors = []
+        self.blocking = []
+        self.waits = 0
+
+    def full(self) -> bool :
+        # a BLOCK cursor would lose the oldest message on the next put
+        return not self.closed and any(self.head - c.pos >= self.capacity for c in self.blocking)
+
+    def put(self, item: Any) -> None :
+        self.putMany([item])
+
+    def putMany(self, items: List[Any]) -> None :
+        if len(items) == 0:
+            return
+
+        with self.cond:
+            for item in items:
+                if len(self.blocking) > 0 and self.full():
+                    self.waits += 1
+                    self.cond.notify_all()
+                    self.cond.wait_for(lambda: not self.full())
+                self.slots[self.head % self.capacity] = item
+                self.head += 1
+            self.cond.notify_all()
+
+    def cursor(self, name: str = None, overrun: str = DROP) -> "Cursor" :
+        if overrun not in (self.DROP, self.BLOCK):
+            raise ValueError(f"Invalid overrun policy {overrun}")
+
+        with self.cond:
+            cur = Cursor(self, name, self.head, overrun)
+            self.cursors.append(cur)
+            if overrun == self.BLOCK:
+                self.blocking.append(cur)
+        return cur
+
+    def stats(self) -> dict :
+        with self.cond:
+            return {"head" : self.head,
+                    "waits" : self.waits,
+                    "cursors" : {c.name : c.stats() for c in self.cursors}}
+
+    def close(self) -> None :
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class Cursor(object) :
+    def __init__(self, ring: RingBuffer, name: str, pos: int, overrun: str = RingBuffer.DROP) :
+        self.ring = ring
+        self.name = name
+        self.pos = pos
+        self.overrun = overrun
+        self.dropped = 0
+
+    def lag(self) -> int :
+        return self.ring.head - self.pos
+
+    def stats(self) -> dict :
+        return {"overrun" : self.overrun,
+                "lag" : self.lag(),
+                "dropped" : self.dropped}
+
+    def get(self, maxItems: int = 256, timeout: float = 3.0) -> List[Any] :
+        # Returns up to maxItems messages, waiting at most timeout seconds for
+        # the first one.  An empty list means timeout (or buffer closed).
+        ring = self.ring
+        with ring.cond:
+            if ring.head == self.pos and not ring.closed:
+                ring.cond.wait_for(lambda: ring.head != self.pos or ring.closed, timeout)
+
+            # slow consumer, the oldest messages have already been overwritten
+            if ring.head - self.pos > ring.capacity:
+                skipped = ring.head - self.pos - ring.capacity
+                self.dropped += skipped
+                self.pos = ring.head - ring.capacity
+                logger.warning(f"Cursor {self.name} overrun, dropped {skipped} messages")
+
+            count = min(ring.head - self.pos, maxItems)
+            start = self.pos % ring.capacity
+            end = start + count
+            if end <= ring.capacity:
+                batch = ring.slots[start:end]
+            else:
+                batch = ring.slots[start:] + ring.slots[:end - ring.capacity]
+            self.pos += count
+
+            # room for a producer waiting on this cursor
+            if count > 0 and self.overrun == RingBuffer.BLOCK:
+                ring.cond.notify_all()
+
+        return batch
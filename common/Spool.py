@@ -0,0 +1,265 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from time import monotonic, sleep
+from typing import List, Tuple
+
+logger = logging.getLogger("Spool")
+
+
+class Segment(object) :
+    # One preallocated, memory-mapped spool file.  Records are stored as
+    # <length:u32><crc32:u32><data>; a zero length marks the end of the data.
+    HEADER = struct.Struct("<II")
+
+    def __init__(self,path:str,segId:int,size:int) :
+        self.path = path
+        self.segId = segId
+
+        exists = os.path.exists(path)
+        self.fd = os.open(path,os.O_RDWR | os.O_CREAT,0o644)
+        if not exists or os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd,max(size,os.fstat(self.fd).st_size))
+        self.size = os.fstat(self.fd).st_size
+        self.mm = mmap.mmap(self.fd,self.size)
+        self.end = self.scan() if exists else 0
+
+    def scan(self) -> int :
+        # find the end of the valid records after a restart
+        pos = 0
+        while pos + self.HEADER.size <= self.size:
+            length,crc = self.HEADER.unpack_from(self.mm,pos)
+            start = pos + self.HEADER.size
+            if length == 0 or start + length > self.size:
+                break
+            if zlib.crc32(self.mm[start:start+length]) != crc:
+                logger.warning(f"Spool segment {self.path} corrupt at {pos}, truncating")
+                break
+            pos = start + length
+        return pos
+
+    def free(self) -> int :
+        return self.size - self.end
+
+    def append(self,data:bytes) -> None :
+        self.HEADER.pack_into(self.mm,self.end,len(data),zlib.crc32(data))
+        start = self.end + self.HEADER.size
+        self.mm[start:start+len(data)] = data
+        self.end = start + len(data)
+        # end marker, the file may be reused garbage after a crash
+        if self.end + self.HEADER.size <= self.size:
+            self.HEADER.pack_into(self.mm,self.end,0,0)
+
+    def read(self,pos:int) -> Tuple[bytes,int] :
+        length,crc = self.HEADER.unpack_from(self.mm,pos)
+        start = pos + self.HEADER.size
+        return self.mm[start:start+length],start + length
+
+    def close(self) -> None :
+        self.mm.flush()
+        self.mm.close()
+        os.close(self.fd)
+
+    def remove(self) -> None :
+        self.mm.close()
+        os.close(self.fd)
+        os.remove(self.path)
+
+
+class Spool(object) :
+    # Segmented, append-only on-disk queue.  Writers append(), a single
+    # consumer read()s records and ack()s them once they are safely
+    # delivered; fully acknowledged segments are deleted.  The acknowledged
+    # position is persisted so a restart resumes where delivery stopped.
+    #
+    # With maxBytes set the oldest segments are evicted when the spool grows
+    # past that size.
+    SEGMENT_RE = re.compile(r"seg_(?P<ID>\d+)\.spool$")
+    HEADER = Segment.HEADER
+
+    def __init__(self,directory:str,segmentSize:int = 16*1024*1024,maxBytes:int = None) :
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+
+        os.makedirs(directory,exist_ok=True)
+        self.ackFile = os.path.join(directory,"ack")
+
+        self.segments = []
+        ids = []
+        for fname in os.listdir(directory):
+            m = self.SEGMENT_RE.match(fname)
+            if m is not None:
+                ids.append(int(m.group("ID")))
+        for segId in sorted(ids):
+            self.segments.append(Segment(self.segmentPath(segId),segId,segmentSize))
+
+        # read cursor: (segment id, offset), also the last acknowledged position
+        self.ackPos = self.loadAck()
+        self.readPos = self.ackPos
+        self.dropSegments()
+
+        self.appended = 0
+        self.acked = 0
+        self.evicted = 0
+
+        if len(self.segments) > 0:
+            logger.info(f"Spool {directory} recovered {len(self.segments)} segments, {self.pendingBytes()} bytes pending")
+
+    def segmentPath(self,segId:int) -> str :
+        return os.path.join(self.directory,f"seg_{segId:012d}.spool")
+
+    def loadAck(self) -> Tuple[int,int] :
+        try:
+            with open(self.ackFile) as f:
+                segId,offset = f.read().split()
+                return int(segId),int(offset)
+        except (FileNotFoundError,ValueError):
+            pass
+
+        if len(self.segments) > 0:
+            return self.segments[0].segId,0
+        return 0,0
+
+    def saveAck(self) -> None :
+        tmp = self.ackFile + ".tmp"
+        with open(tmp,"w") as f:
+            f.write(f"{self.ackPos[0]} {self.ackPos[1]}")
+        os.replace(tmp,self.ackFile)
+
+    def dropSegments(self) -> None :
+        # delete segments that lie completely before the acknowledged position
+        while len(self.segments) > 0:
+            seg = self.segments[0]
+            if seg.segId > self.ackPos[0]:
+                break
+            if seg.segId == self.ackPos[0]:
+                if self.ackPos[1] < seg.end:
+                    break
+                self.ackPos = (seg.segId + 1,0)
+                if self.readPos < self.ackPos:
+                    self.readPos = self.ackPos
+            self.segments.pop(0).remove()
+
+    def pendingBytes(self) -> int :
+        total = 0
+        for seg in self.segments:
+            total += seg.end
+            if seg.segId == self.ackPos[0]:
+                total -= self.ackPos[1]
+        return total
+
+    def isEmpty(self) -> bool :
+        with self.lock:
+            return self.atEnd(self.ackPos)
+
+    def atEnd(self,pos:Tuple[int,int]) -> bool :
+        if len(self.segments) == 0:
+            return True
+        last = self.segments[-1]
+        return pos[0] > last.segId or (pos[0] == last.segId and pos[1] >= last.end)
+
+    def append(self,data:bytes) -> None :
+        need = len(data) + 2 * self.HEADER.size
+        with self.lock:
+            if len(self.segments) == 0 or self.segments[-1].free() < need:
+                segId = self.segments[-1].segId + 1 if len(self.segments) > 0 else self.ackPos[0]
+                if len(self.segments) > 0:
+                    self.segments[-1].mm.flush()
+                self.segments.append(Segment(self.segmentPath(segId),segId,max(self.segmentSize,need)))
+
+            self.segments[-1].append(data)
+            self.appended += 1
+
+            if self.maxBytes is not None:
+                self.evict()
+
+    def evict(self) -> None :
+        # oldest first, never the segment being written
+        while len(self.segments) > 1 and self.pendingBytes() > self.maxBytes:
+            seg = self.segments.pop(0)
+            logger.warning(f"Spool {self.directory} full, evicting {seg.path}")
+            self.evicted += 1
+            nxt = (self.segments[0].segId,0)
+            if self.ackPos < nxt:
+                self.ackPos = nxt
+            if self.readPos < nxt:
+                self.readPos = nxt
+            seg.remove()
+            self.saveAck()
+
+    def read(self,maxBytes:int = 1024*1024,maxRecords:int = None) -> Tuple[List[bytes],Tuple[int,int]] :
+        # returns records after the last read and the position to ack()
+        # once they have been delivered
+        records = []
+        size = 0
+        with self.lock:
+            pos = self.readPos
+            segs = {s.segId : s for s in self.segments}
+            while not self.atEnd(pos):
+                seg = segs.get(pos[0])
+                if seg is None or pos[1] >= seg.end:
+                    pos = (pos[0] + 1,0)
+                    continue
+                data,nxt = seg.read(pos[1])
+                if len(records) > 0 and size + len(data) > maxBytes:
+                    break
+                records.append(data)
+                size += len(data)
+                pos = (pos[0],nxt)
+                if maxRecords is not None and len(records) >= maxRecords:
+                    break
+            self.readPos = pos
+        return records,pos
+
+    def rewind(self) -> None :
+        # delivery failed, the next read() starts at the last ack again
+        with self.lock:
+            self.readPos = self.ackPos
+
+    def ack(self,pos:Tuple[int,int],count:int = 0) -> None :
+        with self.lock:
+            if pos <= self.ackPos:
+                return
+            self.ackPos = pos
+            self.acked += count
+            self.dropSegments()
+            self.saveAck()
+
+    def stats(self) -> dict :
+        with self.lock:
+            return {"segments" : len(self.segments),
+                    "pendingBytes" : self.pendingBytes(),
+                    "appended" : self.appended,
+                    "acked" : self.acked,
+                    "evictedSegments" : self.evicted}
+
+    def close(self) -> None :
+        with self.lock:
+            for seg in self.segments:
+                seg.close()
+            self.segments = []
+
+
+class TokenBucket(object) :
+    # Simple rate limiter, take() blocks until enough tokens are available
+    def __init__(self,rate:float,burst:float = None) :
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.last = monotonic()
+
+    def take(self,n:float) -> None :
+        while True:
+            now = monotonic()
+            self.tokens = min(self.burst,self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= min(n,self.burst):
+                self.tokens -= n
+                return
+            sleep((min(n,self.burst) - self.tokens) / self.rate)
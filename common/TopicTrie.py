@@ -0,0 +1,202 @@
+import logging
+import random
+import re
+import sys
+import threading
+from collections import OrderedDict
+from time import perf_counter
+from typing import Any, List, Tuple
+
+logger = logging.getLogger("TopicTrie")
+
+
+class TrieNode(object) :
+    __slots__ = ("children","value","seq")
+
+    def __init__(self) :
+        self.children = {}
+        self.value = None
+        self.seq = None
+
+
+class TopicTrie(object) :
+    # MQTT topic filters keyed by level, '+' matches exactly one level and
+    # '#' the parent level and everything below it.  Wildcards at the first
+    # level don't match '$' topics ($SYS...).  match() walks the trie once per
+    # topic level whatever the number of filters; the results of recently
+    # seen topics are kept in an LRU cache that is reset on add/remove.
+    # MqttClient subscribes from the caller's thread while its network thread
+    # is already matching, so add/remove/match and the cache share a lock.
+    CACHE_SIZE = 4_096
+
+    def __init__(self,cacheSize:int=CACHE_SIZE) :
+        self.root = TrieNode()
+        self.filters = {}
+        self.seq = 0
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def validate(topicFilter:str) -> List[str] :
+        levels = topicFilter.split('/')
+        for i,lvl in enumerate(levels):
+            if lvl == '#':
+                if i != len(levels) - 1:
+                    raise ValueError(f"'#' must be the last level of {topicFilter}")
+            elif lvl != '+' and ('#' in lvl or '+' in lvl):
+                raise ValueError(f"Wildcard must occupy a whole level in {topicFilter}")
+        return levels
+
+    def add(self,topicFilter:str,value:Any) -> None :
+        levels = self.validate(topicFilter)
+        with self.lock:
+            node = self.root
+            for lvl in levels:
+                child = node.children.get(lvl)
+                if child is None:
+                    child = node.children[lvl] = TrieNode()
+                node = child
+
+            # re-subscribing replaces the handler but keeps the dispatch order
+            if node.seq is None:
+                node.seq = self.seq
+                self.seq += 1
+            node.value = value
+            self.filters[topicFilter] = node
+            self.cache.clear()
+
+    def remove(self,topicFilter:str) -> bool :
+        with self.lock:
+            if topicFilter not in self.filters:
+                return False
+
+            path = [self.root]
+            for lvl in topicFilter.split('/'):
+                path.append(path[-1].children[lvl])
+            node = path[-1]
+            node.value = None
+            node.seq = None
+            del self.filters[topicFilter]
+
+            # prune the branch that no longer leads to a filter
+            for parent,lvl,child in zip(reversed(path[:-1]),reversed(topicFilter.split('/')),reversed(path[1:])):
+                if child.seq is not None or len(child.children) > 0:
+                    break
+                del parent.children[lvl]
+
+            self.cache.clear()
+            return True
+
+    def __contains__(self,topicFilter:str) -> bool :
+        return topicFilter in self.filters
+
+    def __len__(self) -> int :
+        return len(self.filters)
+
+    def lookup(self,levels:List[str]) -> Tuple :
+        found = []
+        nodes = [self.root]
+        for i,lvl in enumerate(levels):
+            nxt = []
+            for node in nodes:
+                if len(node.children) == 0:
+                    continue
+                wild = not (i == 0 and lvl.startswith('$'))
+                if wild:
+                    multi = node.children.get('#')
+                    if multi is not None and multi.seq is not None:
+                        found.append(multi)
+                child = node.children.get(lvl)
+                if child is not None:
+                    nxt.append(child)
+                if wild:
+                    child = node.children.get('+')
+                    if child is not None:
+                        nxt.append(child)
+            nodes = nxt
+            if len(nodes) == 0:
+                break
+        else:
+            for node in nodes:
+                if node.seq is not None:
+                    found.append(node)
+                # 'a/#' also matches 'a'
+                multi = node.children.get('#')
+                if multi is not None and multi.seq is not None:
+                    found.append(multi)
+
+        if len(found) > 1:
+            found.sort(key=lambda n: n.seq)
+        return tuple(n.value for n in found)
+
+    def match(self,topic:str) -> Tuple :
+        with self.lock:
+            res = self.cache.get(topic)
+            if res is not None:
+                self.cache.move_to_end(topic)
+                self.hits += 1
+                return res
+
+            self.misses += 1
+            res = self.lookup(topic.split('/'))
+            self.cache[topic] = res
+            if len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+            return res
+
+    def stats(self) -> dict :
+        return {"filters" : len(self.filters),
+                "cached" : len(self.cache),
+                "hits" : self.hits,
+                "misses" : self.misses}
+
+
+
+def benchmark(subscriptions:int=1_000,messages:int=100_000) -> None :
+    # fleet of aircraft, one filter per tail plus the server's wildcards,
+    # against the regex scan MqttClient.onMessage used to do
+    rnd = random.Random(7)
+    tails = [f"N{i:03d}DQ" for i in range(subscriptions)]
+    filters = [f"Delta/{t}/+/MSI" for t in tails] + ["Delta/+/+/MSI","Delta/+/+/DSS","Delta/+/+/UI"]
+    flights = {t : f"DL{rnd.randint(1,2_000)}" for t in tails}
+    topics = []
+    for i in range(messages):
+        t = rnd.choice(tails)
+        topics.append(f"Delta/{t}/{flights[t]}/{rnd.choice(['MSI','DSS','UI'])}")
+
+    regexes = [re.compile("^" + f.replace('+',"[^/]*").replace('#',".*") + "$") for f in filters]
+    start = perf_counter()
+    count = 0
+    for topic in topics[:messages // 100]:
+        for pat in regexes:
+            if pat.match(topic) is not None:
+                count += 1
+    regexTime = (perf_counter() - start) / (messages // 100)
+
+    trie = TopicTrie()
+    for f in filters:
+        trie.add(f,f)
+    start = perf_counter()
+    for topic in topics:
+        trie.match(topic)
+    trieTime = (perf_counter() - start) / messages
+
+    nocache = TopicTrie(cacheSize=0)
+    for f in filters:
+        nocache.add(f,f)
+    start = perf_counter()
+    for topic in topics:
+        nocache.lookup(topic.split('/'))
+    walkTime = (perf_counter() - start) / messages
+
+    print(f"{len(filters)} filters, {messages} messages over {len(set(topics))} topics")
+    print(f"regex scan  {regexTime*1e6:9.2f}us/msg")
+    print(f"trie walk   {walkTime*1e6:9.2f}us/msg ({regexTime/walkTime:6.1f}x)")
+    print(f"trie cached {trieTime*1e6:9.2f}us/msg ({regexTime/trieTime:6.1f}x) {trie.stats()}")
+
+
+if __name__ == "__main__" :
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000)
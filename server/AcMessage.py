@@ -0,0 +1,52 @@
+import logging
+from datetime import datetime, timezone
+from types import MappingProxyType
+
+logger = logging.getLogger("AcMessage")
+
+
+def parseTime(ts) -> [datetime,None] :
+    if ts is None or isinstance(ts,datetime):
+        return ts
+
+    try:
+        dt = datetime.fromisoformat(ts)
+    except (TypeError,ValueError):
+        logger.warning(f"Invalid timestamp {ts}")
+        return None
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+class AcMessage(object) :
+    # Immutable, decoded aircraft message.  Built once by the server decode
+    # stage and shared by reference with every sink.
+    __slots__ = ("topic","regNum","fltNum","source","timestamp","headerTime","header","data")
+
+    def __init__(self,topic:str,payload:dict) :
+        tpc = topic.split('/')
+        tpc += [None] * (4 - len(tpc))
+
+        header = payload.get('header') or {}
+        data = payload.get('data') or {}
+
+        setter = object.__setattr__
+        setter(self,"topic",topic)
+        setter(self,"regNum",tpc[1])
+        setter(self,"fltNum",tpc[2])
+        setter(self,"source",tpc[3])
+        setter(self,"header",MappingProxyType(header))
+        setter(self,"data",MappingProxyType(data))
+        setter(self,"headerTime",parseTime(header.get('timestamp')))
+        setter(self,"timestamp",parseTime(data.get('timestamp')))
+
+    def __setattr__(self,key,value) :
+        raise AttributeError(f"AcMessage is immutable, cannot set {key}")
+
+    def __delattr__(self,key) :
+        raise AttributeError(f"AcMessage is immutable, cannot delete {key}")
+
+    def __repr__(self) :
+        return f"AcMessage({self.topic},{self.timestamp})"
@@ -0,0 +1,222 @@
+import logging
+import threading
+from collections import Counter, deque
+from time import monotonic
+from typing import Callable
+
+logger = logging.getLogger("AdaptiveBatcher")
+
+
+class AdaptiveBatcher(object) :
+    # Collects line protocol and hands it to flushFunc in batches.
+    #
+    # A batch is flushed when it reaches batchSize lines ("size"), when
+    # waiting any longer would push the oldest line past the latency budget
+    # ("latency") or on close ("close").  Hitting the size limit means
+    # traffic is high so batchSize doubles, latency flushes of mostly empty
+    # batches halve it again.
+    #
+    # A request never carries more than batchSize lines or maxBytes, what is
+    # pending beyond that goes in the following requests.  Once maxPending
+    # bytes are waiting (the server stalled) add() blocks until the flusher
+    # caught up, which holds up the sink and so the broker.
+    SHRINK_RATIO = 0.25
+    PENDING_REQUESTS = 16
+
+    def __init__(self,flushFunc:Callable[[bytes],bool],
+                 latencyMs:int = 500,
+                 minBatch:int = 50,
+                 maxBatch:int = 10_000,
+                 maxBytes:int = 4*1024*1024,
+                 maxPending:int = None,
+                 name:str = "") :
+        self.flushFunc = flushFunc
+        self.latency = latencyMs / 1000.0
+        self.minBatch = minBatch
+        self.maxBatch = maxBatch
+        self.maxBytes = maxBytes
+        self.maxPending = maxPending if maxPending is not None else self.PENDING_REQUESTS * maxBytes
+        self.name = name
+
+        self.batchSize = minBatch
+        # (line protocol, lines)
+        self.pending = deque()
+        self.pendingLines = 0
+        self.pendingBytes = 0
+        self.oldest = None
+
+        # smoothed duration of a flush, used to flush before the budget is hit
+        self.flushTime = 0.0
+
+        self.sizes = Counter()
+        self.reasons = Counter()
+        self.requests = 0
+        self.failures = 0
+        self.totalBytes = 0
+        self.minBytes = None
+        self.maxBytesSent = 0
+        self.blocked = 0
+
+        self.cond = threading.Condition()
+        self.flushLock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run,name=f"batcher-{name}",daemon=True)
+        self.thread.start()
+
+    def settings(self) -> dict :
+        return {"latencyMs" : int(self.latency * 1000),
+                "minBatch" : self.minBatch,
+                "maxBatch" : self.maxBatch,
+                "maxBytes" : self.maxBytes,
+                "maxPending" : self.maxPending,
+                "batchSize" : self.batchSize}
+
+    def stats(self) -> dict :
+        with self.cond:
+            return {"batchSize" : self.batchSize,
+                    "requests" : self.requests,
+                    "failures" : self.failures,
+                    "pendingLines" : self.pendingLines,
+                    "pendingBytes" : self.pendingBytes,
+                    "blocked" : self.blocked,
+                    # histogram keyed by the power of 2 upper bound of the batch
+                    "batchSizes" : dict(sorted(self.sizes.items())),
+                    "flushReasons" : dict(self.reasons),
+                    "bytesPerRequest" : {"min" : self.minBytes or 0,
+                                         "max" : self.maxBytesSent,
+                                         "avg" : self.totalBytes // self.requests if self.requests else 0},
+                    "flushTimeMs" : round(self.flushTime * 1000,1)}
+
+    def add(self,data:bytes,lines:int=None) -> None :
+        if len(data) == 0:
+            return
+        if lines is None:
+            lines = data.count(b'\n') + 1
+
+        with self.cond:
+            if self.pendingBytes >= self.maxPending and self.running:
+                self.blocked += 1
+                logger.warning(f"Batcher {self.name} has {self.pendingBytes} bytes pending, waiting for the server")
+                self.cond.notify()
+                self.cond.wait_for(lambda: self.pendingBytes < self.maxPending or not self.running)
+
+            first = self.oldest is None
+            if first:
+                self.oldest = monotonic()
+            self.pending.append((data,lines))
+            self.pendingLines += lines
+            self.pendingBytes += len(data)
+
+            # wake the flusher to start the latency clock or flush a full batch
+            if first or self.pendingLines >= self.batchSize or self.pendingBytes >= self.maxBytes:
+                self.cond.notify()
+
+    def deadline(self) -> [float,None] :
+        if self.oldest is None:
+            return None
+        return self.oldest + self.latency - self.flushTime
+
+    def take(self) :
+        # the oldest pending lines, at most batchSize lines and maxBytes
+        parts = []
+        lines = 0
+        size = 0
+        pending = self.pending
+        while len(pending) > 0 and lines < self.batchSize:
+            data,n = pending[0]
+            if lines + n <= self.batchSize and size + len(data) <= self.maxBytes:
+                pending.popleft()
+            else:
+                # split the chunk at a line, at least one line goes
+                rows = data.split(b'\n')
+                count = 0
+                used = 0
+                for row in rows:
+                    if count > 0 or len(parts) > 0:
+                        if lines + count >= self.batchSize or size + used + len(row) + 1 > self.maxBytes:
+                            break
+                    count += 1
+                    used += len(row) + 1
+                if count == 0:
+                    break
+                data = b'\n'.join(rows[:count])
+                n = count
+                if count < len(rows):
+                    pending[0] = (b'\n'.join(rows[count:]),len(rows) - count)
+                else:
+                    pending.popleft()
+            parts.append(data)
+            lines += n
+            size += len(data) + 1
+
+        self.pendingLines -= lines
+        self.pendingBytes -= sum(len(p) for p in parts)
+        if len(pending) == 0:
+            self.pendingLines = 0
+            self.pendingBytes = 0
+            self.oldest = None
+        # room for an add() waiting on maxPending
+        self.cond.notify_all()
+        return b'\n'.join(parts),lines
+
+    def flush(self,reason:str) -> None :
+        with self.flushLock:
+            with self.cond:
+                if self.pendingLines == 0:
+                    return
+                data,lines = self.take()
+
+            start = monotonic()
+            ok = False
+            try:
+                ok = self.flushFunc(data)
+            except Exception as e:
+                logger.exception(e)
+            elapsed = monotonic() - start
+
+            with self.cond:
+                self.flushTime = elapsed if self.requests == 0 else 0.8 * self.flushTime + 0.2 * elapsed
+                self.requests += 1
+                self.failures += 0 if ok else 1
+                self.reasons[reason] += 1
+                self.sizes[1 << (lines - 1).bit_length()] += 1
+                self.totalBytes += len(data)
+                self.minBytes = len(data) if self.minBytes is None else min(self.minBytes,len(data))
+                self.maxBytesSent = max(self.maxBytesSent,len(data))
+                self.adapt(reason,lines)
+
+    def adapt(self,reason:str,lines:int) -> None :
+        old = self.batchSize
+        if reason == "size":
+            self.batchSize = min(self.maxBatch,self.batchSize * 2)
+        elif reason == "latency" and lines < self.batchSize * self.SHRINK_RATIO:
+            self.batchSize = max(self.minBatch,self.batchSize // 2)
+
+        if old != self.batchSize:
+            logger.debug(f"Batcher {self.name} batch size {old} -> {self.batchSize}")
+
+    def run(self) -> None :
+        while True:
+            with self.cond:
+                while self.running:
+                    if self.pendingLines >= self.batchSize or self.pendingBytes >= self.maxBytes:
+                        reason = "size"
+                        break
+                    dl = self.deadline()
+                    if dl is not None and monotonic() >= dl:
+                        reason = "latency"
+                        break
+                    self.cond.wait(None if dl is None else max(0.0,dl - monotonic()))
+                else:
+                    break
+            self.flush(reason)
+
+        while self.pendingLines > 0:
+            self.flush("close")
+
+    def close(self) -> None :
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+        logger.info(f"Batcher {self.name} stats: {self.stats()}")
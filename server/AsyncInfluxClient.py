@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+
+from influxdb_client import WritePrecision
+from influxdb_client.rest import ApiException
+
+from common.Spool import Spool
+
+try:
+    # needs aiohttp
+    from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+except ImportError:
+    InfluxDBClientAsync = None
+
+logger = logging.getLogger("AsyncInfluxClient")
+
+
+class AsyncInfluxClient(object) :
+    # InfluxDB writer for the asyncio engine.  Writes go over one pooled
+    # aiohttp session; failed batches are spooled to disk like InfluxClient
+    # and replayed by a background task at a limited rate.
+    RETRY_DELAY = 5
+    REPLAY_BYTES = 4*1024*1024
+
+    def __init__(self,serverUrl:str,
+                 bucket:str,
+                 org:str = "",
+                 token:str = os.getenv("INFLUXDB_TOKEN"),
+                 poolSize:int = 16,
+                 spoolDir:str = None,
+                 replayRate:int = 5_000,
+                 writeSlots:asyncio.Semaphore = None) :
+        if InfluxDBClientAsync is None:
+            raise RuntimeError("asyncio engine needs the aiohttp package")
+
+        self.server = serverUrl
+        self.bucket = bucket
+        self.org = org
+        self.apiKey = token
+        self.poolSize = poolSize
+        self.replayRate = replayRate
+        # shared with other writers to limit their concurrent requests
+        self.writeSlots = writeSlots
+
+        self.client = None
+        self.writeApi = None
+        self.online = True
+        self.replayTask = None
+        self.spool = Spool(os.path.join(spoolDir,bucket)) if spoolDir is not None else None
+
+        self.requests = 0
+        self.failures = 0
+        self.bytes = 0
+
+    async def open(self) -> None :
+        self.client = InfluxDBClientAsync(url=self.server, token=self.apiKey, org=self.org,
+                                          connection_pool_maxsize=self.poolSize)
+        self.writeApi = self.client.write_api()
+        if self.spool is not None:
+            self.replayTask = asyncio.create_task(self.replayRun())
+
+    def retryable(self,ex:Exception) -> bool :
+        if isinstance(ex,ApiException) and ex.status is not None:
+            return ex.status == 429 or ex.status >= 500
+        return True
+
+    async def send(self,data:bytes) -> None :
+        if self.writeSlots is None:
+            await self.writeApi.write(bucket=self.bucket, org=self.org, record=data,
+                                      write_precision=WritePrecision.S)
+            return
+
+        async with self.writeSlots:
+            await self.writeApi.write(bucket=self.bucket, org=self.org, record=data,
+                                      write_precision=WritePrecision.S)
+
+    async def writeLines(self,data:bytes) -> bool :
+        if len(data) == 0:
+            return True
+
+        if self.spool is not None and not self.online:
+            self.spool.append(data)
+            return True
+
+        try:
+            await self.send(data)
+            self.requests += 1
+            self.bytes += len(data)
+            return True
+        except Exception as ex:
+            self.failures += 1
+            logger.error(f"Write failure to InfluxDB {self.server}:{self.bucket}: {ex}")
+            if self.spool is not None and self.retryable(ex):
+                self.online = False
+                self.spool.append(data)
+                return True
+
+        return False
+
+    async def replayRun(self) -> None :
+        while True:
+            if self.spool.isEmpty():
+                await asyncio.sleep(1)
+                continue
+
+            if not self.online:
+                try:
+                    alive = await self.client.ping()
+                except Exception:
+                    alive = False
+                if not alive:
+                    await asyncio.sleep(self.RETRY_DELAY)
+                    continue
+                logger.info(f"InfluxDB {self.server} reachable, replaying spool for {self.bucket}")
+                self.online = True
+
+            records,pos = self.spool.read(self.REPLAY_BYTES)
+            if len(records) == 0:
+                await asyncio.sleep(1)
+                continue
+
+            data = b'\n'.join(records)
+            lines = data.count(b'\n') + 1
+            try:
+                await self.send(data)
+                self.spool.ack(pos,len(records))
+            except Exception as ex:
+                self.spool.rewind()
+                if self.retryable(ex):
+                    self.online = False
+                    continue
+                logger.error(f"InfluxDB rejected spooled records, dropping {len(records)}: {ex}")
+                self.spool.ack(pos)
+
+            # keep the replay below replayRate lines/s
+            await asyncio.sleep(lines / self.replayRate)
+
+    def stats(self) -> dict :
+        stats = {"requests" : self.requests,
+                 "failures" : self.failures,
+                 "bytesPerRequest" : self.bytes // self.requests if self.requests else 0}
+        if self.spool is not None:
+            stats['spool'] = self.spool.stats()
+        return stats
+
+    async def close(self) -> None :
+        if self.replayTask is not None:
+            self.replayTask.cancel()
+        if self.client is not None:
+            await self.client.close()
+        if self.spool is not None:
+            self.spool.close()
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+from argparse import Namespace
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from paho.mqtt.client import MQTTMessage
+
+from common.AsyncMqttClient import AsyncMqttClient
+from AcMessage import AcMessage
+from InfluxMqttServer import InfluxMqttServer
+
+logger = logging.getLogger("AsyncServer")
+
+
+class AsyncSink(object) :
+    def __init__(self,name:str,func:Callable,client,batch:bool,lane:str,maxBatch:int,highWater:int,lowWater:int) :
+        self.name = name
+        self.func = func
+        self.client = client
+        self.batch = batch
+        self.lane = lane
+        self.maxBatch = maxBatch
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.msgs = deque()
+        self.ready = asyncio.Event()
+        self.task = None
+
+        # blocking sinks get a thread of their own so they stay in order
+        # without holding up the event loop
+        self.isAsync = asyncio.iscoroutinefunction(func)
+        self.executor = None if self.isAsync else ThreadPoolExecutor(1,thread_name_prefix=name)
+
+
+class AsyncInfluxMqttServer(InfluxMqttServer) :
+    # InfluxMqttServer on a single asyncio event loop: the MQTT socket, the
+    # Influx writes and the sink scheduling all run on the loop.  When a sink
+    # falls HIGH_WATER messages behind, reading from the broker is paused
+    # until every sink is back under LOW_WATER.  Backfill sinks may fall much
+    # further behind before they hold up the broker.
+    HIGH_WATER = 20_000
+    LOW_WATER = 5_000
+    BACKFILL_HIGH_WATER = 200_000
+    BACKFILL_LOW_WATER = 50_000
+    STATS_INTERVAL = 60
+
+    def __init__(self,sub:AsyncMqttClient) :
+        # no rings, every sink has a queue of its own
+        super(AsyncInfluxMqttServer, self).__init__(sub,capacity=None)
+        self.sinks = {}
+        self.writers = {}
+        self.stopped = None
+
+    def addClient(self,name:str,func:Callable,client,batch:bool=False,lane:str=InfluxMqttServer.LIVE,
+                  maxBatch:int=None,overrun:str=None) :
+        # sinks never drop here, the broker is paused instead whatever overrun
+        if lane == self.BACKFILL:
+            sink = AsyncSink(name,func,client,batch,lane,maxBatch or self.BACKFILL_BATCH,
+                             self.BACKFILL_HIGH_WATER,self.BACKFILL_LOW_WATER)
+        else:
+            sink = AsyncSink(name,func,client,batch,lane,maxBatch or self.MAX_BATCH,self.HIGH_WATER,self.LOW_WATER)
+        self.sinks[name] = sink
+        self.laneSinks[lane] += 1
+        sink.task = asyncio.get_running_loop().create_task(self.sinkRun(sink))
+
+    async def writeToInflux(self,msgs:List[AcMessage],db) :
+        lines = self.encoderFor(db).encodeMsi(msgs)
+        if await db.writeLines(lines):
+            logger.debug(f"Wrote {len(msgs)} Points to InfluxDB")
+
+    async def writePaxData(self,msgs:List[AcMessage],db) :
+        lines = self.encoderFor(db).encodePax(msgs)
+        if await db.writeLines(lines):
+            logger.info(f"Wrote {len(msgs)} Passenger Records to DB")
+
+    def process(self,m:MQTTMessage) :
+        msgs = self.decode(m)
+        if len(msgs) == 0:
+            return
+
+        lanes = dict(zip((self.LIVE,self.BACKFILL),self.classify(msgs)))
+        for sink in self.sinks.values():
+            msgs = lanes[sink.lane]
+            if len(msgs) == 0:
+                continue
+            sink.msgs.extend(msgs)
+            sink.ready.set()
+            if len(sink.msgs) >= sink.highWater:
+                self.mqttClient.pause()
+
+    def checkResume(self) -> None :
+        if self.mqttClient.paused:
+            if all(len(s.msgs) < s.lowWater for s in self.sinks.values()):
+                self.mqttClient.resume()
+
+    @staticmethod
+    def callEach(sink:AsyncSink,batch:List[AcMessage]) -> None :
+        for msg in batch:
+            sink.func(msg,sink.client)
+
+    async def call(self,sink:AsyncSink,batch:List[AcMessage]) -> None :
+        if sink.isAsync:
+            if sink.batch:
+                await sink.func(batch,sink.client)
+            else:
+                for msg in batch:
+                    await sink.func(msg,sink.client)
+        elif sink.batch:
+            await asyncio.get_running_loop().run_in_executor(sink.executor,sink.func,batch,sink.client)
+        else:
+            # one hop to the executor per batch, not per message
+            await asyncio.get_running_loop().run_in_executor(sink.executor,self.callEach,sink,batch)
+
+    async def sinkRun(self,sink:AsyncSink) -> None :
+        await self.startFlag.wait()
+        logger.info(f"Client {sink.name} started")
+
+        while True:
+            if len(sink.msgs) == 0:
+                if self.stopped.is_set():
+                    break
+                sink.ready.clear()
+                await sink.ready.wait()
+                continue
+
+            batch = []
+            while len(sink.msgs) > 0 and len(batch) < sink.maxBatch:
+                batch.append(sink.msgs.popleft())
+            self.checkResume()
+
+            try:
+                await self.call(sink,batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(e)
+
+        logger.info(f"Client {sink.name} exiting")
+
+    async def serve(self,setup:Callable,params:Namespace) -> None :
+        # startFlag is awaited by the sinks, the threading.Event of the base
+        # class can't be
+        self.startFlag = asyncio.Event()
+        self.stopped = asyncio.Event()
+
+        self.writers = await setup(self,params)
+        await self.mqttClient.start()
+        self.subscribe()
+        self.startFlag.set()
+
+        try:
+            while not self.stopped.is_set():
+                try:
+                    await asyncio.wait_for(self.stopped.wait(),self.STATS_INTERVAL)
+                except asyncio.TimeoutError:
+                    for name,writer in self.writers.items():
+                        logger.info(f"{name}: {writer.stats()}")
+                    logger.info(f"Sink backlog: { {n : len(s.msgs) for n,s in self.sinks.items()} }")
+                    logger.info(f"Messages per lane: {self.laneCounts}")
+        finally:
+            await self.shutdown()
+
+    def stop(self) -> None :
+        if self.stopped is not None:
+            self.stopped.set()
+
+    async def shutdown(self) -> None :
+        logger.debug("Terminating MQTT Client/Listener")
+        self.mqttClient.terminate()
+
+        # let the sinks drain what has already been received
+        self.stopped.set()
+        for sink in self.sinks.values():
+            sink.ready.set()
+            await sink.task
+            if sink.executor is not None:
+                sink.executor.shutdown()
+            if hasattr(sink.client,'close'):
+                await sink.client.close()
+            else:
+                sink.client.terminate()
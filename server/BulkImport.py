@@ -0,0 +1,319 @@
+import gzip
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import sys
+from argparse import Namespace, ArgumentParser
+from time import perf_counter, sleep
+from typing import List
+
+from common.ClientLog import SCAN_RE, record
+from common.Compression import loadDictionary
+from InfluxMqttServer import INFLUX_APIKEY, InfluxMqttServer
+from LineProtocol import LineProtocolEncoder
+from ShardedServer import RawMessage
+
+logger = logging.getLogger("BulkImport")
+
+# Backfills recorded client/server logs without a broker or a server: the
+# records are decoded by InfluxMqttServer.decode and encoded to line
+# protocol exactly as its InfluxWriter (MSI, data timestamp) and DssWriter
+# (Passenger, header timestamp, seat points) sinks do, then written to gzip
+# line protocol files (influx write --compression gzip) or straight to
+# InfluxDB in large batches.
+#
+# Every log is imported by one worker process, CHUNK records at a time.
+# After each chunk is written the log offset it ended at is checkpointed to
+# <state>/<log>-<path digest>.ckpt, an import that crashed or was stopped
+# resumes from there (gzip outputs are cut back to their checkpointed size
+# first, each chunk is a gzip member of its own).  The checkpoint also holds
+# the delta decoder's last record per topic, so the deltas right after the
+# resume point are still rebuilt.  Logs of the same name in different
+# directories get their own checkpoints and outputs.
+
+PAX_BUCKET = "Passenger"
+CHUNK = 10_000
+
+
+class GzipSink(object) :
+    def __init__(self,path:str,level:int=6) :
+        self.path = path
+        self.level = level
+        self.f = None
+
+    def open(self,pos:int) -> None :
+        # drops what was written after the checkpoint
+        mode = "r+b" if pos > 0 and os.path.exists(self.path) else "wb"
+        self.f = open(self.path,mode)
+        self.f.truncate(pos)
+        self.f.seek(pos)
+
+    def write(self,data:bytes) -> bool :
+        self.f.write(gzip.compress(data + b'\n',compresslevel=self.level))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return True
+
+    def position(self) -> int :
+        return self.f.tell()
+
+    def close(self) -> None :
+        if self.f is not None:
+            self.f.close()
+
+
+class InfluxSink(object) :
+    # synchronous writes of a whole chunk, the checkpoint only moves on once
+    # InfluxDB took it.  The chunks are the batches, no batcher in between;
+    # what InfluxDB refuses (4xx) isn't retried.
+    RETRIES = 3
+    RETRY_DELAY = 5
+
+    def __init__(self,params:Namespace,bucket:str) :
+        from InfluxClient import InfluxClient
+
+        self.writer = InfluxClient(params.influxServer,bucket,org="Brian Still",token=INFLUX_APIKEY,batched=False)
+
+    def open(self,pos:int) -> None :
+        pass
+
+    def write(self,data:bytes) -> bool :
+        for i in range(self.RETRIES):
+            try:
+                self.writer.send(data)
+                return True
+            except Exception as ex:
+                if not self.writer.retryable(ex):
+                    logger.error(f"InfluxDB {self.writer.bucket} rejected the chunk: {ex}")
+                    return False
+                logger.warning(f"InfluxDB {self.writer.bucket} write failed, attempt {i + 1}: {ex}")
+            if i + 1 < self.RETRIES:
+                sleep(self.RETRY_DELAY * (i + 1))
+        return False
+
+    def position(self) -> int :
+        return 0
+
+    def close(self) -> None :
+        self.writer.terminate()
+
+
+class LogImporter(object) :
+    def __init__(self,fname:str,params:Namespace) :
+        self.fname = fname
+        self.params = params
+        name = self.nameOf(fname)
+        self.statePath = os.path.join(params.stateDir,name + ".ckpt")
+
+        # bucket -> the encoding of the server sink writing to it
+        self.encoding = {params.bucket : "encodeMsi", PAX_BUCKET : "encodePax"}
+        self.encoders = {bucket : LineProtocolEncoder() for bucket in self.encoding}
+        if params.outDir is not None:
+            self.sinks = {bucket : GzipSink(os.path.join(params.outDir,f"{name}.{bucket}.lp.gz"),params.level)
+                          for bucket in self.encoding}
+        else:
+            self.sinks = {bucket : InfluxSink(params,bucket) for bucket in self.encoding}
+
+        self.server = InfluxMqttServer(None)
+        self.state = self.loadState()
+
+    @staticmethod
+    def nameOf(fname:str) -> str :
+        digest = hashlib.sha1(os.path.abspath(fname).encode('utf-8')).hexdigest()[:8]
+        return f"{os.path.basename(fname)}-{digest}"
+
+    def loadState(self) -> dict :
+        try:
+            with open(self.statePath) as f:
+                state = json.load(f)
+            logger.info(f"Resuming {self.fname} at offset {state['offset']}")
+            for topic,(seq,last) in state.pop('deltas',{}).items():
+                self.server.deltas.remember(topic,seq,last)
+            return state
+        except FileNotFoundError:
+            pass
+        except (ValueError,KeyError,TypeError) as e:
+            logger.warning(f"Ignoring invalid checkpoint {self.statePath}: {e}")
+        self.server.deltas.state.clear()
+        return self.newState()
+
+    def newState(self) -> dict :
+        return {"log" : self.fname, "offset" : 0, "records" : 0, "messages" : 0,
+                "lines" : {bucket : 0 for bucket in self.encoding},
+                "outputs" : {bucket : 0 for bucket in self.encoding}}
+
+    def saveState(self) -> None :
+        tmp = self.statePath + ".tmp"
+        state = dict(self.state)
+        state['deltas'] = {topic : [seq,last] for topic,(seq,last) in self.server.deltas.state.items()}
+        with open(tmp,"w") as f:
+            json.dump(state,f,default=str)
+        os.replace(tmp,self.statePath)
+
+    def flush(self,msgs:list,offset:int,records:int) -> None :
+        for bucket,sink in self.sinks.items():
+            data = getattr(self.encoders[bucket],self.encoding[bucket])(msgs)
+            if len(data) == 0:
+                continue
+            if not sink.write(data):
+                raise IOError(f"Unable to write {self.fname} to {bucket}, stopped at offset {self.state['offset']}")
+            self.state['lines'][bucket] += data.count(b'\n') + 1
+            self.state['outputs'][bucket] = sink.position()
+
+        self.state['offset'] = offset
+        self.state['records'] += records
+        self.state['messages'] += len(msgs)
+        self.saveState()
+
+    def run(self) -> dict :
+        start = perf_counter()
+        with open(self.fname,"rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if self.state['offset'] > size:
+                logger.warning(f"{self.fname} is shorter than its checkpoint, importing it again")
+                self.server.deltas.state.clear()
+                self.state = self.newState()
+
+            for bucket,sink in self.sinks.items():
+                sink.open(self.state['outputs'][bucket])
+
+            try:
+                if size > self.state['offset']:
+                    with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as buf:
+                        self.scan(buf)
+            finally:
+                for sink in self.sinks.values():
+                    sink.close()
+
+        stats = dict(self.state)
+        stats['seconds'] = round(perf_counter() - start,2)
+        return stats
+
+    def scan(self,buf) -> None :
+        # up to the last complete line, a log still being written is picked
+        # up from there by the next import
+        end = buf.rfind(b"\n",self.state['offset']) + 1
+        chunk = self.params.chunk
+        msgs = []
+        records = 0
+        for m in SCAN_RE.finditer(buf,self.state['offset'],end):
+            rec = record(m,self.params.synthesize)
+            if rec is None:
+                continue
+            topic,payload,ts = rec
+            msgs.extend(self.server.decode(RawMessage(topic,payload)))
+            records += 1
+            if records >= chunk:
+                self.flush(msgs,m.end(),records)
+                msgs = []
+                records = 0
+
+        if records > 0 or end > self.state['offset']:
+            self.flush(msgs,max(end,self.state['offset']),records)
+
+
+def importMain(fname:str,params:Namespace) -> dict :
+    # runs in the worker process
+    for dictFile in params.dictFiles:
+        loadDictionary(dictFile)
+    try:
+        return LogImporter(fname,params).run()
+    except Exception as e:
+        logger.exception(e)
+        return {"log" : fname, "error" : str(e)}
+
+
+def bulkImport(fnames:List[str],params:Namespace) -> List[dict] :
+    os.makedirs(params.stateDir,exist_ok=True)
+    if params.outDir is not None:
+        os.makedirs(params.outDir,exist_ok=True)
+
+    start = perf_counter()
+    results = []
+    ctx = multiprocessing.get_context("fork" if os.name == "posix" else "spawn")
+    with ctx.Pool(min(params.processes,len(fnames))) as pool:
+        for stats in pool.starmap(importMain,[(fname,params) for fname in fnames],chunksize=1):
+            logger.info(f"Imported {stats}")
+            results.append(stats)
+
+    elapsed = perf_counter() - start
+    records = sum(r.get('records',0) for r in results)
+    logger.info(f"{len(fnames)} logs, {records} records in {elapsed:.1f}s ({records / max(elapsed,1e-6):.0f}/s)")
+    return results
+
+
+def parseCmdLine(args) -> Namespace :
+    parser = ArgumentParser("Import recorded client/server logs into InfluxDB without a broker")
+
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="specify output verbosity")
+
+    parser.add_argument("-o","--out",
+                        dest="outDir",
+                        default=None,
+                        help="Write gzip line protocol files <log>-<path digest>.<bucket>.lp.gz here instead of to InfluxDB")
+
+    parser.add_argument("-i,--influx-server",
+                        dest="influxServer",
+                        default="http://localhost:8086",
+                        help="specify influx server")
+
+    parser.add_argument("-B,--bucket",
+                        dest="bucket",
+                        default="Aircraft",
+                        help="InfluxDB Bucket")
+
+    parser.add_argument("--state",
+                        dest="stateDir",
+                        default="import-state",
+                        help="Checkpoint directory, an import restarted with the same one resumes")
+
+    parser.add_argument("-P","--processes",
+                        dest="processes",
+                        type=int,
+                        default=os.cpu_count(),
+                        help="Logs imported in parallel")
+
+    parser.add_argument("--chunk",
+                        dest="chunk",
+                        type=int,
+                        default=CHUNK,
+                        help="Log records per write and checkpoint")
+
+    parser.add_argument("--level",
+                        dest="level",
+                        type=int,
+                        default=6,
+                        help="gzip compression level")
+
+    parser.add_argument("--synthesize",
+                        dest="synthesize",
+                        action="store_true",
+                        help="Import summary-only log lines as template MSI records (see ClientLog.synthesize)")
+
+    parser.add_argument("--dict",
+                        dest="dictFiles",
+                        nargs="*",
+                        default=[],
+                        help="Trained compression dictionaries the clients may have used")
+
+    parser.add_argument(dest="logs",
+                        nargs="+",
+                        help="Recorded logs to import")
+
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__" :
+    params = parseCmdLine(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO if params.verbose else logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    failed = 0
+    for stats in bulkImport(params.logs,params):
+        print(stats)
+        failed += 1 if 'error' in stats else 0
+    sys.exit(1 if failed > 0 else 0)
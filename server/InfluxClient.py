@@ -1,20 +1,34 @@
 import logging
 import os
+import threading
 from datetime import datetime
 
 from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import ASYNCHRONOUS, WriteOptions
+from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
 
 from common.Client import Client
+from common.Spool import Spool, TokenBucket
+from AdaptiveBatcher import AdaptiveBatcher
 
 logger = logging.getLogger()
 
 class InfluxClient(Client):
+    RETRY_DELAY = 5
+    REPLAY_BYTES = 4*1024*1024
+
     def __init__ (self,serverUrl:str,
                   bucket : str,
                   org : str = "",
-                  token:str = os.getenv("INFLUXDB_TOKEN")) :
-        super(InfluxClient).__init__()
+                  token:str = os.getenv("INFLUXDB_TOKEN"),
+                  latencyMs:int = 500,
+                  minBatch:int = 50,
+                  maxBatch:int = 10_000,
+                  spoolDir:str = None,
+                  replayRate:int = 5_000,
+                  writeSlots:threading.Semaphore = None,
+                  batched:bool = True) :
+        super(InfluxClient, self).__init__()
 
         self.serverUrl = serverUrl
         self.bucket = bucket
@@ -24,9 +38,35 @@ class InfluxClient(Client):
         self.apiKey = token
 
         self.client = InfluxDBClient(url=self.server, token=self.apiKey, org=self.org)
-        self.writeClient = self.client.write_api(write_options=WriteOptions(batch_size=100,flush_interval=60_000),
-                                                 success_callback=lambda a, b: self.writeSuccess(a, b),
-                                                 error_callback=lambda a, b, c: self.writeFail(a, b, c))
+        self.writeClient = self.client.write_api(write_options=SYNCHRONOUS)
+
+        # semaphore shared with other writers to limit their concurrent requests
+        self.writeSlots = writeSlots
+
+        # failed batches go to a disk spool and are replayed, at most
+        # replayRate lines/s, once the server is reachable again
+        self.spool = None
+        self.replayThread = None
+        self.online = threading.Event()
+        self.online.set()
+        self.stopFlag = threading.Event()
+        if spoolDir is not None:
+            self.spool = Spool(os.path.join(spoolDir,bucket))
+            self.replayLimit = TokenBucket(replayRate)
+            self.replayThread = threading.Thread(target=self.replayRun,name=f"replay-{bucket}",daemon=True)
+            self.replayThread.start()
+
+        # batching is done here rather than in the client library so batch
+        # size can follow the traffic and flushes respect a latency budget.
+        # Callers that batch themselves (batched=False) only use send() and
+        # writeBatch().
+        self.batcher = None
+        if batched:
+            self.batcher = AdaptiveBatcher(self.writeBatch,
+                                           latencyMs=latencyMs,
+                                           minBatch=minBatch,
+                                           maxBatch=maxBatch,
+                                           name=bucket)
 
 
     def writeSuccess(self,t,d) :
@@ -35,7 +75,7 @@ class InfluxClient(Client):
 
 
     def writeFail(self,x,y,z) :
-        logger.error(f"Write failure to InfluxDB: {x},{y},{z}")
+        logger.error(f"Write failure to InfluxDB: {x},{len(y)} bytes,{z}")
 
 
 
@@ -53,10 +93,87 @@ class InfluxClient(Client):
             return self.bucket is not None
 
 
+    def retryable(self,ex:Exception) -> bool :
+        # 4xx (other than throttling) means bad data, retrying won't help
+        if isinstance(ex,ApiException) and ex.status is not None:
+            return ex.status == 429 or ex.status >= 500
+        return True
+
+    def send(self,data:bytes) -> None :
+        if self.writeSlots is None:
+            self.writeClient.write(bucket=self.bucket, org=self.org, record=data,
+                                   write_precision=WritePrecision.S)
+            return
+
+        with self.writeSlots:
+            self.writeClient.write(bucket=self.bucket, org=self.org, record=data,
+                                   write_precision=WritePrecision.S)
+
+    def writeBatch(self,data:bytes) -> bool :
+            if self.spool is not None and not self.online.is_set():
+                self.spool.append(data)
+                return True
+
+            try:
+                self.send(data)
+                self.writeSuccess(None,data)
+                return True
+            except Exception as ex:
+                self.writeFail(self.bucket,data,ex)
+                if self.spool is not None and self.retryable(ex):
+                    logger.warning(f"InfluxDB {self.server} unavailable, spooling to disk")
+                    self.online.clear()
+                    self.spool.append(data)
+                    return True
+
+            return False
+
+    def replayRun(self) -> None :
+        while not self.stopFlag.is_set():
+            if self.spool.isEmpty():
+                self.stopFlag.wait(1)
+                continue
+
+            if not self.online.is_set():
+                try:
+                    alive = self.client.ping()
+                except Exception:
+                    alive = False
+                if not alive:
+                    self.stopFlag.wait(self.RETRY_DELAY)
+                    continue
+
+                # live traffic goes straight to the server again while the
+                # backlog drains behind it
+                logger.info(f"InfluxDB {self.server} reachable, replaying spool for {self.bucket}")
+                self.online.set()
+
+            records,pos = self.spool.read(self.REPLAY_BYTES)
+            if len(records) == 0:
+                self.stopFlag.wait(1)
+                continue
+
+            data = b'\n'.join(records)
+            lines = data.count(b'\n') + 1
+            self.replayLimit.take(lines)
+            try:
+                self.send(data)
+                self.spool.ack(pos,len(records))
+                logger.info(f"Replayed {lines} spooled records to {self.server}:{self.bucket}")
+            except Exception as ex:
+                self.spool.rewind()
+                if self.retryable(ex):
+                    logger.warning(f"Replay to {self.server} failed: {ex}")
+                    self.online.clear()
+                else:
+                    # drop what the server refuses so it can't block the spool
+                    logger.error(f"InfluxDB rejected spooled records, dropping {len(records)}: {ex}")
+                    self.spool.ack(pos)
+
     def write(self,ts:datetime,data:Point) -> bool :
 
             try:
-                self.writeClient.write(bucket=self.bucket, org=self.org, record=data)
+                self.batcher.add(data.to_line_protocol(precision=WritePrecision.S).encode('utf-8'),1)
                 return True
             except KeyError as ke:
                 pass
@@ -65,7 +182,27 @@ class InfluxClient(Client):
 
             return False
 
+    def writeLines(self,data:bytes) -> bool :
+            # data is already encoded line protocol with second precision
+            self.batcher.add(data)
+            return True
+
+    def settings(self) -> dict :
+        return self.batcher.settings() if self.batcher is not None else {}
+
+    def stats(self) -> dict :
+        stats = self.batcher.stats() if self.batcher is not None else {}
+        if self.spool is not None:
+            stats['spool'] = self.spool.stats()
+        return stats
+
     def terminate(self) :
+        if self.batcher is not None:
+            self.batcher.close()
+        if self.replayThread is not None:
+            self.stopFlag.set()
+            self.replayThread.join()
+            self.spool.close()
         if self.writeClient is not None :
             self.writeClient.close()
         self.client.close()
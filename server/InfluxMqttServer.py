@@ -4,22 +4,26 @@ import os
 import random
 import sys
 from argparse import Namespace, ArgumentParser
-from datetime import datetime
-from multiprocessing import Queue, Event
-from queue import Empty
-from threading import Thread
+from datetime import datetime, timedelta, timezone
+from threading import BoundedSemaphore, Event, Thread
 
 from time import sleep
-from typing import Callable
+from typing import Callable, List, Tuple
 
-from influxdb_client import Point, WritePrecision
 from influxdb_client.rest import ApiException
 from paho.mqtt.client import MQTTMessage
 from urllib3.exceptions import NewConnectionError
 
+from common import Codec
+from common.Compression import Decompressor, loadDictionary
+from common.DeltaCodec import DeltaDecoder
 from common.KinesisClient import KinesisClient
 from common.MqttClient import MqttClient
+from common.RingBuffer import RingBuffer
 from InfluxClient import InfluxClient
+from AcMessage import AcMessage
+from LineProtocol import LineProtocolEncoder
+from ShardedServer import ShardedServer
 from common.MsiToOcc import transform
 
 
@@ -43,13 +47,43 @@ class InfluxMqttServer (object) :
     RECONNECT_RATE = 2
     MAX_RECONNECT_COUNT = 12
     MAX_RECONNECT_DELAY = 60
-
-    def __init__ (self,sub:MqttClient):
+    RING_CAPACITY = 16_384
+    MAX_BATCH = 500
+    # .../<format> carries a binary payload format in the topic, see Codec
+    TOPICS = ("Delta/+/+/MSI","Delta/+/+/DSS","Delta/+/+/UI",
+              "Delta/+/+/MSI/+","Delta/+/+/DSS/+","Delta/+/+/UI/+")
+
+    # messages whose timestamp is more than BACKFILL_AGE seconds old (history
+    # replayed after an outage) go to the sinks of the backfill lane, when
+    # there are any, so they can't hold up live data
+    LIVE = "live"
+    BACKFILL = "backfill"
+    BACKFILL_AGE = 300
+    BACKFILL_BATCH = 5_000
+
+    def __init__ (self,sub:MqttClient,capacity:[int,None]=RING_CAPACITY):
 
         self.mqttClient = sub
         self.clients = {}
         self.startFlag = Event()
 
+        # every sink reads the same messages through its own cursor, the
+        # backfill lane has a ring of its own.  None for engines that queue
+        # per sink themselves (asyncio)
+        self.ring = None
+        self.rings = {}
+        if capacity is not None:
+            self.ring = RingBuffer(capacity)
+            self.rings = {self.LIVE : self.ring, self.BACKFILL : RingBuffer(4 * capacity)}
+        self.backfillAge = self.BACKFILL_AGE
+        self.laneSinks = {self.LIVE : 0, self.BACKFILL : 0}
+        self.laneCounts = {self.LIVE : 0, self.BACKFILL : 0}
+
+        # one encoder per bucket, they track the field types written to it
+        self.encoders = {}
+        self.deltas = DeltaDecoder()
+        self.decompressor = Decompressor()
+
     def init(self) :
 
         #self.dbase.createBucket("Aircraft")
@@ -59,64 +93,80 @@ class InfluxMqttServer (object) :
         #self.addClient("Influx",self.writeToInflux,self.dbase)
 
         self.mqttClient.run()
-
-        topic = "Delta/+/+/MSI"
-        self.mqttClient.subscribe(topic,lambda m,u: u.process(m),self)
-        self.mqttClient.subscribe("Delta/+/+/DSS",lambda m,u: u.process(m),self)
-        self.mqttClient.subscribe("Delta/+/+/UI",lambda m,u: u.process(m),self)
+        self.subscribe()
 
         self.dss = None
 
-        logger.info(f"Subscribed to: '{topic}'")
-
         self.startFlag.set()
 
-
-    def writePaxData(self,topic:str,payload:dict,db) :
-        pt,ts = self.extractPax(topic,payload)
-        if pt is not None:
-            db.write(ts,pt)
-            logger.info("Wrote Passenger Record to DB")
-
-    def writeToInflux(self,topic:str,payload:dict,db) :
-        pt, ts = self.cvtToPoint(topic, payload)
-        if (pt is not None):
-            db.write(ts, pt)
-            logger.debug(f"Wrote Point to InfluxDB")
-
-    def writeToKinesis(self,topic:str,payload:dict,client) :
-        logger.debug("Writing to Kinesis")
-        toSend  = transform(payload['data'])
-        rsp = client.publish(None,toSend)
-        logger.debug(f"Kinesis: {toSend}")
-        logger.info(f"Published Point to Kinesis {rsp['ResponseMetadata']['HTTPStatusCode']}: {rsp['SequenceNumber']}")
-
-    def addClient(self,name:str,func:Callable,client) :
-        q = Queue()
+    def subscribe(self) :
+        for topic in self.TOPICS:
+            self.mqttClient.subscribe(topic,lambda m,u: u.process(m),self)
+            logger.info(f"Subscribed to: '{topic}'")
+
+
+    def encoderFor(self,db) -> LineProtocolEncoder :
+        enc = self.encoders.get(db.bucket)
+        if enc is None:
+            enc = LineProtocolEncoder()
+            self.encoders[db.bucket] = enc
+        return enc
+
+    def writePaxData(self,msgs:List[AcMessage],db) :
+        lines = self.encoderFor(db).encodePax(msgs)
+        if db.writeLines(lines):
+            logger.info(f"Wrote {len(msgs)} Passenger Records to DB")
+
+    def writeToInflux(self,msgs:List[AcMessage],db) :
+        lines = self.encoderFor(db).encodeMsi(msgs)
+        if db.writeLines(lines):
+            logger.debug(f"Wrote {len(msgs)} Points to InfluxDB")
+
+    def writeToKinesis(self,msgs:List[AcMessage],client) :
+        logger.debug(f"Writing {len(msgs)} records to Kinesis")
+        failed = client.publishBatch(None,[transform(msg.data) for msg in msgs],[msg.regNum for msg in msgs])
+        logger.info(f"Published {len(msgs) - failed} Points to Kinesis, {failed} failed")
+
+    def addClient(self,name:str,func:Callable,client,batch:bool=False,lane:str=LIVE,maxBatch:int=None,
+                  overrun:str=RingBuffer.DROP) :
+        # batch sinks are called once with the list of messages drained from
+        # the ring, others once per AcMessage.  overrun is what happens when
+        # the sink falls a whole ring behind: RingBuffer.DROP loses the oldest
+        # messages (counted as dropped in stats()), RingBuffer.BLOCK stops
+        # taking messages from the broker until the sink caught up.
+        cursor = self.rings[lane].cursor(name,overrun)
+        self.laneSinks[lane] += 1
         evt = Event()
         evt.set()
 
-        thr = Thread(target=self.clientRun,args=(name,q,evt,func,client))
-        self.clients[name] = (thr,q,evt,func,client)
+        if maxBatch is None:
+            maxBatch = self.BACKFILL_BATCH if lane == self.BACKFILL else self.MAX_BATCH
+        thr = Thread(target=self.clientRun,args=(name,cursor,evt,func,client,batch,maxBatch))
+        self.clients[name] = (thr,cursor,evt,func,client)
         thr.start()
 
 
-    def clientRun(self,name:str,msgQ:Queue,runFlag:Event,publish:Callable,client) -> None:
+    def clientRun(self,name:str,cursor,runFlag:Event,publish:Callable,client,batch:bool=False,
+                  maxBatch:int=MAX_BATCH) -> None:
         logger.info(f"Client {name} waiting to start")
         self.startFlag.wait()
-        logger.debug(f"Client {name} started on {msgQ} {runFlag}")
+        logger.debug(f"Client {name} started on {cursor} {runFlag}")
 
         while runFlag.is_set() :
             try:
-                data = msgQ.get(timeout=3)
-                if data is not None:
-                    topic,payload = data
-                    logger.info(f"Client {name} publishing {payload['header']['timestamp']}")
-                    publish(topic,payload,client)
+                data = cursor.get(maxBatch,timeout=3)
+                if len(data) == 0:
+                    continue
+
+                logger.info(f"Client {name} publishing {len(data)} messages")
+                if batch:
+                    publish(data,client)
                 else:
-                    pass
-            except Empty:
-                pass
+                    for msg in data:
+                        try:
+                            publish(msg,client)
+                        except Exception as e:
+                            logger.exception(e)
             except Exception as e:
                 logger.exception(e)
                 pass
@@ -124,65 +174,59 @@ class InfluxMqttServer (object) :
         logger.info(f"Client {name} exiting")
         client.terminate()
 
-    def parse(self,m:MQTTMessage) :
-        asJson = None
+    @staticmethod
+    def contentType(m:MQTTMessage) -> [str,None] :
+        # MQTTMessage has it in the v5 properties, RawMessage as a field
+        ct = getattr(m,'contentType',None)
+        if ct is None:
+            ct = getattr(getattr(m,'properties',None),'ContentType',None)
+        return ct
 
-        try:
-            asJson = json.loads(m.payload)
-            logger.debug(f"Parsed Received Message: {m.payload}")
-        except json.JSONDecodeError as jde:
-            logger.warning(f"Parse error: {m.payload}")
-
-        return asJson
-
-    def extractPax(self,topic:str,data:dict) :
-        p = None
-        ts = None
+    @staticmethod
+    def baseTopic(topic:str) -> str :
         tpc = topic.split('/')
-        typ = tpc[-1]
+        if len(tpc) == 5 and tpc[4] in Codec.FORMATS:
+            return topic[:topic.rfind('/')]
+        return topic
 
+    def parse(self,m:MQTTMessage) :
+        # the payload is decoded once, then checked against the schemas
         try:
-            tmp = Point(tpc[1])
-            if len(tpc) >= 3 :
-                tmp.tag("Source",tpc[3])
-                tmp.tag("regNum",tpc[1])
-                tmp.tag("fltNum",tpc[2])
-
-            for k in data['data'].keys():
-                tmp.field(k, data['data'][k])
-
-            ts = data['header']['timestamp']
-            tmp = tmp.time(ts, write_precision=WritePrecision.S)
-            p = tmp
-        except KeyError as ke:
-            logger.error(f"Invalid key {ke}")
-
-        return p,ts
-
-    def cvtToPoint(self,topic:str,data) -> Point :
-        p = None
-        ts = None
-
-        tpc = topic.split('/')
+            payload = self.decompressor.decompress(m.payload)
+        except Codec.DecodeError as de:
+            logger.warning(f"Decompress error on {m.topic}: {de}")
+            return None
+        fmt = Codec.formatOf(m.topic,payload,self.contentType(m))
+        isMsi = self.baseTopic(m.topic).endswith("/MSI")
 
         try:
-            tmp = Point(tpc[1])
-            if len(tpc) >= 3 :
-                tmp.tag("Source",tpc[3])
-                tmp.tag("regNum",tpc[1])
-                tmp.tag("fltNum",tpc[2])
-
-            for k in data['data'].keys():
-                tmp.field(k,data['data'][k])
+            asJson = fmt.loads(payload)
+        except Codec.DecodeError as de:
+            logger.warning(f"Parse error ({fmt.name}): {de}: {payload}")
+            return None
+
+        # a batch of samples, {"header": ..., "batch": [envelope,...]}
+        isBatch = isinstance(asJson,dict) and 'batch' in asJson
+        if isMsi:
+            schema = Codec.MsiBatch if isBatch else Codec.MsiEnvelope
+        else:
+            schema = Codec.Batch if isBatch else Codec.Envelope
+        try:
+            Codec.validate(asJson,schema)
+            logger.debug(f"Parsed Received Message: {payload}")
+            return asJson
+        except Codec.DecodeError as de:
+            error = de
 
-            ts = data['data']['timestamp']
-            tmp = tmp.time(ts,write_precision=WritePrecision.S)
-            p = tmp
-            logger.debug(f"Successfully converted to Influx Point")
-        except KeyError as ke:
-            logger.error(f"Invalid key {ke}")
+        logger.warning(f"Parse error ({fmt.name}): {error}: {payload}")
 
-        return p,ts
+        # keep records that are well-formed but don't match the MSI schema
+        if isMsi:
+            try:
+                return Codec.validate(asJson,Codec.Batch if isBatch else Codec.Envelope)
+            except Codec.DecodeError:
+                pass
+        return None
 
     def processDss(self,m:MQTTMessage) :
         logger.info("Processing DSS Message")
@@ -190,47 +234,195 @@ class InfluxMqttServer (object) :
             self.dss.msgQ.put((m.topic,json.loads(m.payload)))
 
 
-    def process(self,m:MQTTMessage) :
+    def decode(self,m:MQTTMessage) -> List[AcMessage] :
         payload = self.parse(m)
-        topic   = m.topic
+        if payload is None:
+            return []
 
-        if (payload is not None) :
-            logger.info(f"RX-> TOPIC[{topic}] PAYLOAD[{payload}]")
+        # batches are unpacked in order, they are one message per sample from
+        # here on
+        payloads = payload['batch'] if 'batch' in payload else (payload,)
 
-            for c in self.clients.keys() :
-                tpl = self.clients[c]
-                msgQ = tpl[1]
-                if msgQ is not None :
-                    logger.debug(f"Putting to {msgQ}")
-                    msgQ.put((m.topic,payload))
+        msgs = []
+        topic = self.baseTopic(m.topic)
+        for payload in payloads:
+            # delta encoded records are rebuilt to full ones per aircraft/flight
+            try:
+                payload = self.deltas.decode(topic,payload)
+            except (AttributeError,TypeError) as e:
+                logger.warning(f"Invalid delta message on {m.topic}: {e}")
+                continue
+            if payload is None:
+                continue
 
-            if False:
-                pt,ts = self.cvtToPoint(m.topic,payload)
-                if (pt is not None) :
-                    self.dbase.write(ts,pt)
-                    logger.info(f"Wrote Point to InfluxDB")
+            try:
+                msgs.append(AcMessage(topic,payload))
+            except (AttributeError,TypeError) as e:
+                logger.warning(f"Invalid message on {m.topic}: {e}")
+
+        return msgs
+
+    def classify(self,msgs:List[AcMessage]) -> Tuple[List[AcMessage],List[AcMessage]] :
+        # -> (live, backfill)
+        if self.laneSinks[self.BACKFILL] == 0:
+            return msgs,[]
+
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.backfillAge)
+        live = []
+        stale = []
+        for msg in msgs:
+            ts = msg.timestamp if msg.timestamp is not None else msg.headerTime
+            if ts is not None and ts < cutoff:
+                stale.append(msg)
+            else:
+                live.append(msg)
+
+        self.laneCounts[self.LIVE] += len(live)
+        self.laneCounts[self.BACKFILL] += len(stale)
+        return live,stale
+
+    def process(self,m:MQTTMessage) :
+        msgs = self.decode(m)
+
+        if len(msgs) > 0 :
+            logger.info(f"RX-> TOPIC[{msgs[0].topic}] PAYLOAD[{m.payload}]")
+
+            # stored once, each sink picks them up through its cursor
+            live,stale = self.classify(msgs)
+            self.ring.putMany(live)
+            self.rings[self.BACKFILL].putMany(stale)
 
 
 
+    def stats(self) -> dict :
+        # per sink: overrun policy, lag and messages lost to overruns
+        stats = {"lanes" : dict(self.laneCounts)}
+        for lane,ring in self.rings.items():
+            rs = ring.stats()
+            stats.update(rs['cursors'])
+            stats[f"{lane}Waits"] = rs['waits']
+        stats['deltas'] = self.deltas.stats()
+        return stats
+
     def run(self) :
         self.init()
 
-        logger.debug(f"Starting MQTT Subscriber/Listener")
+        logger.debug("Starting MQTT Subscriber/Listener")
         self.mqttClient.mqClient.loop_start()
 
 
     def terminate(self) :
-        logger.debug(f"Terminating MQTT Client/Listener")
-        self.mqttClient.terminate()
+        logger.debug("Terminating MQTT Client/Listener")
+        if self.mqttClient is not None:
+            self.mqttClient.terminate()
+        for c in self.clients:
+            self.clients[c][2].clear()
+        for ring in self.rings.values():
+            ring.close()
+
         for c in self.clients:
-            thr,q,evt,f,cli = self.clients[c]
-            evt.clear()
-            q.put(None)
+            thr,cursor,evt,f,cli = self.clients[c]
             logger.debug(f"Waiting for {thr} to complete")
             thr.join()
 
 
 
+# batching of the backfill writers
+BACKFILL_LATENCY = 5_000
+BACKFILL_MAX_BATCH = 50_000
+
+
+def createBuckets(params:Namespace) -> None :
+    admin = InfluxClient(params.influxServer, params.bucket, org="Brian Still", token=INFLUX_APIKEY)
+    try:
+        admin.createBucket(params.bucket)
+        admin.createBucket("Passenger")
+        logger.info("Successfully created bucket")
+    finally:
+        admin.terminate()
+
+
+def setupClients(server:InfluxMqttServer,params:Namespace) -> dict :
+    # Registers the sinks on server, returns the Influx writers by name
+    influxWriter = InfluxClient(params.influxServer, params.bucket, org="Brian Still", token=INFLUX_APIKEY,
+                                latencyMs=params.latencyMs, maxBatch=params.maxBatch,
+                                spoolDir=params.spoolDir, replayRate=params.replayRate)
+
+    dssWriter = InfluxClient(params.influxServer,"Passenger",org="Brian Still",token=INFLUX_APIKEY,
+                             latencyMs=params.latencyMs, maxBatch=params.maxBatch,
+                             spoolDir=params.spoolDir, replayRate=params.replayRate)
+    logger.info(f"InfluxDB batching: {influxWriter.settings()}")
+
+    # the InfluxDB sinks never lose data, when they can't keep up the broker
+    # is held up, Kinesis drops
+    server.addClient("InfluxWriter", server.writeToInflux, influxWriter, batch=True, overrun=RingBuffer.BLOCK)
+    server.addClient("DssWriter",server.writePaxData,dssWriter, batch=True, overrun=RingBuffer.BLOCK)
+    writers = {"InfluxWriter" : influxWriter, "DssWriter" : dssWriter}
+
+    if params.kinesisConfig is not None:
+        server.addClient("Kinesis", server.writeToKinesis, KinesisClient(params.kinesisConfig), batch=True)
+
+    if params.backfillAge > 0:
+        # replayed history: large, slow batches on writers of their own that
+        # share backfillConcurrency requests
+        server.backfillAge = params.backfillAge
+        slots = BoundedSemaphore(params.backfillConcurrency)
+        spoolDir = os.path.join(params.spoolDir,"backfill") if params.spoolDir is not None else None
+        for name,bucket,func in (("InfluxBackfill",params.bucket,server.writeToInflux),
+                                 ("DssBackfill","Passenger",server.writePaxData)):
+            writer = InfluxClient(params.influxServer,bucket,org="Brian Still",token=INFLUX_APIKEY,
+                                  latencyMs=BACKFILL_LATENCY,minBatch=params.maxBatch,
+                                  maxBatch=BACKFILL_MAX_BATCH,spoolDir=spoolDir,
+                                  replayRate=params.replayRate,writeSlots=slots)
+            server.addClient(name,func,writer,batch=True,lane=InfluxMqttServer.BACKFILL,overrun=RingBuffer.BLOCK)
+            writers[name] = writer
+        if params.kinesisConfig is not None:
+            # a client of its own, every sink terminates its client on exit
+            server.addClient("KinesisBackfill", server.writeToKinesis, KinesisClient(params.kinesisConfig),
+                             batch=True, lane=InfluxMqttServer.BACKFILL)
+
+    return writers
+
+
+async def setupAsyncClients(server:InfluxMqttServer,params:Namespace) -> dict :
+    # asyncio engine counterpart of setupClients
+    import asyncio
+    from AsyncInfluxClient import AsyncInfluxClient
+
+    influxWriter = AsyncInfluxClient(params.influxServer, params.bucket, org="Brian Still", token=INFLUX_APIKEY,
+                                     spoolDir=params.spoolDir, replayRate=params.replayRate)
+    dssWriter = AsyncInfluxClient(params.influxServer, "Passenger", org="Brian Still", token=INFLUX_APIKEY,
+                                  spoolDir=params.spoolDir, replayRate=params.replayRate)
+    await influxWriter.open()
+    await dssWriter.open()
+
+    server.addClient("InfluxWriter", server.writeToInflux, influxWriter, batch=True)
+    server.addClient("DssWriter", server.writePaxData, dssWriter, batch=True)
+    writers = {"InfluxWriter" : influxWriter, "DssWriter" : dssWriter}
+
+    if params.kinesisConfig is not None:
+        # boto3 is blocking, the engine runs it on the sink's own thread
+        server.addClient("Kinesis", server.writeToKinesis, KinesisClient(params.kinesisConfig), batch=True)
+
+    if params.backfillAge > 0:
+        server.backfillAge = params.backfillAge
+        slots = asyncio.Semaphore(params.backfillConcurrency)
+        spoolDir = os.path.join(params.spoolDir,"backfill") if params.spoolDir is not None else None
+        for name,bucket,func in (("InfluxBackfill",params.bucket,server.writeToInflux),
+                                 ("DssBackfill","Passenger",server.writePaxData)):
+            writer = AsyncInfluxClient(params.influxServer,bucket,org="Brian Still",token=INFLUX_APIKEY,
+                                       spoolDir=spoolDir,replayRate=params.replayRate,writeSlots=slots)
+            await writer.open()
+            server.addClient(name,func,writer,batch=True,lane=InfluxMqttServer.BACKFILL)
+            writers[name] = writer
+        if params.kinesisConfig is not None:
+            # a client of its own, every sink terminates its client on exit
+            server.addClient("KinesisBackfill", server.writeToKinesis, KinesisClient(params.kinesisConfig),
+                             batch=True, lane=InfluxMqttServer.BACKFILL)
+
+    return writers
+
+
 def parseCmdLine(args) -> Namespace :
 
     parser = ArgumentParser("MQTT Server that writes Aircraft data to InfluxDB")
@@ -283,6 +475,65 @@ def parseCmdLine(args) -> Namespace :
                         default=None,
                         help="Kinesis Config")
 
+    parser.add_argument("--latency",
+                        dest="latencyMs",
+                        type=int,
+                        default=500,
+                        help="InfluxDB write latency budget (ms)")
+
+    parser.add_argument("--max-batch",
+                        dest="maxBatch",
+                        type=int,
+                        default=10_000,
+                        help="Largest InfluxDB write batch (lines)")
+
+    parser.add_argument("--spool",
+                        dest="spoolDir",
+                        default=None,
+                        help="Directory to spool InfluxDB writes to during outages")
+
+    parser.add_argument("--replay-rate",
+                        dest="replayRate",
+                        type=int,
+                        default=5_000,
+                        help="Spool replay rate limit (lines/s)")
+
+    parser.add_argument("-W","--workers",
+                        dest="workers",
+                        type=int,
+                        default=0,
+                        help="Number of worker processes, messages are sharded by aircraft (0 = single process)")
+
+    parser.add_argument("--engine",
+                        dest="engine",
+                        choices=("thread","asyncio"),
+                        default="thread",
+                        help="Ingest engine, one thread per sink or a single asyncio event loop")
+
+    parser.add_argument("--share-group",
+                        dest="shareGroup",
+                        default=None,
+                        help="Subscribe as a member of this MQTT shared subscription group, the servers of a group split the traffic "
+                             "(the clients must not delta encode, see DeltaCodec.DeltaDecoder)")
+
+    parser.add_argument("--backfill-age",
+                        dest="backfillAge",
+                        type=float,
+                        default=InfluxMqttServer.BACKFILL_AGE,
+                        help="Messages older than this (s) are written by the low priority backfill writers (0 = off)")
+
+    parser.add_argument("--backfill-concurrency",
+                        dest="backfillConcurrency",
+                        type=int,
+                        default=1,
+                        help="Concurrent InfluxDB requests of the backfill writers")
+
+    parser.add_argument("--dict",
+                        dest="dictFiles",
+                        nargs="*",
+                        default=[],
+                        help="Trained compression dictionaries the clients may use, the builtin one is always known")
+
     return parser.parse_args(args)
 
 
@@ -308,26 +559,46 @@ if __name__ == "__main__" :
     logging.basicConfig(level=level)
 
     logger.info("Starting InfluxMqttServer")
+    if params.shareGroup is not None:
+        logger.warning(f"Sharing group {params.shareGroup}: delta encoded topics are split between servers, "
+                       f"their deltas are dropped, clients must not use --keyframe-interval")
 
-    try:
-        mqtt = MqttClient(params.mqttBroker,1883,user=params.user,passwd=params.password,
-                          clientID=f"infdb-{random.randint(0,10_000):06d}")
+    # before the workers are forked, they share the registry
+    for fname in params.dictFiles:
+        loadDictionary(fname)
 
-        server = InfluxMqttServer(mqtt)
+    if params.engine == "asyncio":
+        import asyncio
+        from common.AsyncMqttClient import AsyncMqttClient
+        from AsyncServer import AsyncInfluxMqttServer
 
-        influxWriter = InfluxClient(params.influxServer, params.bucket, org="Brian Still", token=INFLUX_APIKEY)
-        influxWriter.createBucket(params.bucket)
+        try:
+            createBuckets(params)
+            mqtt = AsyncMqttClient(params.mqttBroker,1883,user=params.user,passwd=params.password,
+                                   clientID=f"infdb-{random.randint(0,10_000):06d}",shareGroup=params.shareGroup)
+            server = AsyncInfluxMqttServer(mqtt)
+            asyncio.run(server.serve(setupAsyncClients,params))
+        except KeyboardInterrupt:
+            logger.info("Exiting....cleanup up clients")
+        except Exception as e:
+            logger.exception(e)
+
+        logger.info("Process Terminated successfully")
+        sys.exit(0)
 
-        dssWriter = InfluxClient(params.influxServer,"Passenger",org="Brian Still",token=INFLUX_APIKEY)
-        dssWriter.createBucket("Passenger")
+    try:
+        mqtt = MqttClient(params.mqttBroker,1883,user=params.user,passwd=params.password,
+                          clientID=f"infdb-{random.randint(0,10_000):06d}",shareGroup=params.shareGroup)
 
-        logger.info(f"Successfully created bucket")
-        server.addClient("InfluxWriter", server.writeToInflux, influxWriter)
-        server.addClient("DssWriter",server.writePaxData,dssWriter)
+        createBuckets(params)
 
-        if params.kinesisConfig is not None:
-            kclient = KinesisClient(params.kinesisConfig)
-            server.addClient("Kinesis", server.writeToKinesis, kclient)
+        if params.workers > 0:
+            # sinks are created inside each worker process
+            server = ShardedServer(mqtt,params.workers,InfluxMqttServer,setupClients,params)
+            writers = {}
+        else:
+            server = InfluxMqttServer(mqtt)
+            writers = setupClients(server,params)
 
     except Exception as e:
         logger.error(f"Unable to connect to InfluxDB Service:{e}")
@@ -357,6 +628,10 @@ if __name__ == "__main__" :
         else:
             while True:
                 sleep(60)
+                for name,writer in writers.items():
+                    logger.info(f"{name}: {writer.stats()}")
+                if isinstance(server,InfluxMqttServer):
+                    logger.info(f"Sinks: {server.stats()}")
 
 
     except ApiException as e :
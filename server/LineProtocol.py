@@ -0,0 +1,213 @@
+import binascii
+import logging
+import math
+from base64 import b64decode
+from datetime import timezone
+from typing import Dict, List
+
+from AcMessage import AcMessage
+
+logger = logging.getLogger("LineProtocol")
+
+# Same escaping rules as influxdb_client.Point
+ESCAPE_MEASUREMENT = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+ESCAPE_KEY = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+ESCAPE_STRING = str.maketrans({'"': r'\"', '\\': r'\\'})
+
+# seat level DSS points, see seatStates
+SEAT_SOURCE = "Seat"
+
+INT = 'i'
+FLOAT = 'f'
+BOOL = 'b'
+STRING = 's'
+
+
+def kindOf(v) -> [str,None] :
+    # bool has to be tested before int
+    if isinstance(v,bool):
+        return BOOL
+    if isinstance(v,int):
+        return INT
+    if isinstance(v,float):
+        return FLOAT
+    if isinstance(v,str):
+        return STRING
+    return None
+
+
+def seatStates(data) -> Dict[str,dict] :
+    # seat -> fields from the "checkpoint" (every seat, every flag) and
+    # "changes" (the flips only) of a DSS record, see client/SeatMatrix.py
+    # SeatTracker.  Checkpoint bitmaps are in np.packbits order, MSB first.
+    seats = {}
+    cp = data.get('checkpoint')
+    if cp is not None:
+        ids = cp['ids']
+        for seat in ids:
+            seats[seat] = {}
+        for fld,bitmap in cp.get('flags',{}).items():
+            bits = b64decode(bitmap)
+            for i,seat in enumerate(ids):
+                seats[seat][fld] = (bits[i >> 3] >> (7 - (i & 7))) & 1
+        uiStates = cp.get('uiStates',[])
+        for seat,code in zip(ids,cp.get('ui',[])):
+            if code >= 0:
+                seats[seat]['UI'] = uiStates[code]
+
+    changes = data.get('changes')
+    if changes is not None:
+        for fld,change in changes.items():
+            if fld == 'UI':
+                for seat,state in change.items():
+                    if state is not None:
+                        seats.setdefault(seat,{})['UI'] = state
+                continue
+            for seat in change.get('on',()):
+                seats.setdefault(seat,{})[fld] = 1
+            for seat in change.get('off',()):
+                seats.setdefault(seat,{})[fld] = 0
+    return seats
+
+
+class LineProtocolEncoder(object) :
+    # Encodes batches of AcMessage straight to InfluxDB line protocol, the only
+    # serializer of the write path: measurement regNum, tags Source/regNum/
+    # fltNum, the scalar data fields, second precision.
+    #
+    # InfluxDB rejects a whole write when a field changes type, so the first
+    # type seen for a field is kept and later values are coerced to it
+    # (e.g. 33000 -> 33000.0) or dropped when that isn't possible.
+    MAX_CACHE = 10_000
+
+    def __init__(self) :
+        self.fieldTypes = {}
+        self.keys = {}
+        self.prefixes = {}
+        self.conflicts = 0
+
+    def prefix(self,msg:AcMessage) -> str :
+        key = (msg.regNum,msg.fltNum,msg.source)
+        p = self.prefixes.get(key)
+        if p is None:
+            if len(self.prefixes) > self.MAX_CACHE:
+                self.prefixes.clear()
+
+            p = str(msg.regNum).translate(ESCAPE_MEASUREMENT)
+            if msg.source is not None:
+                p += self.tags({"Source" : msg.source, "regNum" : msg.regNum, "fltNum" : msg.fltNum})
+            self.prefixes[key] = p
+        return p
+
+    def seatPrefix(self,msg:AcMessage,seat:str) -> str :
+        # the aircraft's measurement, Source=Seat and a seat tag
+        key = (msg.regNum,msg.fltNum,SEAT_SOURCE,seat)
+        p = self.prefixes.get(key)
+        if p is None:
+            if len(self.prefixes) > self.MAX_CACHE:
+                self.prefixes.clear()
+
+            p = str(msg.regNum).translate(ESCAPE_MEASUREMENT)
+            p += self.tags({"Source" : SEAT_SOURCE, "regNum" : msg.regNum, "fltNum" : msg.fltNum, "seat" : seat})
+            self.prefixes[key] = p
+        return p
+
+    @staticmethod
+    def tags(tags:dict) -> str :
+        p = ''
+        for k in sorted(tags):
+            if tags[k] is not None and tags[k] != '':
+                p += f",{k}={str(tags[k]).translate(ESCAPE_KEY)}"
+        return p
+
+    def field(self,k:str,v) -> [str,None] :
+        kind = kindOf(v)
+        if kind is None:
+            return None
+
+        expected = self.fieldTypes.setdefault(k,kind)
+        if kind != expected:
+            if expected == FLOAT and kind == INT:
+                v = float(v)
+            elif expected == INT and kind == FLOAT and v.is_integer():
+                v = int(v)
+            else:
+                self.conflicts += 1
+                logger.warning(f"Dropping field {k}={v!r}, expected type {expected}")
+                return None
+            kind = expected
+
+        key = self.keys.get(k)
+        if key is None:
+            key = k.translate(ESCAPE_KEY)
+            self.keys[k] = key
+
+        if kind == FLOAT:
+            if not math.isfinite(v):
+                return None
+            s = repr(v)
+            return f"{key}={s[:-2] if s.endswith('.0') else s}"
+        if kind == INT:
+            return f"{key}={v}i"
+        if kind == BOOL:
+            return f"{key}={'true' if v else 'false'}"
+        return f'{key}="{v.translate(ESCAPE_STRING)}"'
+
+    def line(self,msg:AcMessage,ts) -> [str,None] :
+        if ts is None:
+            logger.error(f"Missing timestamp in {msg.topic}")
+            return None
+        return self.format(self.prefix(msg),msg.data,ts)
+
+    def seatLines(self,msg:AcMessage,ts) -> List[str] :
+        # one sparse point per seat in a DSS transition record
+        if ts is None or ('checkpoint' not in msg.data and 'changes' not in msg.data):
+            return []
+        try:
+            seats = seatStates(msg.data)
+        except (KeyError,TypeError,IndexError,AttributeError,binascii.Error) as e:
+            logger.warning(f"Invalid seat transitions in {msg.topic}: {e}")
+            return []
+
+        lines = []
+        for seat,fields in seats.items():
+            l = self.format(self.seatPrefix(msg,seat),fields,ts)
+            if l is not None:
+                lines.append(l)
+        return lines
+
+    def format(self,prefix:str,data,ts) -> [str,None] :
+        fields = []
+        for k in sorted(data):
+            v = data[k]
+            if v is not None:
+                f = self.field(k,v)
+                if f is not None:
+                    fields.append(f)
+
+        if len(fields) == 0:
+            return None
+
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        return f"{prefix} {','.join(fields)} {int(ts.timestamp())}"
+
+    def encode(self,msgs:List[AcMessage],useHeaderTime:bool=False,seats:bool=False) -> bytes :
+        lines = []
+        for msg in msgs:
+            ts = msg.headerTime if useHeaderTime else msg.timestamp
+            l = self.line(msg,ts)
+            if l is not None:
+                lines.append(l)
+            if seats:
+                lines.extend(self.seatLines(msg,ts))
+        return '\n'.join(lines).encode('utf-8')
+
+    def encodeMsi(self,msgs:List[AcMessage]) -> bytes :
+        return self.encode(msgs)
+
+    def encodePax(self,msgs:List[AcMessage]) -> bytes :
+        # passenger records use the time they were sent (header timestamp),
+        # the seat transitions they carry become one point per seat, see
+        # seatStates/seatLines
+        return self.encode(msgs,useHeaderTime=True,seats=True)
@@ -0,0 +1,141 @@
+import copy
+import logging
+import multiprocessing
+import os
+import zlib
+from argparse import Namespace
+from collections import namedtuple
+from queue import Empty
+from threading import Event, Lock, Thread
+from typing import Callable
+
+from common.MqttClient import MqttClient
+
+logger = logging.getLogger("ShardedServer")
+
+# What the workers receive, enough of an MQTTMessage for InfluxMqttServer.process
+RawMessage = namedtuple("RawMessage",["topic","payload","contentType"],defaults=[None])
+
+
+def shardOf(topic:str,workers:int) -> int :
+    # all messages of one aircraft (regNum) go to the same worker so their
+    # order is preserved
+    tpc = topic.split('/',2)
+    key = tpc[1] if len(tpc) > 1 else topic
+    return zlib.crc32(key.encode('utf-8')) % workers
+
+
+def workerMain(idx:int,msgQ,serverClass,setup:Callable,params:Namespace) -> None :
+    # Runs in the worker process: owns its own sinks (InfluxClient,
+    # KinesisClient...) and feeds the raw messages through the normal
+    # decode/fan-out path of serverClass.
+    params = copy.copy(params)
+    if getattr(params,'spoolDir',None) is not None:
+        params.spoolDir = os.path.join(params.spoolDir,f"shard{idx}")
+
+    server = serverClass(None)
+    writers = setup(server,params)
+    server.startFlag.set()
+    logger.info(f"Worker {idx} started, pid {os.getpid()}")
+
+    count = 0
+    try:
+        while True:
+            try:
+                batch = msgQ.get(timeout=60)
+            except Empty:
+                for name,writer in writers.items():
+                    logger.info(f"Worker {idx} {name}: {writer.stats()}")
+                logger.info(f"Worker {idx} sinks: {server.stats()}")
+                continue
+
+            if batch is None:
+                break
+
+            for topic,payload,contentType in batch:
+                server.process(RawMessage(topic,payload,contentType))
+            count += len(batch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info(f"Worker {idx} processed {count} messages, exiting")
+        server.terminate()
+
+
+class ShardedServer(object) :
+    # Ingest process: receives MQTT messages and dispatches the undecoded
+    # payloads to N worker processes by a hash of the regNum topic segment.
+    # Messages are sent in small batches to amortize the queue overhead.
+    BATCH_SIZE = 100
+    FLUSH_INTERVAL = 0.05
+    QUEUE_DEPTH = 1_000
+
+    def __init__(self,sub:MqttClient,workers:int,serverClass,setup:Callable,params:Namespace) :
+        self.mqttClient = sub
+        self.workers = workers
+        self.topics = serverClass.TOPICS
+        self.contentType = serverClass.contentType
+
+        ctx = multiprocessing.get_context("fork" if os.name == "posix" else "spawn")
+        # bounded, a full queue blocks the MQTT thread and so the broker
+        self.queues = [ctx.Queue(self.QUEUE_DEPTH) for i in range(workers)]
+        self.procs = [ctx.Process(target=workerMain,
+                                  args=(i,self.queues[i],serverClass,setup,params),
+                                  name=f"shard{i}",daemon=True)
+                      for i in range(workers)]
+
+        self.pending = [[] for i in range(workers)]
+        self.lock = Lock()
+        self.stopFlag = Event()
+        self.flusher = Thread(target=self.flushRun,daemon=True)
+        self.dispatched = [0] * workers
+
+    def dispatch(self,m) :
+        idx = shardOf(m.topic,self.workers)
+        with self.lock:
+            pend = self.pending[idx]
+            pend.append((m.topic,m.payload,self.contentType(m)))
+            if len(pend) >= self.BATCH_SIZE:
+                self.flushShard(idx)
+
+    def flushShard(self,idx:int) -> None :
+        batch = self.pending[idx]
+        if len(batch) > 0:
+            self.pending[idx] = []
+            self.dispatched[idx] += len(batch)
+            self.queues[idx].put(batch)
+
+    def flushRun(self) -> None :
+        while not self.stopFlag.wait(self.FLUSH_INTERVAL):
+            with self.lock:
+                for idx in range(self.workers):
+                    self.flushShard(idx)
+
+    def run(self) :
+        for p in self.procs:
+            p.start()
+        self.flusher.start()
+
+        self.mqttClient.run()
+        for topic in self.topics:
+            self.mqttClient.subscribe(topic,lambda m,u: u.dispatch(m),self)
+        logger.info(f"Dispatching {self.topics} to {self.workers} workers")
+
+    def stats(self) -> dict :
+        return {"dispatched" : list(self.dispatched)}
+
+    def terminate(self) :
+        self.mqttClient.terminate()
+        self.stopFlag.set()
+        if self.flusher.is_alive():
+            self.flusher.join()
+
+        with self.lock:
+            for idx in range(self.workers):
+                self.flushShard(idx)
+                self.queues[idx].put(None)
+
+        for p in self.procs:
+            if p.pid is not None:
+                p.join()
+        logger.info(f"All workers finished {self.stats()}")
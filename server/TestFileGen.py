@@ -1,87 +1,146 @@
-import json
 import logging
+import mmap
+import os
 import random
 import re
 import sys
 from argparse import Namespace, ArgumentParser
-from datetime import datetime, timezone
 from multiprocessing import Event
-from time import sleep
+from threading import Lock, Thread
+from time import monotonic
+from typing import Callable
 
 
+from common.ClientLog import scan
+from common.LogIndex import LogIndex, isoTime
 from common.MqttClient import MqttClient
+from AcMessage import parseTime
 
 logger = logging.getLogger()
 
-MSI_SAMPLE = '''
-{"timestamp":"2025-10-16T12:08:46Z","eta":"02:35","flightDuration":12,"flightNumber":"DAL1516","latitude":37.22229967994918,"longitude":-112.15674058996935,"noseId":"004001","paState":true,"vehicleId":"TESTDL15","destination":"KCVG","origin":"KATL","flightId":"TESTDL15_SF_20251014183628","airspeed":410,"airTemperature":32,"altitude":33000,"distanceToGo":999,"doorState":"Closed","groundspeed":420,"heading":180,"timeToGo":12,"wheelWeightState":"Off","grossWeight":500,"windSpeed":150,"windDirection":200.0,"flightPhase":"Cruise"}
-'''
-
 class TestFileGen(object) :
     SERVER_RE = re.compile(r"INFO:root:Message received: b'(?P<PAYLOAD>.*)'")
     TOPIC_RE  = re.compile("Delta/(?P<TAIL>[a-zA-z]{1}\\d{3}[a-zA-z]{2})/(?P<FLIGHT>[a-zA-z]{3}\\d+)/MSI")
 
-    def __init__(self,client:MqttClient,fnames) :
+    # Replays recorded client/server logs.  Every file is replayed copies
+    # times, each replay (stream) in its own thread, on its own connection
+    # when clientFor(stream) is given, with the tail number rewritten per
+    # stream (tailFormat) so they look like separate aircraft.  With a
+    # selection (start/end/tail/flight) only those records are replayed,
+    # read through the log's sidecar index.
+    TAIL_FORMAT = "{tail}R{n}"
+
+    def __init__(self,client:MqttClient,fnames,speed:float=1.0,copies:int=1,tailFormat:str=TAIL_FORMAT,
+                 topic:str=None,clientFor:Callable=None,select:dict=None) :
         self.mqtt = client
         self.finished = Event()
+        self.stopFlag = Event()
         self.filenames = fnames
-
-    def cvtToPublisher(self,data:str) -> str:
-        header = {"timestamp": str(datetime.now(timezone.utc))}
-
-        if isinstance(data,str) :
-            data = json.loads(data)
-
-        # encode the topic for better efficiency
-        topic = f"Delta/{data['vehicleId']}/{data['flightNumber']}/MSI"
-
-        # remove since encoded in the topic
-        # msiData.pop('vehicleId')
-        # msiData.pop('flightNumber')
-
-        # Don't send empty data elements
-        dataToSend = {}
-        for k in data.keys():
-            if data[k] != None:
-                dataToSend[k] = data[k]
-
-        payload = {"header": header,
-                   "data": dataToSend
-                   }
-
-        payloadStr = json.dumps(payload)
-        return payloadStr
-
-
-    def run(self) :
-        self.mqtt.run()
-
+        self.streams = [fname for fname in fnames for i in range(copies)]
+        self.speed = speed
+        self.tailFormat = tailFormat
+        self.topic = topic
+        self.clientFor = clientFor
+        self.select = {k : v for k,v in (select or {}).items() if v is not None}
+
+        self.lock = Lock()
+        self.counts = {}
+        self.lags = {}
+        self.elapsed = 0.0
+
+    def records(self,fname:str) :
+        # the log is memory-mapped and scanned in one regex pass, see
+        # ClientLog.scan -> (topic, payload, timestamp)
+        if len(self.select) > 0:
+            for topic,payload,ts in LogIndex.open(fname).read(**self.select):
+                yield topic,payload,parseTime(ts)
+            return
+
+        with open(fname,"rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as buf:
+                for topic,payload,ts in scan(buf):
+                    yield topic,payload,parseTime(ts)
+
+    def tailFor(self,stream:int,tail:str) -> str :
+        if not self.tailFormat or len(self.streams) <= 1:
+            return tail
+        return self.tailFormat.format(tail=tail,n=stream)
+
+    def replay(self,stream:int,fname:str,client:MqttClient) -> None :
+        # original pacing divided by speed (0 = as fast as possible), the
+        # tail number rewritten in the topic and the payload
+        count = 0
+        lag = 0.0
+        start = None
+        tails = {}
         try:
-            for fname in self.filenames :
-                with open(fname) as f :
-                    for line in f:
-                        m = self.SERVER_RE.match(line)
-                        if m is not None:
-                            #logger.info(f"{m.group('TOPIC')}:{m.group('PAYLOAD')}")
-                            payload = m.group("PAYLOAD")
-                            #payload = self.cvtToPublisher(MSI_SAMPLE)
-                            #topic   = "Delta/NXXXUS/DAL345/MSI"
-                            #topic    = m.group("TOPIC")
-                            topic = "Delta/NXXXBS/DL998/MSI"
-                            self.mqtt.publish(topic,payload)
-                            sleep(0.5)
-
-
-
-        except FileNotFoundError :
-            logger.warning("File {fname} not found")
+            for topic,payload,ts in self.records(fname):
+                if self.stopFlag.is_set():
+                    break
+
+                tpc = topic.split('/')
+                if len(tpc) > 1:
+                    tail = tpc[1]
+                    newTail = tails.get(tail)
+                    if newTail is None:
+                        newTail = tails[tail] = self.tailFor(stream,tail)
+                    if newTail != tail:
+                        tpc[1] = newTail
+                        topic = '/'.join(tpc)
+                        payload = payload.replace(tail.encode(),newTail.encode())
+
+                if self.topic is not None:
+                    topic = self.topic
+
+                if self.speed > 0 and ts is not None:
+                    if start is None:
+                        start = (monotonic(),ts)
+                    due = start[0] + (ts - start[1]).total_seconds() / self.speed
+                    wait = due - monotonic()
+                    if wait > 0:
+                        self.stopFlag.wait(wait)
+                    else:
+                        lag = max(lag,-wait)
+
+                client.publish(topic,payload)
+                count += 1
+        except FileNotFoundError:
+            logger.warning(f"File {fname} not found")
+
+        with self.lock:
+            self.counts[stream] = count
+            self.lags[stream] = lag
+        logger.info(f"{fname} (stream {stream}): {count} messages replayed, max lag {lag:.2f}s")
 
+    def run(self) :
+        start = monotonic()
+        threads = []
+        for stream,fname in enumerate(self.streams):
+            client = self.mqtt if self.clientFor is None else self.clientFor(stream)
+            thr = Thread(target=self.replay,args=(stream,fname,client),name=f"replay-{stream}")
+            threads.append((thr,client))
+            thr.start()
+
+        for thr,client in threads:
+            thr.join()
+
+        self.elapsed = monotonic() - start
+        logger.info(f"Replay: {self.report()}")
         self.finished.set()
 
-
+    def report(self) -> dict :
+        total = sum(self.counts.values())
+        return {"streams" : len(self.streams),
+                "messages" : total,
+                "seconds" : round(self.elapsed,2),
+                "rate" : round(total / max(self.elapsed,1e-9)),
+                "speed" : self.speed if self.speed > 0 else "max",
+                "maxLag" : round(max(self.lags.values(),default=0.0),2)}
 
     def terminate(self) :
-        pass
+        self.stopFlag.set()
 
 
 
@@ -117,9 +176,59 @@ def parseCmdLine(args) -> Namespace :
                         default="KeepClimbing!",
                         help="MQTT Password")
 
+    parser.add_argument("--port",
+                        dest="port",
+                        type=int,
+                        default=1883,
+                        help="MQTT Broker port")
+
+    parser.add_argument("-s","--speed",
+                        dest="speed",
+                        type=float,
+                        default=1.0,
+                        help="Replay at the recorded pace times N (0 = as fast as possible)")
+
+    parser.add_argument("-c","--copies",
+                        dest="copies",
+                        type=int,
+                        default=1,
+                        help="Replay every file N times in parallel")
+
+    parser.add_argument("--tail-format",
+                        dest="tailFormat",
+                        default=TestFileGen.TAIL_FORMAT,
+                        help="Tail number of each parallel replay, {tail} and {n} (stream) are replaced, empty to keep the recorded ones")
+
+    parser.add_argument("--shared-connection",
+                        dest="sharedConnection",
+                        action="store_true",
+                        help="Replay all the files over one connection instead of one per file")
+
+    parser.add_argument("--start",
+                        dest="start",
+                        type=isoTime,
+                        default=None,
+                        help="Replay from this ISO time on (uses the log's .idx index)")
+
+    parser.add_argument("--end",
+                        dest="end",
+                        type=isoTime,
+                        default=None,
+                        help="Replay up to this ISO time (uses the log's .idx index)")
+
+    parser.add_argument("--tail",
+                        dest="tail",
+                        default=None,
+                        help="Replay this aircraft only (uses the log's .idx index)")
+
+    parser.add_argument("--flight",
+                        dest="flight",
+                        default=None,
+                        help="Replay this flight only (uses the log's .idx index)")
+
     parser.add_argument(dest='testFiles',
                         default=None,
-                        nargs=1,
+                        nargs="+",
                         help="Test files to replicate")
 
     return parser.parse_args(args)
@@ -127,11 +236,31 @@ def parseCmdLine(args) -> Namespace :
 
 if __name__ == "__main__" :
     params = parseCmdLine(sys.argv[1:])
-
-    pub = MqttClient(params.mqttBroker, 1883, user=params.user, passwd=params.password,
-                     clientID=f"test-{random.randint(0, 10_000)}")
-    pub.run()
-
-    testgen = TestFileGen(pub, params.testFiles)
-    testgen.run()
+    logging.basicConfig(level=logging.INFO if params.verbose else logging.WARNING)
+
+    def connect(name:str) -> MqttClient :
+        client = MqttClient(params.mqttBroker, params.port, user=params.user, passwd=params.password,
+                            clientID=f"test-{name}-{random.randint(0, 10_000)}")
+        client.run()
+        return client
+
+    clients = []
+    def clientFor(stream:int) -> MqttClient :
+        clients.append(connect(str(stream)))
+        return clients[-1]
+
+    pub = connect("main")
+    testgen = TestFileGen(pub, params.testFiles, speed=params.speed, copies=params.copies,
+                          tailFormat=params.tailFormat, topic=params.topic,
+                          clientFor=None if params.sharedConnection else clientFor,
+                          select={"start" : params.start, "end" : params.end, "tail" : params.tail,
+                                  "flight" : params.flight})
+    try:
+        testgen.run()
+    except KeyboardInterrupt:
+        testgen.terminate()
+    finally:
+        print(testgen.report())
+        for client in clients + [pub]:
+            client.terminate()
 
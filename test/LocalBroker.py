@@ -0,0 +1,373 @@
+import logging
+import socket
+import struct
+from threading import Event, Lock, Thread
+from time import sleep, time
+
+from common.TopicTrie import TopicTrie
+
+logger = logging.getLogger("LocalBroker")
+
+# Packet types
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+# MQTT v5 properties used here and the size of the others
+TOPIC_ALIAS_MAXIMUM = 0x22
+TOPIC_ALIAS = 0x23
+PROP_SIZES = {0x01 : 1, 0x02 : 4, 0x03 : 's', 0x08 : 's', 0x09 : 's', 0x0B : 'v', 0x11 : 4,
+              0x12 : 's', 0x13 : 2, 0x15 : 's', 0x16 : 's', 0x17 : 1, 0x18 : 4, 0x19 : 1,
+              0x1A : 's', 0x1C : 's', 0x1F : 's', 0x21 : 2, 0x22 : 2, 0x23 : 2, 0x24 : 1,
+              0x25 : 1, 0x26 : 'p', 0x27 : 4, 0x28 : 1, 0x29 : 1, 0x2A : 1}
+
+
+def encodeVarint(n:int) -> bytes :
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+def decodeVarint(buf,pos:int) :
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80:
+            return n,pos
+
+def encodeStr(s) -> bytes :
+    if isinstance(s,str):
+        s = s.encode('utf-8')
+    return struct.pack("!H",len(s)) + s
+
+def decodeStr(buf,pos:int) :
+    n, = struct.unpack_from("!H",buf,pos)
+    return bytes(buf[pos+2:pos+2+n]),pos+2+n
+
+def decodeProps(buf,pos:int) :
+    # -> ({id : value}, [raw property bytes], pos)
+    n,pos = decodeVarint(buf,pos)
+    end = pos + n
+    props = {}
+    raw = []
+    while pos < end:
+        start = pos
+        pid,pos = decodeVarint(buf,pos)
+        size = PROP_SIZES[pid]
+        if size == 's':
+            val,pos = decodeStr(buf,pos)
+        elif size == 'p':
+            key,pos = decodeStr(buf,pos)
+            val,pos = decodeStr(buf,pos)
+        elif size == 'v':
+            val,pos = decodeVarint(buf,pos)
+        else:
+            val = int.from_bytes(buf[pos:pos+size],'big')
+            pos += size
+        props[pid] = val
+        raw.append(bytes(buf[start:pos]))
+    return props,raw,end
+
+def encodeProps(raw) -> bytes :
+    data = b''.join(raw)
+    return encodeVarint(len(data)) + data
+
+def packet(ptype:int,flags:int,body:bytes) -> bytes :
+    return bytes([ptype << 4 | flags]) + encodeVarint(len(body)) + body
+
+
+class Session(object) :
+    def __init__(self,broker,sock:socket.socket,addr) :
+        self.broker = broker
+        self.sock = sock
+        self.addr = addr
+        self.clientId = None
+        self.lock = Lock()
+        self.nextPid = 1
+        self.aliasIn = {}
+        self.aliasOut = {}
+        self.aliasOutMax = 0
+        self.rxBytes = 0
+        self.txBytes = 0
+        self.published = 0
+        self.delivered = 0
+
+    def send(self,data:bytes) -> None :
+        with self.lock:
+            self.txBytes += len(data)
+            self.sock.sendall(data)
+
+    def recvExact(self,n:int) -> bytes :
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("closed")
+            buf.extend(chunk)
+        return bytes(buf)
+
+    def readPacket(self) :
+        hdr = self.recvExact(1)[0]
+        length = shift = 0
+        size = 1
+        while True:
+            b = self.recvExact(1)[0]
+            size += 1
+            length |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        body = self.recvExact(length)
+        self.rxBytes += size + length
+        return hdr >> 4,hdr & 0x0F,body
+
+    def deliver(self,topic:bytes,qos:int,retain:bool,raw,payload:bytes) -> None :
+        # publishers' threads deliver concurrently, aliases and packet ids
+        # are assigned and the packet sent under the session lock
+        with self.lock:
+            hdr = bytearray()
+            props = list(raw)
+            alias = self.aliasOut.get(topic)
+            if alias is not None:
+                hdr += encodeStr(b'')
+                props.append(bytes([TOPIC_ALIAS]) + struct.pack("!H",alias))
+            else:
+                hdr += encodeStr(topic)
+                if len(self.aliasOut) < self.aliasOutMax:
+                    alias = len(self.aliasOut) + 1
+                    self.aliasOut[topic] = alias
+                    props.append(bytes([TOPIC_ALIAS]) + struct.pack("!H",alias))
+
+            if qos > 0:
+                hdr += struct.pack("!H",self.nextPid)
+                self.nextPid = self.nextPid % 65535 + 1
+
+            data = packet(PUBLISH,qos << 1 | int(retain),bytes(hdr) + encodeProps(props) + payload)
+            self.delivered += 1
+            self.txBytes += len(data)
+            self.sock.sendall(data)
+
+    def run(self) -> None :
+        try:
+            while not self.broker.stopFlag.is_set():
+                ptype,flags,body = self.readPacket()
+                if ptype == DISCONNECT:
+                    break
+                self.handle(ptype,flags,body)
+        except (ConnectionError,OSError):
+            pass
+        finally:
+            self.broker.dropSession(self)
+            self.sock.close()
+
+    def handle(self,ptype:int,flags:int,body:bytes) -> None :
+        if ptype == CONNECT:
+            name,pos = decodeStr(body,0)
+            level = body[pos]
+            if level != 5:
+                # only MQTT v5 is spoken here: 'unsupported protocol version'
+                self.send(packet(CONNACK,0,bytes([0,0x84,0])))
+                raise ConnectionError("not MQTT v5")
+            pos += 4                        # level, flags, keepalive
+            props,raw,pos = decodeProps(body,pos)
+            clientId,pos = decodeStr(body,pos)
+            self.clientId = clientId.decode('utf-8')
+            if self.broker.aliasOut:
+                self.aliasOutMax = props.get(TOPIC_ALIAS_MAXIMUM,0)
+            ack = [bytes([TOPIC_ALIAS_MAXIMUM]) + struct.pack("!H",self.broker.aliasMax)]
+            self.send(packet(CONNACK,0,bytes([0,0]) + encodeProps(ack)))
+
+        elif ptype == PUBLISH:
+            qos = (flags >> 1) & 3
+            topic,pos = decodeStr(body,0)
+            pid = None
+            if qos > 0:
+                pid, = struct.unpack_from("!H",body,pos)
+                pos += 2
+            props,raw,pos = decodeProps(body,pos)
+
+            alias = props.get(TOPIC_ALIAS)
+            if alias is not None:
+                raw = [r for r in raw if r[0] != TOPIC_ALIAS]
+                if len(topic) > 0:
+                    self.aliasIn[alias] = topic
+                else:
+                    topic = self.aliasIn[alias]
+
+            self.published += 1
+            self.broker.route(topic,min(qos,1),bool(flags & 1),raw,body[pos:])
+            if qos == 1:
+                self.send(packet(PUBACK,0,struct.pack("!H",pid)))
+            elif qos == 2:
+                self.send(packet(PUBREC,0,struct.pack("!H",pid)))
+
+        elif ptype == PUBREL:
+            self.send(packet(PUBCOMP,0,body[:2]))
+
+        elif ptype == SUBSCRIBE:
+            pid, = struct.unpack_from("!H",body,0)
+            props,raw,pos = decodeProps(body,2)
+            codes = bytearray()
+            while pos < len(body):
+                flt,pos = decodeStr(body,pos)
+                qos = min(body[pos] & 3,1)
+                pos += 1
+                self.broker.addSubscription(self,flt.decode('utf-8'),qos)
+                codes.append(qos)
+            self.send(packet(SUBACK,0,struct.pack("!H",pid) + encodeProps([]) + bytes(codes)))
+
+        elif ptype == UNSUBSCRIBE:
+            pid, = struct.unpack_from("!H",body,0)
+            props,raw,pos = decodeProps(body,2)
+            codes = bytearray()
+            while pos < len(body):
+                flt,pos = decodeStr(body,pos)
+                self.broker.removeSubscription(self,flt.decode('utf-8'))
+                codes.append(0)
+            self.send(packet(UNSUBACK,0,struct.pack("!H",pid) + encodeProps([]) + bytes(codes)))
+
+        elif ptype == PINGREQ:
+            self.send(packet(PINGRESP,0,b''))
+
+
+class FilterSubs(object) :
+    def __init__(self) :
+        self.direct = {}
+        self.shared = {}
+        self.next = {}
+
+
+class LocalBroker(object) :
+    # Minimal MQTT v5 broker for the tests: QoS 0/1 routing (QoS 2 is
+    # acknowledged and delivered as 1), $share/<group>/ subscriptions served
+    # round robin, and topic aliases in both directions.  No retained
+    # messages, sessions or authentication.  Counts the bytes exchanged with
+    # every client.
+    def __init__(self,port:int=0,aliasMax:int=10,aliasOut:bool=False) :
+        self.aliasMax = aliasMax
+        self.aliasOut = aliasOut
+        self.listener = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.listener.bind(("127.0.0.1",port))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+
+        self.lock = Lock()
+        self.filters = {}
+        self.trie = TopicTrie()
+        self.sessions = []
+        self.closed = []
+        self.stopFlag = Event()
+        self.thread = Thread(target=self.acceptRun,daemon=True)
+
+    def start(self) -> "LocalBroker" :
+        self.thread.start()
+        logger.info(f"Local broker listening on port {self.port}")
+        return self
+
+    def acceptRun(self) -> None :
+        while not self.stopFlag.is_set():
+            try:
+                sock,addr = self.listener.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            sess = Session(self,sock,addr)
+            with self.lock:
+                self.sessions.append(sess)
+            Thread(target=sess.run,daemon=True).start()
+
+    def addSubscription(self,sess:Session,flt:str,qos:int) -> None :
+        group = None
+        if flt.startswith("$share/"):
+            _,group,flt = flt.split('/',2)
+
+        with self.lock:
+            fs = self.filters.get(flt)
+            if fs is None:
+                fs = self.filters[flt] = FilterSubs()
+                self.trie.add(flt,fs)
+            if group is None:
+                fs.direct[sess] = qos
+            else:
+                members = fs.shared.setdefault(group,{})
+                members[sess] = qos
+                fs.next.setdefault(group,0)
+
+    def removeSubscription(self,sess:Session,flt:str) -> None :
+        group = None
+        if flt.startswith("$share/"):
+            _,group,flt = flt.split('/',2)
+
+        with self.lock:
+            fs = self.filters.get(flt)
+            if fs is None:
+                return
+            if group is None:
+                fs.direct.pop(sess,None)
+            else:
+                fs.shared.get(group,{}).pop(sess,None)
+
+    def dropSession(self,sess:Session) -> None :
+        with self.lock:
+            for fs in self.filters.values():
+                fs.direct.pop(sess,None)
+                for members in fs.shared.values():
+                    members.pop(sess,None)
+            if sess in self.sessions:
+                self.sessions.remove(sess)
+                self.closed.append(sess)
+
+    def route(self,topic:bytes,qos:int,retain:bool,raw,payload:bytes) -> None :
+        targets = {}
+        with self.lock:
+            for fs in self.trie.match(topic.decode('utf-8')):
+                for sess,subQos in fs.direct.items():
+                    targets[sess] = max(targets.get(sess,0),min(qos,subQos))
+                for group,members in fs.shared.items():
+                    if len(members) == 0:
+                        continue
+                    sessions = list(members)
+                    idx = fs.next[group] % len(sessions)
+                    fs.next[group] = idx + 1
+                    sess = sessions[idx]
+                    targets[sess] = max(targets.get(sess,0),min(qos,members[sess]))
+
+        for sess,q in targets.items():
+            try:
+                sess.deliver(topic,q,retain,raw,payload)
+            except OSError:
+                pass
+
+    def session(self,clientId:str) -> Session :
+        with self.lock:
+            for sess in self.sessions + self.closed:
+                if sess.clientId == clientId:
+                    return sess
+        return None
+
+    def stop(self) -> None :
+        self.stopFlag.set()
+        self.listener.close()
+        with self.lock:
+            sessions = list(self.sessions)
+        for sess in sessions:
+            try:
+                sess.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+
+def waitFor(cond,timeout:float=5.0) -> bool :
+    end = time() + timeout
+    while time() < end:
+        if cond():
+            return True
+        sleep(0.02)
+    return cond()
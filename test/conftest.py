@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+# the server modules import each other as top level modules
+sys.path[:0] = [ROOT_DIR,os.path.join(ROOT_DIR,"server"),TEST_DIR]
+
+from LocalBroker import LocalBroker
+
+
+@pytest.fixture
+def broker() :
+    broker = LocalBroker().start()
+    yield broker
+    broker.stop()
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+from LocalBroker import LocalBroker, waitFor
+from common.ClientLog import readRecords
+from common.MqttClient import MqttClient
+
+FLIGHT_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),"AcClient_20251015_144203.log")
+
+
+def test_shared_subscription(broker,messages:int=300) :
+    # two servers in one shared group split the fleet, a third plain
+    # subscriber still sees everything
+    counts = {}
+    def onMsg(m,name) :
+        counts.setdefault(name,[]).append(m.payload)
+
+    servers = [MqttClient("127.0.0.1",broker.port,clientID=f"srv{i}",shareGroup="ingest") for i in range(2)]
+    monitor = MqttClient("127.0.0.1",broker.port,clientID="monitor")
+    pub = MqttClient("127.0.0.1",broker.port,clientID="aircraft")
+    try:
+        for name,cl in [("srv0",servers[0]),("srv1",servers[1]),("monitor",monitor)]:
+            cl.run()
+            cl.subscribe("Delta/+/+/MSI",onMsg,name)
+        assert waitFor(lambda: sum(len(fs.direct) + sum(len(g) for g in fs.shared.values())
+                                   for fs in broker.filters.values()) == 3)
+
+        pub.run()
+        assert waitFor(lambda: pub.mqClient.is_connected())
+        for i in range(messages):
+            pub.publish(f"Delta/N{i % 7}DQ/DL{i % 3}/MSI",str(i).encode(),qos=1)
+
+        assert waitFor(lambda: len(counts.get("monitor",[])) == messages)
+        assert waitFor(lambda: len(counts.get("srv0",[])) + len(counts.get("srv1",[])) == messages)
+        shared = counts["srv0"] + counts["srv1"]
+        assert len(set(shared)) == messages, "shared group delivered duplicates"
+        assert len(counts["srv0"]) > 0 and len(counts["srv1"]) > 0
+    finally:
+        for cl in servers + [monitor,pub]:
+            cl.terminate()
+
+
+@pytest.mark.parametrize("aliases",[0,MqttClient.TOPIC_ALIASES])
+def test_topic_aliases(aliases:int) :
+    # replays a logged flight through the broker, the broker also aliases
+    # towards the ground subscriber, which must see every topic in order
+    records = [(t,p.encode('utf-8')) for t,p in readRecords(FLIGHT_LOG)]
+    assert len(records) > 0
+
+    broker = LocalBroker(aliasOut=True).start()
+    topics = []
+    ground = MqttClient("127.0.0.1",broker.port,clientID="ground")
+    aircraft = MqttClient("127.0.0.1",broker.port,clientID="aircraft",topicAliases=aliases)
+    try:
+        ground.run()
+        ground.subscribe("Delta/#",lambda m,u: topics.append(m.topic),None)
+        assert waitFor(lambda: len(broker.filters) == 1)
+
+        aircraft.run()
+        assert waitFor(lambda: aircraft.mqClient.is_connected() and
+                               aircraft.aliasMax == min(aliases,broker.aliasMax))
+        for t,p in records:
+            aircraft.publish(t,p)
+
+        assert waitFor(lambda: len(topics) == len(records),30)
+        assert topics == [t for t,p in records], "aliased topics not resolved"
+
+        # every repeat of an aliased topic goes up without its name
+        saved = aircraft.aliasStats()
+        if aliases > 0:
+            assert sum(saved.values()) > 0
+        else:
+            assert sum(saved.values()) == 0
+    finally:
+        aircraft.terminate()
+        ground.terminate()
+        broker.stop()
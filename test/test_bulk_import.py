@@ -0,0 +1,83 @@
+import gzip
+import json
+import os
+from argparse import Namespace
+
+from BulkImport import LogImporter
+from common.ClientLog import MSI_TEMPLATE
+from common.DeltaCodec import DeltaEncoder, simulateFlight
+
+TOPICS = ("Delta/N101DQ/DL1/MSI","Delta/N102DQ/DL2/MSI")
+
+
+def deltaLog(samples:int=300) -> list :
+    # two interleaved delta encoded flights as AircraftClient logs them
+    enc = DeltaEncoder(20)
+    flights = []
+    for topic in TOPICS:
+        template = dict(MSI_TEMPLATE,vehicleId=topic.split('/')[1],flightNumber=topic.split('/')[2])
+        lines = []
+        for rec in simulateFlight(topic,template,samples):
+            header = {"timestamp" : rec['timestamp'].replace('T',' ').replace('Z','+00:00')}
+            fields,data = enc.encode(topic,rec)
+            header.update(fields)
+            payload = json.dumps({"header" : header, "data" : data},separators=(',',':'))
+            lines.append(f"INFO:root:TOPIC:[{topic}] PAYLOAD:[{payload}]\n")
+        flights.append(lines)
+    return [line for pair in zip(*flights) for line in pair]
+
+
+def params(tmp_path,name:str) -> Namespace :
+    return Namespace(stateDir=str(tmp_path / name / "state"),outDir=str(tmp_path / name / "out"),
+                     level=1,chunk=40,synthesize=False,bucket="Aircraft",dictFiles=[])
+
+
+def importLog(fname:str,p:Namespace) -> dict :
+    os.makedirs(p.stateDir,exist_ok=True)
+    os.makedirs(p.outDir,exist_ok=True)
+    return LogImporter(fname,p).run()
+
+
+def output(p:Namespace,bucket:str) -> list :
+    files = [f for f in os.listdir(p.outDir) if f.endswith(f".{bucket}.lp.gz")]
+    assert len(files) == 1
+    with gzip.open(os.path.join(p.outDir,files[0])) as f:
+        return sorted(l for l in f.read().splitlines() if len(l) > 0)
+
+
+def test_resume_keeps_delta_state(tmp_path) :
+    lines = deltaLog()
+    assert len(lines) == 600
+
+    whole = tmp_path / "whole.log"
+    whole.write_text(''.join(lines))
+    expect = params(tmp_path,"whole")
+    stats = importLog(str(whole),expect)
+    assert stats['messages'] == 600
+
+    # cut at a delta, not at a keyframe, then the rest of the log arrives
+    cut = 257
+    assert '"frame":"D"' in lines[cut]
+    resumed = tmp_path / "resumed.log"
+    resumed.write_text(''.join(lines[:cut]))
+    p = params(tmp_path,"resumed")
+    assert importLog(str(resumed),p)['records'] == cut
+    with open(resumed,"a") as f:
+        f.writelines(lines[cut:])
+    stats = importLog(str(resumed),p)
+
+    assert stats['records'] == 600
+    assert stats['messages'] == 600
+    assert output(p,"Aircraft") == output(expect,"Aircraft")
+
+
+def test_same_name_logs_dont_collide(tmp_path) :
+    lines = deltaLog(20)
+    p = params(tmp_path,"shared")
+    for d in ("a","b"):
+        os.makedirs(tmp_path / d)
+        (tmp_path / d / "x.log").write_text(''.join(lines if d == "a" else lines[:10]))
+        importLog(str(tmp_path / d / "x.log"),p)
+
+    assert len(os.listdir(p.stateDir)) == 2
+    assert len([f for f in os.listdir(p.outDir) if f.endswith(".Aircraft.lp.gz")]) == 2
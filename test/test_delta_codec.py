@@ -0,0 +1,94 @@
+import random
+
+import pytest
+
+from common import Codec
+from common.ClientLog import MSI_TEMPLATE
+from common.DeltaCodec import DELETED, DELTA, KEYFRAME, DeltaDecoder, DeltaEncoder, simulateFlight
+
+TOPIC = "Delta/N362DN/DAL501/MSI"
+
+
+def frame(seq:int,kind:str,data:dict) -> dict :
+    return {"header" : {"seq" : seq, "frame" : kind}, "data" : data}
+
+
+def published(fmt,enc:DeltaEncoder,topic:str,rec:dict) -> dict :
+    header = {"timestamp" : rec['timestamp']}
+    fields,data = enc.encode(topic,rec)
+    header.update(fields)
+    return fmt.loads(fmt.dumps({"header" : header, "data" : data}))
+
+
+@pytest.mark.parametrize("fmtName",list(Codec.FORMATS))
+def test_round_trip(fmtName) :
+    # the server rebuilds every record that was published, in any format
+    fmt = Codec.FORMATS[fmtName]
+    enc = DeltaEncoder(20)
+    dec = DeltaDecoder()
+    for i,rec in enumerate(simulateFlight(TOPIC,MSI_TEMPLATE,500)):
+        out = dec.decode(TOPIC,published(fmt,enc,TOPIC,rec))
+        assert out is not None and out['data'] == rec, i
+    assert dec.keyframes == 25 and dec.deltas == 475 and dec.dropped == 0
+
+
+def test_loss_never_gives_a_wrong_record() :
+    # after a lost message deltas are dropped until the next keyframe, what
+    # comes through is exact
+    fmt = Codec.FORMATS["json"]
+    enc = DeltaEncoder(20)
+    dec = DeltaDecoder()
+    rnd = random.Random(1)
+    lost = 0
+    for i,rec in enumerate(simulateFlight(TOPIC,MSI_TEMPLATE,2000)):
+        payload = published(fmt,enc,TOPIC,rec)
+        if rnd.random() < 0.01:
+            lost += 1
+            continue
+        out = dec.decode(TOPIC,payload)
+        assert out is None or out['data'] == rec, i
+    assert lost > 0 and dec.dropped > 0
+
+
+def test_deleted_fields() :
+    enc = DeltaEncoder(10)
+    dec = DeltaDecoder()
+    for rec in ({"a" : 1, "b" : 2},{"a" : 1},{"a" : 3, "c" : 4}):
+        header,data = enc.encode(TOPIC,rec)
+        assert dec.decode(TOPIC,{"header" : header, "data" : data})['data'] == rec
+    assert enc.encode(TOPIC,{"c" : 4})[1] == {DELETED : ["a"]}
+
+
+def test_plain_records_pass_through() :
+    payload = {"header" : {"timestamp" : "2025-10-16T12:00:00Z"}, "data" : {"a" : 1}}
+    assert DeltaDecoder().decode(TOPIC,payload) is payload
+
+
+def test_gap_waits_for_a_keyframe() :
+    dec = DeltaDecoder()
+    assert dec.decode(TOPIC,frame(1,KEYFRAME,{"x" : 1})) is not None
+    assert dec.decode(TOPIC,frame(3,DELTA,{"x" : 3})) is None
+    assert dec.decode(TOPIC,frame(4,DELTA,{"x" : 4})) is None
+    assert dec.decode(TOPIC,frame(5,KEYFRAME,{"x" : 5}))['data'] == {"x" : 5}
+    assert dec.decode(TOPIC,frame(6,DELTA,{"y" : 6}))['data'] == {"x" : 5, "y" : 6}
+    assert dec.stats()['dropped'] == 2
+
+
+def test_reset_sends_keyframes() :
+    enc = DeltaEncoder(20)
+    assert enc.encode(TOPIC,{"a" : 1})[0]['frame'] == KEYFRAME
+    assert enc.encode(TOPIC,{"a" : 2})[0]['frame'] == DELTA
+    enc.reset()
+    assert enc.encode(TOPIC,{"a" : 3})[0] == {"seq" : 3, "frame" : KEYFRAME}
+
+
+def test_state_is_bounded() :
+    # an evicted topic resumes at its next keyframe, the others are kept
+    dec = DeltaDecoder(maxTopics=2)
+    for topic in ("a","b","c"):
+        dec.decode(topic,frame(1,KEYFRAME,{"x" : 1}))
+    assert list(dec.state) == ["b","c"] and dec.evicted == 1
+    assert dec.decode("a",frame(2,DELTA,{"x" : 2})) is None
+    assert dec.decode("b",frame(2,DELTA,{"x" : 2}))['data'] == {"x" : 2}
+    assert list(dec.state) == ["c","b"]
+    assert dec.stats()['evicted'] == 1
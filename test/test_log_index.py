@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import pytest
+
+from common.LogIndex import LogIndex, isoTime, parseCmdLine, toMillis
+
+LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),"AcClient_20251015_144203.log")
+
+
+def record(tail:str,ts:str) -> str :
+    return f"INFO:root:Publishing to Delta/{tail}/DL1/MSI, timestamp: {ts}\n"
+
+
+@pytest.fixture
+def log(tmp_path) :
+    fname = tmp_path / "flight.log"
+    shutil.copy(LOG,fname)
+    return str(fname)
+
+
+def test_reused_and_grown(log) :
+    built = LogIndex.open(log)
+    assert os.path.exists(LogIndex.indexPath(log))
+    assert len(LogIndex.open(log).ts) == len(built.ts)
+
+    with open(log,"a") as f:
+        f.write(record("N9XX","2025-10-16T00:00:00Z"))
+    grown = LogIndex.open(log)
+    assert len(grown.ts) == len(built.ts) + 1
+    assert grown.topics(tail="N9XX") == ["Delta/N9XX/DL1/MSI"]
+
+
+def test_replaced_by_larger_log(log) :
+    LogIndex.open(log)
+    other = log + ".new"
+    with open(other,"w") as f:
+        for i in range(100):
+            f.write(record("N1AA",f"2025-10-16T01:{i // 60:02d}:{i % 60:02d}Z"))
+        with open(log) as src:
+            f.write(src.read())
+    os.replace(other,log)
+
+    idx = LogIndex.open(log)
+    assert "Delta/N1AA/DL1/MSI" in idx.runs
+    records = list(idx.read(tail="N1AA"))
+    assert len(records) == 100
+    assert all(topic == "Delta/N1AA/DL1/MSI" for topic,payload,ts in records)
+
+
+def test_rewritten_in_place_same_size(log) :
+    # same inode and size, only the head changed
+    before = LogIndex.open(log)
+    with open(log,"r+b") as f:
+        data = f.read()
+        f.seek(0)
+        f.write(data.replace(b"N362DN",b"N999ZZ"))
+    st = os.stat(log)
+    os.utime(log,ns=(st.st_atime_ns,before.logMtime))
+
+    idx = LogIndex.open(log)
+    assert idx.topics(tail="N362DN") == []
+    assert len(list(idx.read(tail="N999ZZ"))) == len(before.ts)
+
+
+@pytest.mark.parametrize("bad",["yesterday","2025-13-01","",None])
+def test_bad_times_rejected(bad) :
+    with pytest.raises(ValueError):
+        isoTime(bad)
+    if bad is not None:
+        with pytest.raises(ValueError):
+            toMillis(bad)
+
+
+def test_times() :
+    assert toMillis(None) is None
+    assert toMillis("1970-01-01T00:00:01") == 1000
+    assert toMillis("1970-01-01T01:00:00+01:00") == 0
+
+
+def test_cli_rejects_bad_times(capsys) :
+    with pytest.raises(SystemExit):
+        parseCmdLine(["query","x.log","--start","nope"])
+    assert "--start" in capsys.readouterr().err
+    assert parseCmdLine(["query","x.log","--end","2025-10-15T15:00:00Z"]).end == isoTime("2025-10-15T15:00:00Z")
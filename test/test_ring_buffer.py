@@ -0,0 +1,117 @@
+import threading
+from time import sleep
+
+import pytest
+
+from LocalBroker import waitFor
+from common.RingBuffer import RingBuffer
+
+
+def producer(ring:RingBuffer,items:list) -> threading.Thread :
+    t = threading.Thread(target=ring.putMany,args=(items,),daemon=True)
+    t.start()
+    return t
+
+
+def test_invalid_arguments() :
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+    with pytest.raises(ValueError):
+        RingBuffer(4).cursor("x",overrun="wait")
+
+
+def test_wrap_around_batches() :
+    ring = RingBuffer(8)
+    cur = ring.cursor("sink")
+    got = []
+    for start in range(0,60,6):
+        ring.putMany(list(range(start,start + 6)))
+        while True:
+            batch = cur.get(maxItems=5,timeout=0)
+            if len(batch) == 0:
+                break
+            assert len(batch) <= 5
+            got.extend(batch)
+    assert got == list(range(60))
+    assert cur.dropped == 0 and cur.lag() == 0
+
+
+def test_new_cursor_starts_at_head() :
+    ring = RingBuffer(4)
+    ring.putMany([1,2,3])
+    cur = ring.cursor("late")
+    ring.put(4)
+    assert cur.get(timeout=0) == [4]
+
+
+def test_drop_accounting() :
+    ring = RingBuffer(8)
+    slow = ring.cursor("slow",overrun=RingBuffer.DROP)
+    fast = ring.cursor("fast")
+    for i in range(100):
+        ring.put(i)
+        assert fast.get(timeout=0) == [i]
+
+    # the last capacity messages are still there, the others were skipped
+    assert slow.lag() == 100
+    assert slow.get(maxItems=100,timeout=0) == list(range(92,100))
+    assert slow.dropped == 92
+    assert fast.dropped == 0
+    stats = ring.stats()
+    assert stats['head'] == 100 and stats['waits'] == 0
+    assert stats['cursors']['slow'] == {"overrun" : RingBuffer.DROP, "lag" : 0, "dropped" : 92}
+
+
+def test_block_waits_for_the_consumer() :
+    ring = RingBuffer(4)
+    cur = ring.cursor("influx",overrun=RingBuffer.BLOCK)
+    t = producer(ring,list(range(10)))
+
+    # the producer fills the ring, then waits for the BLOCK cursor
+    assert waitFor(lambda: ring.head == 4 and ring.waits == 1)
+    sleep(0.05)
+    assert t.is_alive() and ring.head == 4
+
+    got = []
+    while len(got) < 10:
+        got.extend(cur.get(maxItems=3,timeout=1))
+    t.join(1)
+    assert not t.is_alive()
+    assert got == list(range(10))
+    assert cur.dropped == 0 and ring.waits >= 1
+
+
+def test_block_only_waits_for_blocking_cursors() :
+    ring = RingBuffer(4)
+    block = ring.cursor("influx",overrun=RingBuffer.BLOCK)
+    drop = ring.cursor("kinesis",overrun=RingBuffer.DROP)
+    for i in range(3):
+        ring.putMany(list(range(i * 4,i * 4 + 4)))
+        assert block.get(timeout=0) == list(range(i * 4,i * 4 + 4))
+    assert ring.waits == 0
+    assert drop.get(maxItems=100,timeout=0) == list(range(8,12))
+    assert drop.dropped == 8
+
+
+def test_close_releases_a_blocked_producer() :
+    ring = RingBuffer(2)
+    ring.cursor("influx",overrun=RingBuffer.BLOCK)
+    t = producer(ring,list(range(5)))
+    assert waitFor(lambda: ring.waits == 1)
+    assert t.is_alive()
+
+    ring.close()
+    t.join(1)
+    assert not t.is_alive()
+    assert ring.head == 5
+
+
+def test_get_timeout_and_close() :
+    ring = RingBuffer(4)
+    cur = ring.cursor("sink")
+    assert cur.get(timeout=0.05) == []
+
+    t = threading.Thread(target=lambda: sleep(0.05) or ring.close(),daemon=True)
+    t.start()
+    assert cur.get(timeout=5) == []
+    t.join()
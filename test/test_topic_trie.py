@@ -0,0 +1,125 @@
+import random
+import threading
+
+import pytest
+
+from common.TopicTrie import TopicTrie
+
+
+@pytest.fixture
+def trie() :
+    trie = TopicTrie()
+    trie.add("Delta/+/+/MSI","msi")
+    trie.add("Delta/+/+/DSS","dss")
+    trie.add("Delta/N101DQ/#","tail")
+    trie.add("#","all")
+    trie.add("sport/tennis/+","tennis")
+    trie.add("+/+","two")
+    trie.add("/+","slash")
+    return trie
+
+
+@pytest.mark.parametrize("topic,expect",[
+    ("Delta/N101DQ/DL77/MSI",("msi","tail","all")),
+    ("Delta/N101DQ/DL77/DSS",("dss","tail","all")),
+    ("Delta/N102DQ/DL77/MSIX",("all",)),
+    ("Delta/N101DQ",("tail","all","two")),
+    ("Delta/N102DQ/DL77/MSI/x",("all",)),
+    ("sport/tennis/player1",("all","tennis")),
+    ("sport/tennis",("all","two")),
+    ("sport/tennis/player1/ranking",("all",)),
+    ("/finance",("all","two","slash")),
+    ("$SYS/broker",()),
+])
+def test_match(trie,topic,expect) :
+    # in subscription order, wildcards at the first level skip '$' topics
+    assert trie.match(topic) == expect
+    assert trie.match(topic) == expect
+
+
+def test_remove_and_resubscribe(trie) :
+    assert trie.match("Delta/N102DQ/DL77/MSIX") == ("all",)
+    assert trie.remove("#")
+    assert not trie.remove("#")
+    assert "#" not in trie
+    assert trie.match("Delta/N102DQ/DL77/MSIX") == ()
+
+    # a re-subscription replaces the value but keeps its place
+    trie.add("Delta/+/+/MSI","msi2")
+    assert trie.match("Delta/N101DQ/DL77/MSI") == ("msi2","tail")
+    assert len(trie) == 6
+
+
+@pytest.mark.parametrize("bad",["a/#/b","a/b#","a+/b"])
+def test_invalid_filters(bad) :
+    with pytest.raises(ValueError):
+        TopicTrie().add(bad,None)
+
+
+def brute(flt:str,topic:str) -> bool :
+    f = flt.split('/')
+    t = topic.split('/')
+    if topic.startswith('$') and f[0] in ('+','#'):
+        return False
+    for i,lvl in enumerate(f):
+        if lvl == '#':
+            return True
+        if i >= len(t) or (lvl != '+' and lvl != t[i]):
+            return False
+    return len(f) == len(t)
+
+
+def test_same_as_brute_force() :
+    rnd = random.Random(1)
+    words = ["a","b","c","+"]
+    trie = TopicTrie()
+    for i in range(300):
+        flt = "/".join(rnd.choice(words) for j in range(rnd.randint(1,4)))
+        if rnd.random() < 0.3:
+            flt += "/#"
+        trie.add(flt,flt)
+    for i in range(2000):
+        topic = "/".join(rnd.choice(words[:3]) for j in range(rnd.randint(1,5)))
+        expect = sorted(f for f in trie.filters if brute(f,topic))
+        assert sorted(trie.match(topic)) == expect, topic
+
+
+def test_cache_is_bounded() :
+    trie = TopicTrie(cacheSize=4)
+    trie.add("a/+","a")
+    for i in range(10):
+        assert trie.match(f"a/{i}") == ("a",)
+    assert trie.match("a/9") == ("a",)
+    stats = trie.stats()
+    assert stats['cached'] == 4 and stats['misses'] == 10 and stats['hits'] == 1
+
+
+def test_subscribe_while_matching() :
+    # MqttClient subscribes while its network thread is already matching
+    trie = TopicTrie(cacheSize=16)
+    errors = []
+    done = threading.Event()
+    def matcher() -> None :
+        try:
+            while not done.is_set():
+                for i in range(64):
+                    trie.match(f"a/{i}/MSI")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=matcher) for i in range(2)]
+    for t in threads:
+        t.start()
+    for i in range(2000):
+        trie.add(f"a/{i % 64}/+",i)
+        if i % 3 == 0:
+            trie.remove(f"a/{(i * 7) % 64}/+")
+    done.set()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    for i in range(64):
+        flt = f"a/{i}/+"
+        expect = (trie.filters[flt].value,) if flt in trie else ()
+        assert trie.match(f"a/{i}/MSI") == expect, i